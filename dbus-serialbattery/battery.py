@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
-from typing import Union, Tuple, List, Callable
+from typing import Union, Tuple, List, Callable, NamedTuple
+from array import array
 
 from utils import logger
 import utils
+from utils_stats import POWER_AVERAGE_WINDOWS, CoulombCounter, EventCounter, RollingWindow, TimeWindow
 import logging
 import math
+import threading
 from datetime import datetime
-from time import time
+from utils_clock import monotonic, now, time, wall_time
+from utils_profile import LoadProfile
 from abc import ABC, abstractmethod
 import sys
 
@@ -159,6 +163,368 @@ class Cell:
         self.balance = balance
 
 
+class CellView(Cell):
+    """
+    A cell of a `CellArray`. Reading and writing the attributes reads and writes the columns of the array,
+    so existing drivers can keep using `self.cells[c].voltage = ...`.
+    The views are created on access, the array does not keep an object per cell.
+    """
+
+    def __init__(self, cells: "CellArray", index: int):
+        self.cells = cells
+        self.index = index
+
+    @property
+    def voltage(self) -> Union[float, None]:
+        return self.cells.get_voltage(self.index)
+
+    @voltage.setter
+    def voltage(self, value: Union[float, None]) -> None:
+        self.cells.set_voltage(self.index, value)
+
+    @property
+    def balance(self) -> Union[bool, None]:
+        return self.cells.get_balance(self.index)
+
+    @balance.setter
+    def balance(self, value: Union[bool, None]) -> None:
+        self.cells.set_balance(self.index, value)
+
+    @property
+    def resistance(self) -> Union[float, None]:
+        return self.cells.get_column("resistances", self.index)
+
+    @resistance.setter
+    def resistance(self, value: Union[float, None]) -> None:
+        self.cells.set_column("resistances", self.index, value)
+
+    @property
+    def temp(self) -> Union[float, None]:
+        return self.cells.get_column("temperatures", self.index)
+
+    @temp.setter
+    def temp(self, value: Union[float, None]) -> None:
+        self.cells.set_column("temperatures", self.index, value)
+
+
+class CellArray:
+    """
+    Stores the cells of a battery in compact columns instead of one `Cell` object per cell.
+
+    The voltages are stored in an `array("d")` with NaN for unknown values, the balancing states in two bitmasks.
+    Resistances and temperatures are optional columns, which are created on the first write.
+    Sum, minimum and maximum of the voltages are maintained on write, so querying them does not scan the cells.
+
+    For compatibility with existing drivers it behaves like a list of `Cell` objects:
+    `append(Cell(False))`, `len()`, iteration and `cells[c].voltage` work as before.
+    Indexing and iteration return a `CellView`, which is created on access.
+    """
+
+    def __init__(self, cells: Union[List[Cell], None] = None):
+        """
+        :param cells: The cells to add
+        """
+        self.voltages: array = array("d")
+        """
+        Voltages of the cells in Volts, NaN if unknown. Can be handed to a publisher or recorder without copying.
+        """
+        self.balance_mask: int = 0
+        """
+        Bit n is set, if cell n is balancing
+        """
+        self.balance_known: int = 0
+        """
+        Bit n is set, if the balancing state of cell n is known
+        """
+        self.resistances: Union[array, None] = None
+        self.temperatures: Union[array, None] = None
+        self.voltage_sum_uv: int = 0
+        """
+        Sum of the known voltages in µV, an integer to avoid rounding errors adding up
+        """
+        self.min_index: Union[int, None] = None
+        self.max_index: Union[int, None] = None
+        self.aggregates_valid: bool = True
+
+        if cells:
+            self.extend(cells)
+
+    def __len__(self) -> int:
+        return len(self.voltages)
+
+    def __iter__(self):
+        return (CellView(self, index) for index in range(len(self.voltages)))
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[CellView, List[CellView]]:
+        if isinstance(index, slice):
+            return [CellView(self, i) for i in range(*index.indices(len(self.voltages)))]
+
+        if index < 0:
+            index += len(self.voltages)
+        if not 0 <= index < len(self.voltages):
+            raise IndexError("cell index out of range")
+
+        return CellView(self, index)
+
+    def append(self, cell: Cell) -> None:
+        """
+        Add a cell at the end. The values of the cell are copied into the array.
+
+        :param cell: The cell
+        :return: None
+        """
+        index = len(self.voltages)
+        self.voltages.append(math.nan)
+        for name in ("resistances", "temperatures"):
+            column = getattr(self, name)
+            if column is not None:
+                column.append(math.nan)
+
+        self.set_voltage(index, cell.voltage)
+        self.set_balance(index, cell.balance)
+        for attribute, name in (("resistance", "resistances"), ("temp", "temperatures")):
+            value = getattr(cell, attribute, None)
+            if value is not None:
+                self.set_column(name, index, value)
+
+    def extend(self, cells: List[Cell]) -> None:
+        for cell in cells:
+            self.append(cell)
+
+    def insert(self, index: int, cell: Cell) -> None:
+        """
+        Insert a cell before the index. The columns are rebuilt, since the bitmasks and indexes shift.
+
+        :param index: The index
+        :param cell: The cell
+        :return: None
+        """
+        cells = [self.copy_cell(i) for i in range(len(self))]
+        cells.insert(index, cell)
+        self.replace(cells)
+
+    def clear(self) -> None:
+        self.voltages = array("d")
+        self.balance_mask = 0
+        self.balance_known = 0
+        self.resistances = None
+        self.temperatures = None
+        self.voltage_sum_uv = 0
+        self.min_index = None
+        self.max_index = None
+        self.aggregates_valid = True
+
+    def replace(self, cells: List[Cell]) -> None:
+        """
+        Replace all cells, e.g. if a driver assigns a new list to `Battery.cells`.
+
+        :param cells: The new cells
+        :return: None
+        """
+        # copy first, the list could contain views of this array
+        cells = [self.copy_cell(cell.index) if isinstance(cell, CellView) and cell.cells is self else cell for cell in cells]
+        self.clear()
+        self.extend(cells)
+
+    def copy_cell(self, index: int) -> Cell:
+        """
+        Return a detached `Cell` with the values of a cell.
+
+        :param index: The index of the cell
+        :return: The cell
+        """
+        cell = Cell(self.get_balance(index))
+        cell.voltage = self.get_voltage(index)
+        for attribute, name in (("resistance", "resistances"), ("temp", "temperatures")):
+            value = self.get_column(name, index)
+            if value is not None:
+                setattr(cell, attribute, value)
+        return cell
+
+    def get_voltage(self, index: int) -> Union[float, None]:
+        voltage = self.voltages[index]
+        return None if voltage != voltage else voltage
+
+    def set_voltage(self, index: int, value: Union[float, None]) -> None:
+        """
+        Set the voltage of a cell and update the sum, minimum and maximum.
+
+        :param index: The index of the cell
+        :param value: The voltage in Volts, None if unknown
+        :return: None
+        """
+        old = self.voltages[index]
+        new = math.nan if value is None else float(value)
+
+        # NaN != NaN, so compare the representation of unknown values separately
+        if old == new or (old != old and new != new):
+            return
+
+        if old == old:
+            self.voltage_sum_uv -= round(old * 1000000)
+        if new == new:
+            self.voltage_sum_uv += round(new * 1000000)
+
+        self.voltages[index] = new
+
+        if not self.aggregates_valid:
+            return
+
+        # keep the first index of the minimum and maximum, like a scan would return it
+        if index == self.min_index:
+            if new != new or new > old:
+                self.aggregates_valid = False
+        elif new == new:
+            min_voltage = self.voltages[self.min_index] if self.min_index is not None else math.inf
+            if new < min_voltage or (new == min_voltage and index < self.min_index):
+                self.min_index = index
+
+        if index == self.max_index:
+            if new != new or new < old:
+                self.aggregates_valid = False
+        elif new == new:
+            max_voltage = self.voltages[self.max_index] if self.max_index is not None else -math.inf
+            if new > max_voltage or (new == max_voltage and index < self.max_index):
+                self.max_index = index
+
+    def get_balance(self, index: int) -> Union[bool, None]:
+        bit = 1 << index
+        if not self.balance_known & bit:
+            return None
+        return bool(self.balance_mask & bit)
+
+    def set_balance(self, index: int, value: Union[bool, None]) -> None:
+        bit = 1 << index
+        if value is None:
+            self.balance_known &= ~bit
+        else:
+            self.balance_known |= bit
+        if value:
+            self.balance_mask |= bit
+        else:
+            self.balance_mask &= ~bit
+
+    def get_column(self, name: str, index: int) -> Union[float, None]:
+        column = getattr(self, name)
+        if column is None:
+            return None
+        value = column[index]
+        return None if value != value else value
+
+    def set_column(self, name: str, index: int, value: Union[float, None]) -> None:
+        """
+        Set a value of an optional column, the column is created on the first write.
+
+        :param name: The name of the column, `resistances` or `temperatures`
+        :param index: The index of the cell
+        :param value: The value, None if unknown
+        :return: None
+        """
+        column = getattr(self, name)
+        if column is None:
+            if value is None:
+                return
+            column = array("d", [math.nan]) * len(self.voltages)
+            setattr(self, name, column)
+        column[index] = math.nan if value is None else float(value)
+
+    def update_aggregates(self) -> None:
+        """
+        Scan the voltages, if the minimum or maximum cell got a value that could have changed its position.
+
+        :return: None
+        """
+        self.min_index = None
+        self.max_index = None
+        for index, voltage in enumerate(self.voltages):
+            if voltage != voltage:
+                continue
+            if self.min_index is None or voltage < self.voltages[self.min_index]:
+                self.min_index = index
+            if self.max_index is None or voltage > self.voltages[self.max_index]:
+                self.max_index = index
+        self.aggregates_valid = True
+
+    def get_min_index(self) -> Union[int, None]:
+        """
+        :return: The index of the first cell with the lowest voltage, None if no voltage is known
+        """
+        if not self.aggregates_valid:
+            self.update_aggregates()
+        return self.min_index
+
+    def get_max_index(self) -> Union[int, None]:
+        """
+        :return: The index of the first cell with the highest voltage, None if no voltage is known
+        """
+        if not self.aggregates_valid:
+            self.update_aggregates()
+        return self.max_index
+
+    def get_voltage_sum(self) -> float:
+        """
+        :return: The sum of the known voltages in Volts
+        """
+        return self.voltage_sum_uv / 1000000
+
+    def is_balancing(self) -> bool:
+        """
+        :return: True if any cell is balancing
+        """
+        return self.balance_mask != 0
+
+
+class PollTier:
+    """
+    Defines how often a read function of a BMS driver is called by `Battery.run_due_reads()`.
+
+    FAST = every poll, e.g. voltage and current
+    MEDIUM = every `POLL_INTERVAL_MEDIUM` seconds, e.g. cell voltages and temperatures
+    SLOW = every `POLL_INTERVAL_SLOW` seconds, e.g. alarms
+    STATIC = only once after the connection was established, e.g. serial number and capacity
+    """
+
+    FAST = 0
+    MEDIUM = 1
+    SLOW = 2
+    STATIC = 3
+
+
+def poll_tier(tier: int) -> Callable:
+    """
+    Decorator to declare the `PollTier` of a read function of a BMS driver.
+    Read functions without a declared tier are called on every poll.
+
+    :param tier: the `PollTier`
+    :return: the decorator
+    """
+
+    def decorator(read_function: Callable) -> Callable:
+        read_function.poll_tier = tier
+        return read_function
+
+    return decorator
+
+
+class BatteryMetrics(NamedTuple):
+    """
+    Aggregates of the cells and temperatures, calculated once per poll by `Battery.update_metrics()`
+    """
+
+    min_cell: Union[int, None]
+    max_cell: Union[int, None]
+    min_cell_voltage: Union[float, None]
+    max_cell_voltage: Union[float, None]
+    cell_voltage_sum: float
+    balancing: int
+    midvoltage: Tuple[Union[float, None], Union[float, None]]
+    temp: Union[float, None]
+    min_temp: Union[float, None]
+    min_temp_id: Union[str, None]
+    max_temp: Union[float, None]
+    max_temp_id: Union[str, None]
+
+
 class Battery(ABC):
     """
     This Class is the abstract baseclass for all batteries. For each BMS this class needs to be extended
@@ -187,6 +553,17 @@ class Battery(ABC):
         self.max_battery_charge_current: float = utils.MAX_BATTERY_CHARGE_CURRENT
         self.max_battery_discharge_current: float = utils.MAX_BATTERY_DISCHARGE_CURRENT
         self.has_settings: bool = False
+        self.poll_lock: threading.Lock = threading.Lock()
+        """
+        Held by the poll thread while `refresh_data()` runs. Main loop callbacks that change the battery,
+        like the ones of `/Settings/ResetSoc` or `/Io/ForceChargingOff`, acquire it, so they don't change the
+        battery in the middle of a poll.
+        """
+        self.current_samples_from_frames: bool = False
+        """
+        Set by drivers that add the current of every received frame with `add_current_sample()`.
+        Then the current set by `refresh_data()` is not added again to the `coulomb_counter`.
+        """
 
         # this values should only be initialized once,
         # else the BMS turns off the inverter on disconnect
@@ -205,7 +582,14 @@ class Battery(ABC):
         self.control_allow_discharge: bool = None
 
         self.current_avg: float = None
-        self.current_avg_lst: list = []
+        self.current_avg_window: RollingWindow = RollingWindow(300)
+        """
+        Current of the last 300 polls, used for `current_avg`
+        """
+        self.power_avg: dict = {name: TimeWindow(window, resolution) for name, window, resolution in POWER_AVERAGE_WINDOWS}
+        """
+        Average power per window of `POWER_AVERAGE_WINDOWS`
+        """
         self.current_external: float = None
         self.capacity_remain: float = None
         self.capacity: float = None
@@ -213,14 +597,17 @@ class Battery(ABC):
         self.protection = Protection()
         self.history = History()
         self.version = None
-        self.time_to_soc_update: int = 0
+        self.time_to_soc_update: Union[float, None] = None
+        """
+        Monotonic time of the last Time-to-SoC calculation
+        """
         self.temp_sensors: int = None
         self.temp1: float = None
         self.temp2: float = None
         self.temp3: float = None
         self.temp4: float = None
         self.temp_mos: float = None
-        self.cells: List[Cell] = []
+        self._cells: CellArray = CellArray()
         self.control_voltage: float = None
         self.soc_reset_requested: bool = False
         self.soc_reset_last_reached: int = 0  # save state to preserve on restart
@@ -236,9 +623,12 @@ class Battery(ABC):
         self.charge_mode_debug_bulk: str = ""
         self.charge_limitation: str = None
         self.discharge_limitation: str = None
-        self.linear_cvl_last_set: int = 0
-        self.linear_ccl_last_set: int = 0
-        self.linear_dcl_last_set: int = 0
+        self.linear_cvl_last_set: Union[float, None] = None
+        self.linear_ccl_last_set: Union[float, None] = None
+        self.linear_dcl_last_set: Union[float, None] = None
+        """
+        Monotonic time of the last change of the CVL, CCL and DCL in linear mode
+        """
 
         # list of available callbacks, in order to display the buttons in the GUI
         self.available_callbacks: List[str] = []
@@ -258,14 +648,19 @@ class Battery(ABC):
         Does not block charge/discharge
         """
 
-        self.error_code_last_reset_check: int = 0
+        self.error_code_last_reset_check: float = 0
         """
-        Timestamp when it was last checked, if the error could be reset
+        Monotonic time when it was last checked, if the error could be reset
         """
 
-        self.error_timestamps: list = []
+        self.error_counter: EventCounter = EventCounter(60 * 60 * 3, 180)
         """
-        List of timestamps when an error occurred
+        Counts the errors of the last 3 hours
+        """
+
+        self.error_code_counted: Union[int, None] = None
+        """
+        Error code that was set by `manage_error_code()`, only this one is reset by `manage_error_code_reset()`
         """
 
         self.custom_field: str = None
@@ -275,6 +670,65 @@ class Battery(ABC):
 
         self.init_values()
 
+    @property
+    def cells(self) -> CellArray:
+        """
+        The cells of the battery
+        """
+        return self._cells
+
+    @cells.setter
+    def cells(self, cells: Union[CellArray, List[Cell]]) -> None:
+        # drivers assign new lists, keep the array, so references to its buffers stay valid
+        if cells is not self._cells:
+            self._cells.replace(cells)
+
+    @property
+    def current(self) -> Union[float, None]:
+        """
+        The current in A reported by the BMS. Every value set by the driver is added to the `coulomb_counter`,
+        unless the driver adds the samples of the received frames itself, see `add_current_sample()`.
+        """
+        return self._current
+
+    @current.setter
+    def current(self, current: Union[float, None]) -> None:
+        self._current = current
+
+        if current is not None and not getattr(self, "current_samples_from_frames", False):
+            self.add_current_sample(current)
+
+    def add_current_sample(self, current: float, timestamp: float = None) -> None:
+        """
+        Add a current sample to the `coulomb_counter`. Drivers that receive the frames in another thread,
+        like CAN or Bluetooth, call it for every frame with the time of the reception,
+        so that every sample is integrated and not only the last value of each poll.
+
+        :param current: The current in A
+        :param timestamp: Monotonic time of the reception in seconds, now if None
+        :return: None
+        """
+        # if an external current sensor is used, its value is added in soc_calculation()
+        if getattr(self, "dbus_external_objects", None) is not None:
+            return
+
+        coulomb_counter = getattr(self, "coulomb_counter", None)
+        if coulomb_counter is not None:
+            # samples without time are set by refresh_data() and can correct a preliminary value of the same poll,
+            # samples of received frames are always integrated
+            coulomb_counter.add(current, timestamp, supersede=timestamp is None)
+
+    def correct_current(self, current: float) -> float:
+        """
+        Correct the current reported by the BMS with the SoC current correction curve.
+
+        :param current: The current in A
+        :return: The corrected current in A
+        """
+        if utils.SOC_CALC_CURRENT:
+            return utils.LIMIT_CURVES["soc_calc_current"].linear(current)
+        return current
+
     def init_values(self) -> None:
         """
         Used to initialize and reset values, if battery unexpectly disconnects
@@ -282,9 +736,21 @@ class Battery(ABC):
         :return: None
         """
         self.voltage: float = None
+        self.coulomb_counter: CoulombCounter = CoulombCounter(self.correct_current)
+        """
+        Integrates every current sample for the SoC calculation, see `soc_calculation()`
+        """
         self.current: float = None
         self.current_corrected: float = None
         self.driver_start_time: int = int(time())
+        self.poll_tier_last_read: dict = {}
+        """
+        Monotonic timestamp of the last successful call of each read function, see `run_due_reads()`
+        """
+        self.metrics: Union[BatteryMetrics, None] = None
+        """
+        Aggregates of the last poll, see `update_metrics()`
+        """
 
     @abstractmethod
     def test_connection(self) -> bool:
@@ -356,6 +822,17 @@ class Battery(ABC):
         """
         return False
 
+    def get_link_metrics(self) -> dict:
+        """
+        Each driver with a wireless connection may override this function to provide link quality metrics,
+        like the signal strength and the number of reconnects. They are published on the dbus under `/Link/<key>`.
+
+        The keys have to be the same on every call, since the dbus paths are created once on startup.
+
+        :return: dict with the metric names as keys, empty if not supported
+        """
+        return {}
+
     def set_message_cache_callback(self, callback: callable) -> None:
         """
         Set the callback for the can message cache.
@@ -365,6 +842,18 @@ class Battery(ABC):
         """
         self.can_message_cache_callback: callable = callback
 
+    def can_frame_received(self, arbitration_id: int, data: bytearray, timestamp: float) -> None:
+        """
+        Called by the CAN receiver thread for every received frame, before it's polled from the message cache.
+        Drivers can override it to add every current sample with `add_current_sample()`.
+
+        :param arbitration_id: The arbitration id of the frame
+        :param data: The payload of the frame
+        :param timestamp: Monotonic time of the reception in seconds
+        :return: None
+        """
+        pass
+
     @abstractmethod
     def get_settings(self) -> bool:
         """
@@ -387,6 +876,59 @@ class Battery(ABC):
         """
         return False
 
+    def is_read_due(self, read_function: Callable) -> bool:
+        """
+        Check if a read function has to be called in this poll, depending on its `PollTier`.
+
+        :param read_function: the read function, optionally decorated with `poll_tier()`
+        :return: True if the read function has to be called, else False
+        """
+        tier = getattr(read_function, "poll_tier", PollTier.FAST)
+        last_read = self.poll_tier_last_read.get(read_function.__name__)
+
+        if tier == PollTier.FAST or last_read is None:
+            return True
+
+        if tier == PollTier.STATIC:
+            return False
+
+        period = utils.POLL_INTERVAL_MEDIUM if tier == PollTier.MEDIUM else utils.POLL_INTERVAL_SLOW
+
+        # allow half a poll interval of jitter, else a read would be skipped one poll too often
+        return monotonic() - last_read >= period - self.poll_interval / 2000
+
+    def run_due_reads(self, read_functions: List[Callable], *args, stop_on_failure: bool = True) -> bool:
+        """
+        Call all read functions that are due in this poll. Data of skipped read functions
+        stays the same as in the last poll. A failed read function is called again in the next poll.
+
+        :param read_functions: the read functions in the order they have to be called
+        :param args: arguments passed to each read function, e.g. the serial port
+        :param stop_on_failure: if True, stop after the first failed read function, else call all of them
+        :return: True if all called read functions were successful, else False
+        """
+        result = True
+
+        for read_function in read_functions:
+            if not self.is_read_due(read_function):
+                continue
+
+            read_start = monotonic()
+            read_result = read_function(*args)
+            read_end = monotonic()
+
+            if logger.isEnabledFor(logging.DEBUG) and read_end - read_start > 0.200:
+                logger.debug(f"  |- refresh_data: {read_function.__name__} - result: {read_result} - runtime: {read_end - read_start:.1f}s")
+
+            if read_result:
+                self.poll_tier_last_read[read_function.__name__] = read_end
+            else:
+                result = False
+                if stop_on_failure:
+                    break
+
+        return result
+
     def to_temp(self, sensor: int, value: float) -> None:
         """
         Keep the temp value between -20 and 100 to handle sensor issues or no data.
@@ -453,9 +995,16 @@ class Battery(ABC):
 
         :return: None
         """
-        current_time = time()
+        current_time = now()
         self.current_corrected = 0
 
+        # the external current sensor is only read once per poll
+        if self.dbus_external_objects is not None and self.get_current() is not None:
+            self.coulomb_counter.add(self.get_current())
+
+        # charge since the last call, integrated from every current sample
+        charge = self.coulomb_counter.take()
+
         # ### only needed, if the SOC should be reset to 100% after the battery was balanced
         """
         voltage_sum = 0
@@ -468,24 +1017,10 @@ class Battery(ABC):
         """
 
         if self.soc_calc_capacity_remain is not None:
-            # calculate current only, if lists are different
-            if utils.SOC_CALC_CURRENT:
-                # calculate current from real current
-                self.current_corrected = round(
-                    utils.calc_linear_relationship(
-                        self.get_current(),
-                        utils.SOC_CALC_CURRENT_REPORTED_BY_BMS,
-                        utils.SOC_CALC_CURRENT_MEASURED_BY_USER,
-                    ),
-                    3,
-                )
-            else:
-                # use current as it is
-                self.current_corrected = self.get_current()
+            # corrected current of this poll, only for logging
+            self.current_corrected = round(self.correct_current(self.get_current()), 3) if self.get_current() is not None else None
 
-            self.soc_calc_capacity_remain = (
-                self.soc_calc_capacity_remain + self.current_corrected * (current_time - self.soc_calc_capacity_remain_lasttime) / 3600
-            )
+            self.soc_calc_capacity_remain = self.soc_calc_capacity_remain + charge
 
             # limit soc_calc_capacity_remain to capacity and zero
             # in case 100% is reached and the battery is not fully charged
@@ -558,7 +1093,7 @@ class Battery(ABC):
         :return: None
         """
 
-        soc_reset_last_reached_days_ago = 0 if self.soc_reset_last_reached == 0 else (((int(time()) - self.soc_reset_last_reached) / 60 / 60 / 24))
+        soc_reset_last_reached_days_ago = 0 if self.soc_reset_last_reached == 0 else (((int(wall_time()) - self.soc_reset_last_reached) / 60 / 60 / 24))
 
         # set soc_reset_requested to True, if the days are over
         # it gets set to False once the bulk voltage was reached once
@@ -588,27 +1123,28 @@ class Battery(ABC):
         penalty_sum = 0
         time_diff = 0
         control_voltage = 0
-        current_time = int(time())
+        # persisted timestamps like `max_voltage_start_time` have to survive a restart, so they use the wall time
+        current_time = int(wall_time())
 
         # meassurment and variation tolerance in volts
         measurement_tolerance_variation = 0.5
 
         try:
+            # the penalty is calculated above the SoC reset voltage, while a SoC reset is requested
+            cell_voltage_limit = utils.SOC_RESET_VOLTAGE if self.max_battery_voltage == self.soc_reset_battery_voltage else utils.MAX_CELL_VOLTAGE
+
             # calculate voltage sum and check for cell overvoltage
-            for i in range(self.cell_count):
-                voltage = self.get_cell_voltage(i)
-                if voltage:
+            # read the voltages from the cell array directly, since this runs every poll for every cell
+            for voltage in self.cells.voltages[: min(len(self.cells), self.cell_count)]:
+                # skip unknown (NaN) and zero voltages
+                if voltage == voltage and voltage:
                     voltage_sum += voltage
 
                     # calculate penalty sum to prevent single cell overcharge by using current cell voltage
-                    if self.max_battery_voltage != self.soc_reset_battery_voltage and voltage > utils.MAX_CELL_VOLTAGE:
-                        # found_high_cell_voltage: reset to False is not needed, since it is recalculated every second
-                        found_high_cell_voltage = True
-                        penalty_sum += voltage - utils.MAX_CELL_VOLTAGE
-                    elif self.max_battery_voltage == self.soc_reset_battery_voltage and voltage > utils.SOC_RESET_VOLTAGE:
+                    if voltage > cell_voltage_limit:
                         # found_high_cell_voltage: reset to False is not needed, since it is recalculated every second
                         found_high_cell_voltage = True
-                        penalty_sum += voltage - utils.SOC_RESET_VOLTAGE
+                        penalty_sum += voltage - cell_voltage_limit
 
             voltage_cell_diff = self.get_max_cell_voltage() - self.get_min_cell_voltage()
 
@@ -725,13 +1261,13 @@ class Battery(ABC):
                 if self.control_voltage:
                     # check if battery changed from bulk/absoprtion to float
                     if self.charge_mode is not None and not self.charge_mode.startswith("Float"):
-                        self.transition_start_time = current_time
+                        self.transition_start_time = now()
                         self.initial_control_voltage = self.control_voltage
                         charge_mode = "Float Transition"
                         # Assume battery SOC ist 100% at this stage
                         self.trigger_soc_reset()
                     elif self.charge_mode.startswith("Float Transition"):
-                        elapsed_time = current_time - self.transition_start_time
+                        elapsed_time = now() - self.transition_start_time
                         # Voltage reduction per second
                         VOLTAGE_REDUCTION_PER_SECOND = 0.01 / 10
                         voltage_reduction = min(
@@ -789,7 +1325,7 @@ class Battery(ABC):
                         else ""
                     )
                     + "soc_calc_reset_starttime: "
-                    + (f"{int(current_time - self.soc_calc_reset_starttime)}/{utils.SOC_RESET_TIME}" if self.soc_calc_reset_starttime is not None else "None")
+                    + (f"{int(now() - self.soc_calc_reset_starttime)}/{utils.SOC_RESET_TIME}" if self.soc_calc_reset_starttime is not None else "None")
                 )
 
                 self.charge_mode_debug_float = (
@@ -839,11 +1375,14 @@ class Battery(ABC):
 
         :return: The status, if the CVL was set
         """
-        current_time = int(time())
+        current_time = now()
         diff = abs(self.control_voltage - control_voltage) if self.control_voltage is not None else 0
 
-        if utils.LINEAR_RECALCULATION_EVERY <= current_time - self.linear_cvl_last_set or (
-            diff >= self.control_voltage * utils.LINEAR_RECALCULATION_ON_PERC_CHANGE / 100 / 10  # for more precision, since the changes are small in this case
+        # the change is divided by 10 for more precision, since the changes are small in this case
+        if (
+            self.linear_cvl_last_set is None
+            or utils.LINEAR_RECALCULATION_EVERY <= current_time - self.linear_cvl_last_set
+            or diff >= self.control_voltage * utils.LINEAR_RECALCULATION_ON_PERC_CHANGE / 100 / 10
         ):
             self.control_voltage = control_voltage
             self.linear_cvl_last_set = current_time
@@ -859,7 +1398,8 @@ class Battery(ABC):
         """
         voltage_sum = 0
         time_diff = 0
-        current_time = int(time())
+        # persisted timestamps like `max_voltage_start_time` have to survive a restart, so they use the wall time
+        current_time = int(wall_time())
 
         try:
             # calculate battery sum
@@ -954,7 +1494,7 @@ class Battery(ABC):
                         else ""
                     )
                     + "soc_calc_reset_starttime: "
-                    + (f"{int(current_time - self.soc_calc_reset_starttime)}/{utils.SOC_RESET_TIME}" if self.soc_calc_reset_starttime is not None else "None")
+                    + (f"{int(now() - self.soc_calc_reset_starttime)}/{utils.SOC_RESET_TIME}" if self.soc_calc_reset_starttime is not None else "None")
                 )
 
                 self.charge_mode_debug_float = (
@@ -1054,11 +1594,12 @@ class Battery(ABC):
         ccl = round(min(charge_limits), 3)
         diff = abs(self.control_charge_current - ccl) if self.control_charge_current is not None else 0
         if (
-            int(time()) - self.linear_ccl_last_set >= utils.LINEAR_RECALCULATION_EVERY
+            self.linear_ccl_last_set is None
+            or now() - self.linear_ccl_last_set >= utils.LINEAR_RECALCULATION_EVERY
             or (diff >= self.control_charge_current * utils.LINEAR_RECALCULATION_ON_PERC_CHANGE / 100)
             or (ccl == 0 and self.control_charge_current != 0)
         ):
-            self.linear_ccl_last_set = int(time())
+            self.linear_ccl_last_set = now()
 
             # Introduce a threshold mechanism to prevent flapping
             if ccl == 0:
@@ -1140,11 +1681,12 @@ class Battery(ABC):
         dcl = round(min(discharge_limits), 3)
         diff = abs(self.control_discharge_current - dcl) if self.control_discharge_current is not None else 0
         if (
-            int(time()) - self.linear_dcl_last_set >= utils.LINEAR_RECALCULATION_EVERY
+            self.linear_dcl_last_set is None
+            or now() - self.linear_dcl_last_set >= utils.LINEAR_RECALCULATION_EVERY
             or (diff >= self.control_discharge_current * utils.LINEAR_RECALCULATION_ON_PERC_CHANGE / 100)
             or (dcl == 0 and self.control_discharge_current != 0)
         ):
-            self.linear_dcl_last_set = int(time())
+            self.linear_dcl_last_set = now()
 
             # Introduce a threshold mechanism to prevent flapping
             if dcl == 0:
@@ -1180,17 +1722,8 @@ class Battery(ABC):
 
         try:
             if utils.LINEAR_LIMITATION_ENABLE:
-                return utils.calc_linear_relationship(
-                    self.get_max_cell_voltage(),
-                    utils.CELL_VOLTAGES_WHILE_CHARGING,
-                    utils.MAX_CHARGE_CURRENT_CV,
-                )
-            return utils.calc_step_relationship(
-                self.get_max_cell_voltage(),
-                utils.CELL_VOLTAGES_WHILE_CHARGING,
-                utils.MAX_CHARGE_CURRENT_CV,
-                False,
-            )
+                return utils.LIMIT_CURVES["charge_cell_voltage"].linear(self.get_max_cell_voltage())
+            return utils.LIMIT_CURVES["charge_cell_voltage"].step(self.get_max_cell_voltage(), False)
         except Exception:
             # set error code, to show in the GUI that something is wrong
             self.manage_error_code(8)
@@ -1228,17 +1761,8 @@ class Battery(ABC):
 
         try:
             if utils.LINEAR_LIMITATION_ENABLE:
-                return utils.calc_linear_relationship(
-                    self.get_min_cell_voltage(),
-                    utils.CELL_VOLTAGES_WHILE_DISCHARGING,
-                    utils.MAX_DISCHARGE_CURRENT_CV,
-                )
-            return utils.calc_step_relationship(
-                self.get_min_cell_voltage(),
-                utils.CELL_VOLTAGES_WHILE_DISCHARGING,
-                utils.MAX_DISCHARGE_CURRENT_CV,
-                True,
-            )
+                return utils.LIMIT_CURVES["discharge_cell_voltage"].linear(self.get_min_cell_voltage())
+            return utils.LIMIT_CURVES["discharge_cell_voltage"].step(self.get_min_cell_voltage(), True)
         except Exception:
             # set error code, to show in the GUI that something is wrong
             self.manage_error_code(8)
@@ -1276,18 +1800,9 @@ class Battery(ABC):
         try:
             for key, currentMaxTemperature in temps.items():
                 if utils.LINEAR_LIMITATION_ENABLE:
-                    temps[key] = utils.calc_linear_relationship(
-                        currentMaxTemperature,
-                        utils.TEMPERATURES_WHILE_CHARGING,
-                        utils.MAX_CHARGE_CURRENT_T,
-                    )
+                    temps[key] = utils.LIMIT_CURVES["charge_temperature"].linear(currentMaxTemperature)
                 else:
-                    temps[key] = utils.calc_step_relationship(
-                        currentMaxTemperature,
-                        utils.TEMPERATURES_WHILE_CHARGING,
-                        utils.MAX_CHARGE_CURRENT_T,
-                        False,
-                    )
+                    temps[key] = utils.LIMIT_CURVES["charge_temperature"].step(currentMaxTemperature, False)
             return min(temps[0], temps[1])
         except Exception:
             # set error code, to show in the GUI that something is wrong
@@ -1326,18 +1841,9 @@ class Battery(ABC):
         try:
             for key, currentMaxTemperature in temps.items():
                 if utils.LINEAR_LIMITATION_ENABLE:
-                    temps[key] = utils.calc_linear_relationship(
-                        currentMaxTemperature,
-                        utils.TEMPERATURES_WHILE_DISCHARGING,
-                        utils.MAX_DISCHARGE_CURRENT_T,
-                    )
+                    temps[key] = utils.LIMIT_CURVES["discharge_temperature"].linear(currentMaxTemperature)
                 else:
-                    temps[key] = utils.calc_step_relationship(
-                        currentMaxTemperature,
-                        utils.TEMPERATURES_WHILE_DISCHARGING,
-                        utils.MAX_DISCHARGE_CURRENT_T,
-                        True,
-                    )
+                    temps[key] = utils.LIMIT_CURVES["discharge_temperature"].step(currentMaxTemperature, True)
             return min(temps[0], temps[1])
         except Exception:
             # set error code, to show in the GUI that something is wrong
@@ -1364,17 +1870,8 @@ class Battery(ABC):
         """
         try:
             if utils.LINEAR_LIMITATION_ENABLE:
-                return utils.calc_linear_relationship(
-                    self.soc_calc,
-                    utils.SOC_WHILE_CHARGING,
-                    utils.MAX_CHARGE_CURRENT_SOC,
-                )
-            return utils.calc_step_relationship(
-                self.soc_calc,
-                utils.SOC_WHILE_CHARGING,
-                utils.MAX_CHARGE_CURRENT_SOC,
-                True,
-            )
+                return utils.LIMIT_CURVES["charge_soc"].linear(self.soc_calc)
+            return utils.LIMIT_CURVES["charge_soc"].step(self.soc_calc, True)
         except Exception:
             # set error code, to show in the GUI that something is wrong
             self.manage_error_code(8)
@@ -1400,17 +1897,8 @@ class Battery(ABC):
         """
         try:
             if utils.LINEAR_LIMITATION_ENABLE:
-                return utils.calc_linear_relationship(
-                    self.soc_calc,
-                    utils.SOC_WHILE_DISCHARGING,
-                    utils.MAX_DISCHARGE_CURRENT_SOC,
-                )
-            return utils.calc_step_relationship(
-                self.soc_calc,
-                utils.SOC_WHILE_DISCHARGING,
-                utils.MAX_DISCHARGE_CURRENT_SOC,
-                True,
-            )
+                return utils.LIMIT_CURVES["discharge_soc"].linear(self.soc_calc)
+            return utils.LIMIT_CURVES["discharge_soc"].step(self.soc_calc, True)
         except Exception:
             # set error code, to show in the GUI that something is wrong
             self.manage_error_code(8)
@@ -1428,12 +1916,94 @@ class Battery(ABC):
             logger.error(f"Exception occurred: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
             return self.max_battery_discharge_current
 
+    def update_metrics(self) -> None:
+        """
+        Calculate the aggregates of the cells and temperatures once after `refresh_data()`.
+        Until the next poll the getters like `get_min_cell()` and `get_max_cell_voltage()` return these values
+        instead of scanning the cells on every call.
+
+        :return: None
+        """
+        # the getters calculate the values, while no snapshot is set
+        self.metrics = None
+
+        cells = self.cells
+        cell_count = min(len(cells), self.cell_count) if self.cell_count is not None else 0
+        min_cell = None
+        max_cell = None
+        min_cell_voltage = None
+        max_cell_voltage = None
+        cell_voltage_sum = 0
+        balancing = 0
+
+        if cell_count == len(cells):
+            # all cells are used, the aggregates are maintained by the cell array on write
+            min_cell = cells.get_min_index()
+            max_cell = cells.get_max_index()
+            min_cell_voltage = cells.get_voltage(min_cell) if min_cell is not None else None
+            max_cell_voltage = cells.get_voltage(max_cell) if max_cell is not None else None
+            if max_cell_voltage is not None and max_cell_voltage <= 0:
+                max_cell = None
+            cell_voltage_sum = cells.get_voltage_sum()
+            balancing = 1 if cells.is_balancing() else 0
+
+        else:
+            # scan the cells only once
+            for c, cell in enumerate(cells):
+                voltage = cell.voltage
+
+                if c < cell_count and cell.balance:
+                    balancing = 1
+
+                if voltage is None:
+                    continue
+
+                # the min/max voltage include all cells, the cell numbers only the configured ones
+                if min_cell_voltage is None or voltage < min_cell_voltage:
+                    min_cell_voltage = voltage
+                if max_cell_voltage is None or voltage > max_cell_voltage:
+                    max_cell_voltage = voltage
+
+                if c < cell_count:
+                    if min_cell is None or voltage < cells[min_cell].voltage:
+                        min_cell = c
+                    if (max_cell is None or voltage > cells[max_cell].voltage) and voltage > 0:
+                        max_cell = c
+                    cell_voltage_sum += voltage
+
+        # keep the values of BMS that only report the min/max cell
+        if len(self.cells) == 0:
+            min_cell = getattr(self, "cell_min_no", None)
+            max_cell = getattr(self, "cell_max_no", None)
+        if getattr(self, "cell_min_voltage", None) is not None:
+            min_cell_voltage = self.cell_min_voltage
+        if getattr(self, "cell_max_voltage", None) is not None:
+            max_cell_voltage = self.cell_max_voltage
+
+        self.metrics = BatteryMetrics(
+            min_cell,
+            max_cell,
+            min_cell_voltage,
+            max_cell_voltage,
+            cell_voltage_sum,
+            balancing,
+            self.get_midvoltage(),
+            self.get_temp(),
+            self.get_min_temp(),
+            self.get_min_temp_id(),
+            self.get_max_temp(),
+            self.get_max_temp_id(),
+        )
+
     def get_min_cell(self) -> int:
         """
         Get the cell with the lowest voltage.
 
         :return: The number of the cell with the lowest voltage
         """
+        if self.metrics is not None:
+            return self.metrics.min_cell
+
         min_voltage = 9999
         min_cell = None
         if len(self.cells) == 0 and hasattr(self, "cell_min_no"):
@@ -1451,6 +2021,9 @@ class Battery(ABC):
 
         :return: The number of the cell with the highest voltage
         """
+        if self.metrics is not None:
+            return self.metrics.max_cell
+
         max_voltage = 0
         max_cell = None
         if len(self.cells) == 0 and hasattr(self, "cell_max_no"):
@@ -1489,7 +2062,7 @@ class Battery(ABC):
         """
         if idx >= min(len(self.cells), self.cell_count):
             return None
-        return self.cells[idx].voltage
+        return self.cells.get_voltage(idx)
 
     def get_cell_voltage_sum(self) -> float:
         """
@@ -1497,6 +2070,9 @@ class Battery(ABC):
 
         :return: The sum of all cell voltages
         """
+        if self.metrics is not None:
+            return self.metrics.cell_voltage_sum
+
         voltage_sum = 0
         for i in range(self.cell_count):
             voltage = self.get_cell_voltage(i)
@@ -1513,7 +2089,7 @@ class Battery(ABC):
         """
         if idx >= min(len(self.cells), self.cell_count):
             return None
-        if self.cells[idx].balance is not None and self.cells[idx].balance:
+        if self.cells.get_balance(idx):
             return 1
         return 0
 
@@ -1530,14 +2106,15 @@ class Battery(ABC):
             return self.capacity * self.soc_calc / 100
         return None
 
-    def get_timeToSoc(self, soc_target: float, percent_per_second: float, only_number: bool = False) -> str:
+    def get_timeToSoc(self, soc_target: float, percent_per_second: float, only_number: bool = False, load_profile: LoadProfile = None) -> str:
         """
         Calculate the time to reach a specific SoC target.
 
         :param soc_target: The target SoC
         :param percent_per_second: The percentage per second
         :param only_number: Whether to return only the seconds
-        :return: The time to reach the target SoC
+        :param load_profile: The learned load profile, if set and ready it's used instead of `percent_per_second`
+        :return: The time to reach the target SoC, None if it's not reached
         """
         if self.get_current() is None or soc_target is None or percent_per_second is None:
             return None
@@ -1557,7 +2134,14 @@ class Battery(ABC):
 
         time_to_go_str = None
         if self.soc_calc != soc_target and percent_per_second != 0 and (soc_diff > 0 or utils.TIME_TO_SOC_INC_FROM is True):
-            seconds_to_go = int(soc_diff / percent_per_second)
+            seconds_to_go = None
+            if load_profile is not None:
+                seconds_to_go = load_profile.get_seconds_to_charge((soc_target - self.soc_calc) / 100 * self.capacity, self.current_avg, wall_time())
+                # the target is not reached within the next week
+                if seconds_to_go == math.inf:
+                    return None
+
+            seconds_to_go = int(soc_diff / percent_per_second) if seconds_to_go is None else int(seconds_to_go)
             time_to_go_str = ""
 
             if only_number or utils.TIME_TO_SOC_VALUE_TYPE & 1:
@@ -1610,6 +2194,9 @@ class Battery(ABC):
 
         :return: The voltage of the cell with the lowest voltage
         """
+        if self.metrics is not None:
+            return self.metrics.min_cell_voltage
+
         min_voltage = None
         if hasattr(self, "cell_min_voltage"):
             min_voltage = self.cell_min_voltage
@@ -1622,6 +2209,9 @@ class Battery(ABC):
         return min_voltage
 
     def get_max_cell_voltage(self) -> Union[float, None]:
+        if self.metrics is not None:
+            return self.metrics.max_cell_voltage
+
         max_voltage = None
         if hasattr(self, "cell_max_voltage"):
             max_voltage = self.cell_max_voltage
@@ -1640,6 +2230,9 @@ class Battery(ABC):
         of the cells and adding 1/2 of the "middle cell" voltage (if it exists)
         :return: a tuple of the voltage in the middle, as well as a percentage deviation (total_voltage / 2)
         """
+        if self.metrics is not None:
+            return self.metrics.midvoltage
+
         if not utils.MIDPOINT_ENABLE or self.cell_count is None or self.cell_count == 0 or self.cell_count < 4 or len(self.cells) != self.cell_count:
             return None, None
 
@@ -1666,12 +2259,18 @@ class Battery(ABC):
             return None, None
 
     def get_balancing(self) -> int:
+        if self.metrics is not None:
+            return self.metrics.balancing
+
         for c in range(min(len(self.cells), self.cell_count)):
             if self.cells[c].balance is not None and self.cells[c].balance:
                 return 1
         return 0
 
     def get_temp(self) -> Union[float, None]:
+        if self.metrics is not None:
+            return self.metrics.temp
+
         try:
             if utils.TEMP_BATTERY == 1:
                 return self.temp1
@@ -1696,6 +2295,9 @@ class Battery(ABC):
             return None
 
     def get_min_temp(self) -> Union[float, None]:
+        if self.metrics is not None:
+            return self.metrics.min_temp
+
         try:
             temps = [t for t in [self.temp1, self.temp2, self.temp3, self.temp4] if t is not None]
             if not temps:
@@ -1705,6 +2307,9 @@ class Battery(ABC):
             return None
 
     def get_min_temp_id(self) -> Union[str, None]:
+        if self.metrics is not None:
+            return self.metrics.min_temp_id
+
         try:
             temps = [(t, i) for i, t in enumerate([self.temp1, self.temp2, self.temp3, self.temp4]) if t is not None]
             if not temps:
@@ -1722,6 +2327,9 @@ class Battery(ABC):
             return None
 
     def get_max_temp(self) -> Union[float, None]:
+        if self.metrics is not None:
+            return self.metrics.max_temp
+
         try:
             temps = [t for t in [self.temp1, self.temp2, self.temp3, self.temp4] if t is not None]
             if not temps:
@@ -1731,6 +2339,9 @@ class Battery(ABC):
             return None
 
     def get_max_temp_id(self) -> Union[str, None]:
+        if self.metrics is not None:
+            return self.metrics.max_temp_id
+
         try:
             temps = [(t, i) for i, t in enumerate([self.temp1, self.temp2, self.temp3, self.temp4]) if t is not None]
             if not temps:
@@ -1789,10 +2400,9 @@ class Battery(ABC):
         """
         # TODO: sometimes it happens that the external sensor disconnects, the system switches to native sensor
         # ans after switching back to the external sensor, the system does not update the current values anymore
-        import dbus
-        import os
         from dbus.mainloop.glib import DBusGMainLoop
         from vedbus import VeDbusItemImport
+        from utils_dbus import get_bus, has_service
 
         logger.info("Monitoring external current using: " + f"{utils.EXTERNAL_CURRENT_SENSOR_DBUS_DEVICE}{utils.EXTERNAL_CURRENT_SENSOR_DBUS_PATH}")
 
@@ -1800,14 +2410,14 @@ class Battery(ABC):
         try:
             DBusGMainLoop(set_as_default=True)
 
-            # connect to the sessionbus, on a CC GX the systembus is used
-            dbus_connection = dbus.SessionBus() if "DBUS_SESSION_BUS_ADDRESS" in os.environ else dbus.SystemBus()
+            # use the dbus connection shared by the whole driver
+            dbus_connection = get_bus()
 
             # dictionary containing the different items
             dbus_objects = {}
 
             # check if the dbus service is available
-            is_present_in_vebus = utils.EXTERNAL_CURRENT_SENSOR_DBUS_DEVICE in dbus_connection.list_names()
+            is_present_in_vebus = has_service(utils.EXTERNAL_CURRENT_SENSOR_DBUS_DEVICE)
 
             if is_present_in_vebus:
                 dbus_objects["Current"] = VeDbusItemImport(
@@ -1851,31 +2461,26 @@ class Battery(ABC):
 
         :param error_code: The error code to display
         """
-        self.error_timestamps.append(int(time()))
-
-        # only keep last 180 errors
-        if len(self.error_timestamps) > 180:
-            # remove first element
-            self.error_timestamps.pop(0)
+        self.error_counter.add()
 
         # check if
-        #     there are more or equal to 180 errors
-        #     the first error in the list is within the last 3 hours
+        #     there are more or equal to 180 errors within the last 3 hours
         #     the error code is different from the current error
-        if len(self.error_timestamps) >= 180 and int(time()) - self.error_timestamps[0] <= (60 * 60 * 3) and self.error_code != error_code:
+        if self.error_counter.is_limit_reached() and self.error_code != error_code:
             # set error code
             self.error_code = error_code
+            self.error_code_counted = error_code
 
     def manage_error_code_reset(self) -> None:
         """
         This method is used to reset the error code.
         """
         # check if
-        #     there are more or equal to 180 errors
-        #     the first error in the list is not within the last 3 hours
-        #     the error code is not already None
-        if len(self.error_timestamps) >= 180 and int(time()) - self.error_timestamps[0] > (60 * 60 * 3) and self.error_code is not None:
+        #     the error code was set by manage_error_code(), other error codes like invalid settings are kept
+        #     there are less than 180 errors within the last 3 hours, so the window of the errors expired
+        if self.error_code is not None and self.error_code == self.error_code_counted and not self.error_counter.is_limit_reached():
             self.error_code = None
+            self.error_code_counted = None
 
     def log_cell_data(self) -> bool:
         if logger.getEffectiveLevel() > logging.INFO and len(self.cells) == 0:
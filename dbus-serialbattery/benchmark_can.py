@@ -0,0 +1,155 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Replay a recorded CAN log (candump, ASC, BLF) against the CAN BMS drivers without CAN hardware
+and measure how long `refresh_data()` takes.
+
+The frames are fed into the message cache as fast as possible, while `refresh_data()` is called
+once per poll interval of recorded time, like the driver would do on a live bus.
+
+Usage:
+    python benchmark_can.py <log file> [Daly_Can|Jkbms_Can] [address]
+
+Example:
+    python benchmark_can.py /data/candump-2024-01-01_120000.log Jkbms_Can
+"""
+import os
+import sys
+from time import perf_counter
+
+# add ext folder to sys.path
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), "ext"))
+
+from utils import logger  # noqa: E402
+from utils_can import CanReceiverThread  # noqa: E402
+from bms.daly_can import Daly_Can  # noqa: E402
+from bms.jkbms_can import Jkbms_Can  # noqa: E402
+
+
+supported_bms_types = {
+    "Daly_Can": Daly_Can,
+    "Jkbms_Can": Jkbms_Can,
+}
+
+
+def percentile(values: list, percent: float) -> float:
+    """
+    Return the percentile of a list of values using the nearest-rank method.
+
+    :param values: The values
+    :param percent: The percentile to return, e.g. 95
+    :return: The percentile
+    """
+    if len(values) == 0:
+        return 0
+    values_sorted = sorted(values)
+    index = max(0, min(len(values_sorted) - 1, int(round(percent / 100 * len(values_sorted) + 0.5)) - 1))
+    return values_sorted[index]
+
+
+def benchmark(replay_file: str, bms_type: str, address: bytes = None) -> bool:
+    """
+    Run the benchmark for one BMS type.
+
+    :param replay_file: Path to the log file
+    :param bms_type: The name of the BMS class
+    :param address: The device address of the BMS (optional)
+    :return: True if the BMS was recognized in the log, else False
+    """
+    # the thread is not started, the frames are fed synchronously to get reproducible results
+    can_thread = CanReceiverThread("replay", "benchmark_" + bms_type, replay_file=replay_file, replay_speed=0)
+
+    battery = supported_bms_types[bms_type](port="replay", baud=None, address=address)
+    battery.set_message_cache_callback(can_thread.get_message_cache)
+    # same as in dbus-serialbattery.py, the listener is part of the decode work per frame
+    can_thread.add_listener(battery.can_frame_received)
+
+    connected = False
+    connection_retries = 0
+    message_count = 0
+    refresh_durations = []
+    refresh_failed = 0
+    next_refresh = None
+
+    time_start = perf_counter()
+
+    for message in CanReceiverThread.replay_messages(replay_file, 0):
+        # the recorded time, so the listeners integrate the current like in real time
+        can_thread.cache_message(message, message.timestamp)
+        message_count += 1
+
+        if next_refresh is None:
+            # same as in dbus-serialbattery.py, wait a bit to have all needed data in the cache
+            next_refresh = message.timestamp + 2
+            continue
+
+        if message.timestamp < next_refresh:
+            continue
+
+        next_refresh = message.timestamp + battery.poll_interval / 1000
+
+        if not connected:
+            connected = battery.test_connection() and battery.validate_data()
+            if not connected:
+                # same as in dbus-serialbattery.py, give up after 3 rounds
+                connection_retries += 1
+                if connection_retries >= 3:
+                    break
+                continue
+
+        refresh_start = perf_counter()
+        result = battery.refresh_data()
+        refresh_durations.append(perf_counter() - refresh_start)
+
+        if not result:
+            refresh_failed += 1
+
+    time_total = perf_counter() - time_start
+
+    print(f"{bms_type}:")
+    print(f"  Frames replayed:    {message_count} in {time_total:.3f} s ({message_count / time_total if time_total > 0 else 0:.0f} frames/s)")
+
+    if not connected:
+        print("  BMS not recognized in the log")
+        return False
+
+    print(f"  Cells:              {battery.cell_count}")
+    print(f"  refresh_data calls: {len(refresh_durations)} ({refresh_failed} failed)")
+    print(
+        f"  refresh_data time:  mean {sum(refresh_durations) / len(refresh_durations) * 1000:.3f} ms, "
+        f"p95 {percentile(refresh_durations, 95) * 1000:.3f} ms, "
+        f"max {max(refresh_durations) * 1000:.3f} ms"
+        if len(refresh_durations) > 0
+        else "  refresh_data time:  -"
+    )
+
+    return True
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    replay_file = sys.argv[1]
+
+    if len(sys.argv) > 2:
+        if sys.argv[2] not in supported_bms_types:
+            logger.error(f"Unsupported BMS type {sys.argv[2]}, use one of: {', '.join(supported_bms_types)}")
+            sys.exit(1)
+        bms_types = [sys.argv[2]]
+    else:
+        bms_types = list(supported_bms_types)
+
+    # convert hex string to bytes
+    address = bytes.fromhex(sys.argv[3].replace("0x", "")) if len(sys.argv) > 3 else None
+
+    found = False
+    for bms_type in bms_types:
+        found = benchmark(replay_file, bms_type, address) or found
+
+    sys.exit(0 if found else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,7 @@
 # in the documentation for a checklist what you have to do, when adding a new BMS
 
 # avoid importing wildcards, remove unused imports
-from battery import Battery, Cell
+from battery import Battery, Cell, PollTier, poll_tier
 from utils import read_serial_data, logger
 from struct import unpack_from
 import sys
@@ -128,10 +128,10 @@ class BatteryTemplate(Battery):
         This will be called for every iteration (1 second)
         Return True if success, False for failure
         """
-        result = self.read_status_data()
-
-        # only read next dafa if the first one was successful
-        result = result and self.read_cell_data()
+        # only read next data if the previous one was successful
+        # read functions decorated with @poll_tier() are only called when they are due,
+        # so slow changing data does not use the bus on every poll
+        result = self.run_due_reads([self.read_status_data, self.read_cell_data])
 
         # this is only an example, you can combine all into one function
         # or split it up into more functions, whatever fits best for your BMS
@@ -307,6 +307,7 @@ class BatteryTemplate(Battery):
         logger.info(self.hardware_version)
         return True
 
+    @poll_tier(PollTier.MEDIUM)
     def read_cell_data(self):
         # read the cell data
         cell_data = self.read_serial_data_template(self.command_cells)
@@ -333,11 +334,11 @@ class BatteryTemplate(Battery):
         # set balance status, if only a common balance status is available (bool)
         # not needed, if balance status is available for each cell
         self.balancing: bool = VALUE_FROM_BMS
-        if self.get_min_cell() is not None and self.get_max_cell() is not None:
+        min_cell = self.get_min_cell()
+        max_cell = self.get_max_cell()
+        if min_cell is not None and max_cell is not None:
             for c in range(self.cell_count):
-                if self.balancing and (
-                    self.get_min_cell() == c or self.get_max_cell() == c
-                ):
+                if self.balancing and (min_cell == c or max_cell == c):
                     self.cells[c].balance = True
                 else:
                     self.cells[c].balance = False
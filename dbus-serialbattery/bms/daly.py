@@ -3,7 +3,7 @@
 # Notes
 # Updated by https://github.com/transistorgit
 
-from battery import Battery, Cell
+from battery import Battery, Cell, PollTier, poll_tier
 from utils import (
     bytearray_to_string,
     open_serial_port,
@@ -117,44 +117,23 @@ class Daly(Battery):
         # Open serial port to be used for all data reads instead of opening multiple times
         try:
             with open_serial_port(self.port, self.baud_rate) as ser:
-                result = self.read_soc_data(ser)
-                self.reset_soc = self.soc if self.soc else 0
-                if self.runtime > 0.200:  # TROUBLESHOOTING for no reply errors
-                    logger.debug("  |- refresh_data: read_soc_data - result: " + str(result) + " - runtime: " + str(f"{self.runtime:.1f}") + "s")
-
                 # result placed last to ensure all data is read anyway
-                result = self.read_fed_data(ser) and result
-                if self.runtime > 0.200:  # TROUBLESHOOTING for no reply errors
-                    logger.debug("  |- refresh_data: read_fed_data - result: " + str(result) + " - runtime: " + str(f"{self.runtime:.1f}") + "s")
-
-                # result placed last to ensure all data is read anyway
-                result = self.read_cell_voltage_range_data(ser) and result
-                if self.runtime > 0.200:  # TROUBLESHOOTING for no reply errors
-                    logger.debug("  |- refresh_data: read_cell_voltage_range_data - result: " + str(result) + " - runtime: " + str(f"{self.runtime:.1f}") + "s")
+                result = self.run_due_reads([self.read_soc_data, self.read_fed_data, self.read_cell_voltage_range_data], ser, stop_on_failure=False)
+                self.reset_soc = self.soc if self.soc else 0
 
                 self.write_soc_and_datetime(ser)
                 if self.runtime > 0.200:  # TROUBLESHOOTING for no reply errors
                     logger.debug("  |- refresh_data: write_soc_and_datetime - result: " + str(result) + " - runtime: " + str(f"{self.runtime:.1f}") + "s")
 
                 # result placed last to ensure all data is read anyway
-                result = self.read_alarm_data(ser) and result
-                if self.runtime > 0.200:  # TROUBLESHOOTING for no reply errors
-                    logger.debug("  |- refresh_data: read_alarm_data - result: " + str(result) + " - runtime: " + str(f"{self.runtime:.1f}") + "s")
-
-                # result placed last to ensure all data is read anyway
-                result = self.read_temperature_range_data(ser) and result
-                if self.runtime > 0.200:  # TROUBLESHOOTING for no reply errors
-                    logger.debug("  |- refresh_data: read_temperature_range_data - result: " + str(result) + " - runtime: " + str(f"{self.runtime:.1f}") + "s")
-
-                # result placed last to ensure all data is read anyway
-                result = self.read_balance_state(ser) and result
-                if self.runtime > 0.200:  # TROUBLESHOOTING for no reply errors
-                    logger.debug("  |- refresh_data: read_balance_state - result: " + str(result) + " - runtime: " + str(f"{self.runtime:.1f}") + "s")
-
-                # result placed last to ensure all data is read anyway
-                result = self.read_cells_volts(ser) and result
-                if self.runtime > 0.200:  # TROUBLESHOOTING for no reply errors
-                    logger.debug("  |- refresh_data: read_cells_volts - result: " + str(result) + " - runtime: " + str(f"{self.runtime:.1f}") + "s")
+                result = (
+                    self.run_due_reads(
+                        [self.read_alarm_data, self.read_temperature_range_data, self.read_balance_state, self.read_cells_volts],
+                        ser,
+                        stop_on_failure=False,
+                    )
+                    and result
+                )
 
                 self.write_charge_discharge_mos(ser)
 
@@ -207,6 +186,7 @@ class Daly(Battery):
 
         return False
 
+    @poll_tier(PollTier.FAST)
     def read_soc_data(self, ser):
 
         result = True
@@ -254,6 +234,7 @@ class Daly(Battery):
 
         return False
 
+    @poll_tier(PollTier.SLOW)
     def read_alarm_data(self, ser):
         alarm_data = self.request_data(ser, self.command_alarm)
         # check if connection success
@@ -364,6 +345,7 @@ class Daly(Battery):
 
         return True
 
+    @poll_tier(PollTier.MEDIUM)
     def read_cells_volts(self, ser):
         if self.cell_count is None:
             return True
@@ -419,6 +401,7 @@ class Daly(Battery):
                 self.cells[cellnum].voltage = None if cellVoltage < lowMin else cellVoltage
         return True
 
+    @poll_tier(PollTier.MEDIUM)
     def read_cell_voltage_range_data(self, ser):
         minmax_data = self.request_data(ser, self.command_minmax_cell_volts)
         # check if connection success
@@ -440,6 +423,7 @@ class Daly(Battery):
         self.cell_min_voltage = cell_min_voltage / 1000
         return True
 
+    @poll_tier(PollTier.MEDIUM)
     def read_balance_state(self, ser):
         balance_data = self.request_data(ser, self.command_cell_balance)
         # check if connection success
@@ -456,6 +440,7 @@ class Daly(Battery):
 
         return True
 
+    @poll_tier(PollTier.MEDIUM)
     def read_temperature_range_data(self, ser):
         minmax_data = self.request_data(ser, self.command_minmax_temp)
         # check if connection success
@@ -468,6 +453,7 @@ class Daly(Battery):
         self.temp2 = max_temp - self.TEMP_ZERO_CONSTANT
         return True
 
+    @poll_tier(PollTier.FAST)
     def read_fed_data(self, ser):
         fed_data = self.request_data(ser, self.command_fet)
         # check if connection success
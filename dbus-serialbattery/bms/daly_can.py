@@ -154,6 +154,14 @@ class Daly_Can(Battery):
 
         return True
 
+    def can_frame_received(self, arbitration_id: int, data: bytearray, timestamp: float) -> None:
+        # add the current of every SOC frame to the coulomb counter, not only the last one of each poll
+        if arbitration_id + self.device_address in self.CAN_FRAMES[self.COMMAND_SOC]:
+            self.current_samples_from_frames = True
+            current = (unpack_from(">H", data, 4)[0] - self.CURRENT_ZERO_CONSTANT) / -10 * INVERT_CURRENT_MEASUREMENT
+            if -(MAX_BATTERY_DISCHARGE_CURRENT * 2.1) < current < MAX_BATTERY_CHARGE_CURRENT * 1.3:
+                self.add_current_sample(current, timestamp)
+
     def read_daly_can(self):
         # reset errors after timeout
         if ((time() - self.last_error_time) > 120.0) and self.error_active is True:
@@ -4,7 +4,7 @@
 # Added by https://github.com/versager
 # https://github.com/mr-manuel/venus-os_dbus-serialbattery/pull/116
 
-from battery import Battery, Cell, Protection
+from battery import Battery, Cell, PollTier, Protection, poll_tier
 from utils import read_serial_data, unpack_from, logger
 import utils
 from struct import unpack
@@ -81,9 +81,7 @@ class Felicity(Battery):
         # call all functions that will refresh the battery data.
         # This will be called for every iteration (1 second)
         # Return True if success, False for failure
-        result = self.read_soc_data()
-        result = result and self.read_cell_data()
-        result = result and self.read_temp_data()
+        result = self.run_due_reads([self.read_soc_data, self.read_cell_data, self.read_temp_data])
 
         return result
 
@@ -205,6 +203,7 @@ class Felicity(Battery):
 
         return True
 
+    @poll_tier(PollTier.MEDIUM)
     def read_cell_data(self):
         cell_volt_data = self.read_serial_data_felicity(self.command_cell_voltages)
         if len(cell_volt_data) != 32:
@@ -219,6 +218,7 @@ class Felicity(Battery):
                     self.cells[c].voltage = 0
         return True
 
+    @poll_tier(PollTier.MEDIUM)
     def read_temp_data(self):
         tempBms_data = self.read_serial_data_felicity(self.command_bms_temp1)
 
@@ -215,9 +215,11 @@ class Jkbms(Battery):
         )
 
         # show wich cells are balancing
-        if self.get_min_cell() is not None and self.get_max_cell() is not None:
+        min_cell = self.get_min_cell()
+        max_cell = self.get_max_cell()
+        if min_cell is not None and max_cell is not None:
             for c in range(self.cell_count):
-                if self.balancing and (self.get_min_cell() == c or self.get_max_cell() == c):
+                if self.balancing and (min_cell == c or max_cell == c):
                     self.cells[c].balance = True
                 else:
                     self.cells[c].balance = False
@@ -244,24 +246,6 @@ class Jkbms(Battery):
     def get_balancing(self):
         return 1 if self.balancing else 0
 
-    def get_min_cell(self):
-        min_voltage = 9999
-        min_cell = None
-        for c in range(min(len(self.cells), self.cell_count)):
-            if self.cells[c].voltage is not None and min_voltage > self.cells[c].voltage:
-                min_voltage = self.cells[c].voltage
-                min_cell = c
-        return min_cell
-
-    def get_max_cell(self):
-        max_voltage = 0
-        max_cell = None
-        for c in range(min(len(self.cells), self.cell_count)):
-            if self.cells[c].voltage is not None and max_voltage < self.cells[c].voltage:
-                max_voltage = self.cells[c].voltage
-                max_cell = c
-        return max_cell
-
     def to_protection_bits(self, byte_data):
         """
         Bit 0: Low capacity alarm: 1 warning only, 0 nomal -> OK
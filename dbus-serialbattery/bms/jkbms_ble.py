@@ -10,7 +10,6 @@ from typing import Callable
 from utils import logger, AUTO_RESET_SOC
 from time import sleep, time
 from bms.jkbms_brn import Jkbms_Brn
-import os
 import sys
 
 # from bleak import BleakScanner, BleakError
@@ -19,13 +18,14 @@ import sys
 
 class Jkbms_Ble(Battery):
     BATTERYTYPE = "JKBMS BLE"
-    resetting = False
+    reconnecting = False
 
     def __init__(self, port, baud, address):
         super(Jkbms_Ble, self).__init__(port, baud, address)
         self.address = address
         self.type = self.BATTERYTYPE
-        self.jk = Jkbms_Brn(address, lambda: self.reset_bluetooth())
+        self.jk = Jkbms_Brn(address)
+        self.jk.set_current_sample_callback(self.current_sample_received)
         self.unique_identifier_tmp = ""
 
         logger.info("Init of Jkbms_Ble at " + address)
@@ -136,6 +136,11 @@ class Jkbms_Ble(Battery):
         self.jk.set_callback(callback)
         return callback is not None
 
+    def current_sample_received(self, current: float, timestamp: float) -> None:
+        # add the current of every cell info frame to the coulomb counter, not only the last one of each poll
+        self.current_samples_from_frames = True
+        self.add_current_sample(current, timestamp)
+
     def refresh_data(self):
         # call all functions that will refresh the battery data.
         # This will be called for every iteration (1 second)
@@ -148,25 +153,23 @@ class Jkbms_Ble(Battery):
             return False
 
         last_update = int(time() - st["last_update"])
-        if last_update >= 15 and last_update % 15 == 0:
-            logger.info(f"Jkbms_Ble: Bluetooth connection interrupted. Got no fresh data since {last_update}s.")
-            # show Bluetooth signal strength (RSSI)
-            bluetoothctl_info = os.popen("bluetoothctl info " + self.address + ' | grep -i -E "device|name|alias|pair|trusted|blocked|connected|rssi|power"')
-            logger.info(bluetoothctl_info.read())
-            bluetoothctl_info.close()
-
-            # if the thread is still alive but data too old there is something
-            # wrong with the bt-connection; restart whole stack
-            if not self.resetting and last_update >= 60:
-                logger.error("Jkbms_Ble: Bluetooth died. Restarting Bluetooth system driver.")
-                self.reset_bluetooth()
-                sleep(2)
-                self.jk.start_scraping()
-                sleep(2)
+        if last_update >= 15:
+            if last_update % 15 == 0:
+                logger.info(f"Jkbms_Ble: Bluetooth connection interrupted. Got no fresh data since {last_update}s.")
+                # show the link state reported by BlueZ, like the Bluetooth signal strength (RSSI)
+                logger.info(f"Jkbms_Ble: Link state: {self.get_link_metrics()}")
+
+            # if the connection is still alive but data too old there is something
+            # wrong with the bt-connection; reconnect, the BLE hub escalates to an adapter reset if needed
+            if not self.reconnecting and last_update >= 60:
+                logger.error("Jkbms_Ble: Bluetooth died. Reconnecting.")
+                self.reconnecting = True
+                if self.jk.connection is not None:
+                    self.jk.connection.reconnect()
 
             return False
         else:
-            self.resetting = False
+            self.reconnecting = False
 
         # update cell voltages
         for c in range(self.cell_count):
@@ -228,30 +231,19 @@ class Jkbms_Ble(Battery):
         self.protection.high_temperature = 2 if st["warnings"]["discharge_overtemp"] else 0
         return True
 
-    def reset_bluetooth(self):
-        logger.info("Reset of system Bluetooth daemon triggered")
-        self.resetting = True
-        if self.jk.is_running():
-            if self.jk.stop_scraping():
-                logger.info("Scraping stopped, issuing sys-commands")
-            else:
-                logger.warning("Scraping was unable to stop, issuing sys-commands")
-
-        # process kill is needed, since the service/bluetooth driver is probably freezed
-        os.system('pkill -f "bluetoothd"')
-        # stop will not work, if service/bluetooth driver is stuck
-        # os.system("/etc/init.d/bluetooth stop")
-        sleep(2)
-        os.system("rfkill block bluetooth")
-        os.system("rfkill unblock bluetooth")
-        os.system("/etc/init.d/bluetooth start")
-        logger.info("System Bluetooth daemon should have been restarted")
-
     def get_balancing(self):
         return 1 if self.balancing else 0
 
+    def disconnect(self):
+        self.jk.stop_scraping()
+
+    def get_link_metrics(self) -> dict:
+        if self.jk.connection is None:
+            return {}
+        return self.jk.connection.link_metrics()
+
     def trigger_soc_reset(self):
         if AUTO_RESET_SOC:
             self.jk.max_cell_voltage = self.get_max_cell_voltage()
-            self.jk.trigger_soc_reset = True
+            self.jk.request_soc_reset()
         return
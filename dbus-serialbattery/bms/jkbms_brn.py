@@ -9,14 +9,12 @@ from struct import unpack_from, calcsize
 from bleak import BleakScanner, BleakClient, exc
 from time import sleep, time
 import asyncio
-import threading
+import logging
 import sys
 
 # if used as standalone script then use custom logger
 # else import logger from utils
 if __name__ == "__main__":
-    import logging
-
     logger = logging.basicConfig(level=logging.DEBUG)
 
     def bytearray_to_string(data):
@@ -25,6 +23,9 @@ if __name__ == "__main__":
 else:
     from utils import bytearray_to_string, logger
 
+from utils_ble import BleHub  # noqa: E402
+from utils_clock import monotonic  # noqa: E402
+
 # zero means parse all incoming data (every second)
 CELL_INFO_REFRESH_S = 0
 CHAR_HANDLE = "0000ffe1-0000-1000-8000-00805f9b34fb"
@@ -127,34 +128,38 @@ class Jkbms_Brn:
     # entries for translating the bytearray to py-object via unpack
     # [[py dict entry as list, each entry ] ]
 
-    frame_buffer = bytearray()
-    bms_status = {}
-
-    waiting_for_response = ""
-    last_cell_info = 0
-
     _new_data_callback = None
+    _current_sample_callback = None
 
-    # Variables to control automatic SOC reset for BLE connected JK BMS
-    # max_cell_voltage will be updated when a SOC reset is requested
-    max_cell_voltage = None
-    # OVP and OVPR will be persisted after the first successful readout of the BMS settings
-    ovp_initial_voltage = None
-    ovpr_initial_voltage = None
+    def __init__(self, addr):
+        self.address = addr
 
-    # will be set by get_bms_max_cell_count()
-    bms_max_cell_count = None
+        # preallocated frame buffer, notifications are copied in place at frame_buffer_index
+        self.frame_buffer = bytearray(MAX_RESPONSE_SIZE)
+        self.frame_buffer_view = memoryview(self.frame_buffer)
+        self.frame_buffer_index = 0
+        self.bms_status = {}
+
+        self.waiting_for_response = ""
+        self.last_cell_info = 0
+
+        # Variables to control automatic SOC reset for BLE connected JK BMS
+        # max_cell_voltage will be updated when a SOC reset is requested
+        self.max_cell_voltage = None
+        # OVP and OVPR will be persisted after the first successful readout of the BMS settings
+        self.ovp_initial_voltage = None
+        self.ovpr_initial_voltage = None
+        self.trigger_soc_reset = False
 
-    # translate info placeholder, since it depends on the bms_max_cell_count
-    translate_cell_info = []
+        # will be set by get_bms_max_cell_count()
+        self.bms_max_cell_count = None
 
-    def __init__(self, addr, reset_bt_callback=None):
-        self.address = addr
-        self.bt_thread = None
-        self.bt_thread_monitor = threading.Thread(target=self.monitor_scraping, name="Thread-JKBMS-Monitor")
-        self.bt_reset = reset_bt_callback
-        self.should_be_scraping = False
-        self.trigger_soc_reset = False
+        # translate info placeholder, since it depends on the bms_max_cell_count
+        self.translate_cell_info = []
+
+        # the connection is handled by the shared BLE hub
+        self.hub = BleHub.get_instance()
+        self.connection = None
 
     async def scanForDevices(self):
         devices = await BleakScanner.discover()
@@ -165,7 +170,6 @@ class Jkbms_Brn:
     # if the bms is a 24s or 32s type
     def get_bms_max_cell_count(self):
         fb = self.frame_buffer
-        logger.debug(self.frame_buffer)
 
         # old check to recognize 32s
         # what does this check validate?
@@ -174,23 +178,33 @@ class Jkbms_Brn:
 
         # logger can be removed after releasing next stable
         # current version v1.0.20231102dev
-        logger.debug(f"fb[38]: {fb[36]}.{fb[37]}.{fb[38]}.{fb[39]}.{fb[40]}")
-        logger.debug(f"fb[54]: {fb[52]}.{fb[53]}.{fb[54]}.{fb[55]}.{fb[56]}")
-        logger.debug(f"fb[70]: {fb[68]}.{fb[69]}.{fb[70]}.{fb[71]}.{fb[72]}")
-        logger.debug(f"fb[134]: {fb[132]}.{fb[133]}.{fb[134]}.{fb[135]}.{fb[136]}")
-        logger.debug(f"fb[144]: {fb[142]}.{fb[143]}.{fb[144]}.{fb[145]}.{fb[146]}")
-        logger.debug(f"fb[289]: {fb[287]}.{fb[288]}.{fb[289]}.{fb[290]}.{fb[291]}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(bytearray_to_string(self.frame_buffer_view[: self.frame_buffer_index]))
+            logger.debug(f"fb[38]: {fb[36]}.{fb[37]}.{fb[38]}.{fb[39]}.{fb[40]}")
+            logger.debug(f"fb[54]: {fb[52]}.{fb[53]}.{fb[54]}.{fb[55]}.{fb[56]}")
+            logger.debug(f"fb[70]: {fb[68]}.{fb[69]}.{fb[70]}.{fb[71]}.{fb[72]}")
+            logger.debug(f"fb[134]: {fb[132]}.{fb[133]}.{fb[134]}.{fb[135]}.{fb[136]}")
+            logger.debug(f"fb[144]: {fb[142]}.{fb[143]}.{fb[144]}.{fb[145]}.{fb[146]}")
+            logger.debug(f"fb[289]: {fb[287]}.{fb[288]}.{fb[289]}.{fb[290]}.{fb[291]}")
 
         # if BMS has a max of 32s the data at fb[287] is not empty
-        if fb[287] > 0:
-            self.bms_max_cell_count = 32
-            self.translate_cell_info = TRANSLATE_CELL_INFO_32S
         # if BMS has a max of 24s the data ends at fb[219]
-        else:
-            self.bms_max_cell_count = 24
-            self.translate_cell_info = TRANSLATE_CELL_INFO_24S
+        bms_max_cell_count = 32 if fb[287] > 0 else 24
+
+        if bms_max_cell_count != self.bms_max_cell_count:
+            self.bms_max_cell_count = bms_max_cell_count
+            # copy the translation table, since the cell count is adapted per BMS
+            self.translate_cell_info = [[list(t[0])] + t[1:] for t in (TRANSLATE_CELL_INFO_32S if bms_max_cell_count == 32 else TRANSLATE_CELL_INFO_24S)]
+            if "settings" in self.bms_status:
+                self.adapt_translate_cell_info(self.bms_status["settings"]["cell_count"])
 
-        logger.debug(f"bms_max_cell_count recognized: {self.bms_max_cell_count}")
+            logger.debug(f"bms_max_cell_count recognized: {self.bms_max_cell_count}")
+
+    # adapt translation table for cell array lengths
+    def adapt_translate_cell_info(self, ccount: int):
+        for i, t in enumerate(self.translate_cell_info):
+            if t[0][-2] == "voltages":
+                self.translate_cell_info[i][0][-1] = ccount
 
     # iterative implementation maybe later due to referencing
     def translate(self, fb, translation, o, f32s=False, i=0):
@@ -208,10 +222,10 @@ class Jkbms_Brn:
                 if isinstance(translation[2], int):
                     # handle raw bytes without unpack_from;
                     # 3. param gives no format but number of bytes
-                    val = bytearray(fb[translation[1] + i + offset : translation[1] + i + translation[2] + offset])
+                    val = bytes(memoryview(fb)[translation[1] + i + offset : translation[1] + i + translation[2] + offset])
                     i += translation[2]
                 else:
-                    val = unpack_from(translation[2], bytearray(fb), translation[1] + i + offset)[0]
+                    val = unpack_from(translation[2], fb, translation[1] + i + offset)[0]
                     # calculate stepping in case of array
                     i = i + calcsize(translation[2])
 
@@ -234,7 +248,7 @@ class Jkbms_Brn:
             self.translate(fb, translation, o[translation[0][i]], f32s=f32s, i=i + 1)
 
     def decode_warnings(self, fb):
-        val = unpack_from("<H", bytearray(fb), 136)[0]
+        val = unpack_from("<H", fb, 136)[0]
 
         self.bms_status["cell_info"]["error_bitmask_16"] = hex(val)
         self.bms_status["cell_info"]["error_bitmask_2"] = format(val, "016b")
@@ -264,9 +278,10 @@ class Jkbms_Brn:
         for t in self.translate_cell_info:
             self.translate(fb, t, self.bms_status, f32s=has32s)
         self.decode_warnings(fb)
-        logger.debug("decode_cellinfo_jk02(): self.frame_buffer")
-        logger.debug(self.frame_buffer)
-        logger.debug(self.bms_status)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("decode_cellinfo_jk02(): self.frame_buffer")
+            logger.debug(bytearray_to_string(self.frame_buffer_view[: self.frame_buffer_index]))
+            logger.debug(self.bms_status)
 
     def decode_settings_jk02(self):
         fb = self.frame_buffer
@@ -282,11 +297,7 @@ class Jkbms_Brn:
             logger.debug("Processing frame with settings info")
             if protocol_version == PROTOCOL_VERSION_JK02:
                 self.decode_settings_jk02()
-                # adapt translation table for cell array lengths
-                ccount = self.bms_status["settings"]["cell_count"]
-                for i, t in enumerate(self.translate_cell_info):
-                    if t[0][-2] == "voltages" or t[0][-2] == "voltages":
-                        self.translate_cell_info[i][0][-1] = ccount
+                self.adapt_translate_cell_info(self.bms_status["settings"]["cell_count"])
                 self.bms_status["last_update"] = time()
 
         elif info_type == 0x02:
@@ -296,6 +307,8 @@ class Jkbms_Brn:
                 if protocol_version == PROTOCOL_VERSION_JK02:
                     self.decode_cellinfo_jk02()
                     self.bms_status["last_update"] = time()
+                    if self._current_sample_callback is not None:
+                        self._current_sample_callback(self.bms_status["cell_info"]["current"], monotonic())
                 # power is calculated from voltage x current as
                 # register 122 contains unsigned power-value
                 self.bms_status["cell_info"]["power"] = self.bms_status["cell_info"]["current"] * self.bms_status["cell_info"]["total_voltage"]
@@ -315,44 +328,59 @@ class Jkbms_Brn:
     def set_callback(self, callback):
         self._new_data_callback = callback
 
+    def set_current_sample_callback(self, callback):
+        # called with the current and the monotonic time of every decoded cell info frame
+        self._current_sample_callback = callback
+
     def assemble_frame(self, data: bytearray):
-        logger.debug(f"--> assemble_frame() -> self.frame_buffer (before extend) -> lenght:  {len(self.frame_buffer)}")
-        logger.debug(self.frame_buffer)
-        if len(self.frame_buffer) > MAX_RESPONSE_SIZE:
-            logger.debug("data dropped because it alone was longer than max frame length")
-            self.frame_buffer = []
+        data_length = len(data)
+        debug = logger.isEnabledFor(logging.DEBUG)
 
-        if data[0] == 0x55 and data[1] == 0xAA and data[2] == 0xEB and data[3] == 0x90:
+        if data_length >= 4 and data[0] == 0x55 and data[1] == 0xAA and data[2] == 0xEB and data[3] == 0x90:
             # beginning of new frame, clear buffer
-            self.frame_buffer = []
+            self.frame_buffer_index = 0
+        elif self.frame_buffer_index == 0:
+            if debug:
+                logger.debug("data dropped because no frame start was received")
+            return
+
+        if self.frame_buffer_index + data_length > MAX_RESPONSE_SIZE:
+            if debug:
+                logger.debug("data dropped because the frame got longer than max frame length")
+            self.frame_buffer_index = 0
+            return
+
+        # copy the data in place, without growing or reallocating the buffer
+        self.frame_buffer_view[self.frame_buffer_index : self.frame_buffer_index + data_length] = data
+        self.frame_buffer_index += data_length
 
-        self.frame_buffer.extend(data)
+        if debug:
+            logger.debug(f"--> assemble_frame() -> self.frame_buffer -> lenght:  {self.frame_buffer_index}")
 
-        logger.debug(f"--> assemble_frame() -> self.frame_buffer (after extend) -> lenght:  {len(self.frame_buffer)}")
-        logger.debug(self.frame_buffer)
-        if len(self.frame_buffer) >= MIN_RESPONSE_SIZE:
+        if self.frame_buffer_index >= MIN_RESPONSE_SIZE:
             # check crc; always at position 300, independent of
             # actual frame-lentgh, so crc up to 299
-            ccrc = self.crc(self.frame_buffer, 300 - 1)
+            ccrc = self.crc(self.frame_buffer_view, 300 - 1)
             rcrc = self.frame_buffer[300 - 1]
-            logger.debug(f"compair recvd. crc: {rcrc} vs calc. crc: {ccrc}")
+            if debug:
+                logger.debug(f"compair recvd. crc: {rcrc} vs calc. crc: {ccrc}")
             if ccrc == rcrc:
-                logger.debug("great success! frame complete and sane, lets decode")
+                if debug:
+                    logger.debug("great success! frame complete and sane, lets decode")
                 self.decode()
-                self.frame_buffer = []
+                self.frame_buffer_index = 0
                 if self._new_data_callback is not None:
                     self._new_data_callback()
 
     def ncallback(self, sender: int, data: bytearray):
-        logger.debug(f"--> NEW PACKAGE! lenght:  {len(data)}")
-        logger.debug("ncallback(): " + bytearray_to_string(data))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"--> NEW PACKAGE! lenght:  {len(data)}")
+            logger.debug("ncallback(): " + bytearray_to_string(data))
         self.assemble_frame(data)
 
     def crc(self, arr: bytearray, length: int) -> int:
-        crc = 0
-        for a in arr[:length]:
-            crc = crc + a
-        return crc.to_bytes(2, "little")[0]
+        # sum over a memoryview slice, so no copy of the frame is made
+        return sum(memoryview(arr)[:length]) & 0xFF
 
     async def write_register(
         self,
@@ -427,132 +455,87 @@ class Jkbms_Brn:
         else:
             return None
 
-    def connect_and_scrape(self):
-        asyncio.run(self.asy_connect_and_scrape())
-
-    # self.bt_thread
-    async def asy_connect_and_scrape(self):
-        logger.debug("--> asy_connect_and_scrape(): Connect and scrape on address: " + self.address)
-        self.run = True
-        while self.run and self.main_thread.is_alive():  # autoreconnect
-            client = BleakClient(self.address)
-            logger.debug("--> asy_connect_and_scrape(): btloop")
-
-            try:
-                logger.debug("--> asy_connect_and_scrape(): reconnect")
-                await client.connect()
-
-                # try to get MODEL_NBR_UUID, since not all JKBMS send it
-                try:
-                    self.bms_status["model_nbr"] = (await client.read_gatt_char(MODEL_NBR_UUID)).decode("utf-8")
-                except exc.BleakError:
-                    (
-                        exception_type,
-                        exception_object,
-                        exception_traceback,
-                    ) = sys.exc_info()
-                    logger.debug(f'Error getting UUID "{MODEL_NBR_UUID}": {repr(exception_object)} -> failover')
-                    self.bms_status["model_nbr"] = "JK-BMS-Unknown-Model"
-
-                # some JKBMS trow an error
-                # BleakError('Multiple Characteristics with this UUID, refer to your desired
-                #             characteristic by the `handle` attribute instead.')
-                # failover in this case and use handle instead of UUID
-                try:
-                    await client.start_notify(CHAR_HANDLE, self.ncallback)
-                except exc.BleakError:
-                    (
-                        exception_type,
-                        exception_object,
-                        exception_traceback,
-                    ) = sys.exc_info()
-                    logger.debug(f'Error getting UUID "{CHAR_HANDLE}": {repr(exception_object)} -> failover')
-                    await client.start_notify(CHAR_HANDLE_FAILOVER, self.ncallback)
-
-                await self.request_bt("device_info", client)
-
-                await self.request_bt("cell_info", client)
-                # await self.enable_charging(client)
-                # last_dev_info = time()
-                while client.is_connected and self.run and self.main_thread.is_alive():
-                    if self.trigger_soc_reset:
-                        self.trigger_soc_reset = False
-                        await self.reset_soc_jk(client)
-                    await asyncio.sleep(0.01)
-
-            except exc.BleakDeviceNotFoundError:
-                logger.info(f"--> asy_connect_and_scrape(): device not found: {self.address}")
-                self.run = False
-
-            except Exception:
-                (
-                    exception_type,
-                    exception_object,
-                    exception_traceback,
-                ) = sys.exc_info()
-                file = exception_traceback.tb_frame.f_code.co_filename
-                line = exception_traceback.tb_lineno
-                logger.info(
-                    f"--> asy_connect_and_scrape(): error while connecting to bt: {repr(exception_object)} "
-                    + f"of type {exception_type} in {file} line #{line}"
-                )
-                self.run = False
-
-            finally:
-                self.run = False
-                if client.is_connected:
-                    try:
-                        await client.disconnect()
-                    except Exception:
-                        (
-                            exception_type,
-                            exception_object,
-                            exception_traceback,
-                        ) = sys.exc_info()
-                        file = exception_traceback.tb_frame.f_code.co_filename
-                        line = exception_traceback.tb_lineno
-                        logger.info(
-                            f"--> asy_connect_and_scrape(): error while disconnecting: {repr(exception_object)} "
-                            + f"of type {exception_type} in {file} line #{line}"
-                        )
-
-        logger.info("--> asy_connect_and_scrape(): Exit")
-
-    def monitor_scraping(self):
-        while self.should_be_scraping is True:
-            self.bt_thread = threading.Thread(target=self.connect_and_scrape, name="Thread-JKBMS-Connect-and-Scrape")
-            self.bt_thread.start()
-            logger.debug("scraping thread started -> main thread id: " + str(self.main_thread.ident) + " scraping thread: " + str(self.bt_thread.ident))
-            self.bt_thread.join()
-            if self.should_be_scraping is True:
-                logger.debug("scraping thread ended: reseting bluetooth and restarting")
-                if self.bt_reset is not None:
-                    self.bt_reset()
-                sleep(2)
+    async def on_connect(self, client: BleakClient):
+        """
+        Called by the BLE hub after each (re)connect.
+        Subscribes to the notifications and requests the device and cell info.
+        """
+        logger.debug("--> on_connect(): Connected to address: " + self.address)
+        self.waiting_for_response = ""
+
+        # try to get MODEL_NBR_UUID, since not all JKBMS send it
+        try:
+            self.bms_status["model_nbr"] = (await client.read_gatt_char(MODEL_NBR_UUID)).decode("utf-8")
+        except exc.BleakError:
+            (
+                exception_type,
+                exception_object,
+                exception_traceback,
+            ) = sys.exc_info()
+            logger.debug(f'Error getting UUID "{MODEL_NBR_UUID}": {repr(exception_object)} -> failover')
+            self.bms_status["model_nbr"] = "JK-BMS-Unknown-Model"
+
+        # some JKBMS trow an error
+        # BleakError('Multiple Characteristics with this UUID, refer to your desired
+        #             characteristic by the `handle` attribute instead.')
+        # failover in this case and use handle instead of UUID
+        try:
+            await client.start_notify(CHAR_HANDLE, self.ncallback)
+        except exc.BleakError:
+            (
+                exception_type,
+                exception_object,
+                exception_traceback,
+            ) = sys.exc_info()
+            logger.debug(f'Error getting UUID "{CHAR_HANDLE}": {repr(exception_object)} -> failover')
+            await client.start_notify(CHAR_HANDLE_FAILOVER, self.ncallback)
+
+        await self.request_bt("device_info", client)
+
+        await self.request_bt("cell_info", client)
+        # await self.enable_charging(client)
+
+        # run a SOC reset that was requested while disconnected
+        if self.trigger_soc_reset:
+            self.hub.submit(self.run_soc_reset(client))
 
     def start_scraping(self):
-        self.main_thread = threading.current_thread()
         if self.is_running():
-            logger.debug("scraping thread already running")
+            logger.debug("scraping already running")
             return
-        self.should_be_scraping = True
-        self.bt_thread_monitor.start()
+        self.connection = self.hub.register(self.address, self.on_connect)
 
     def stop_scraping(self):
-        self.run = False
-        self.should_be_scraping = False
-        stop = time()
-        while self.is_running():
-            sleep(0.1)
-            if time() - stop > 10:
-                return False
-        return True
+        return self.hub.unregister(self.address)
 
     def is_running(self):
-        if self.bt_thread is not None:
-            return self.bt_thread.is_alive()
+        if self.connection is not None:
+            return self.connection.is_running()
         return False
 
+    def request_soc_reset(self):
+        self.trigger_soc_reset = True
+        if self.connection is not None and self.connection.is_connected():
+            self.hub.submit(self.run_soc_reset(self.connection.client))
+
+    async def run_soc_reset(self, client: BleakClient):
+        # already started by a previous request
+        if not self.trigger_soc_reset:
+            return
+        self.trigger_soc_reset = False
+
+        try:
+            await self.reset_soc_jk(client)
+        except Exception:
+            (
+                exception_type,
+                exception_object,
+                exception_traceback,
+            ) = sys.exc_info()
+            file = exception_traceback.tb_frame.f_code.co_filename
+            line = exception_traceback.tb_lineno
+            logger.error(f"Exception occurred: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
+
     async def enable_charging(self, c):
         # these are the registers for the control-buttons:
         # data is 01 00 00 00 for on  00 00 00 00 for off;
@@ -190,6 +190,13 @@ class Jkbms_Can(Battery):
                     self.cell_count = len(self.cells)
                 self.cells[i].voltage = cell_voltage
 
+    def can_frame_received(self, arbitration_id: int, data: bytearray, timestamp: float) -> None:
+        # add the current of every status frame (sent every 20ms) to the coulomb counter, not only the last one of each poll
+        if arbitration_id + self.device_address in self.CAN_FRAMES[self.BATT_STAT]:
+            self.current_samples_from_frames = True
+            current = unpack_from("<H", data, 2)[0]
+            self.add_current_sample((current / 10) - 400, timestamp)
+
     def read_jkbms_can(self):
         # reset errors after timeout
         if ((time() - self.last_error_time) > 120.0) and self.error_active is True:
@@ -311,9 +318,11 @@ class Jkbms_Can(Battery):
                 # set balance status, if only a common balance status is available (bool)
                 # not needed, if balance status is available for each cell
                 self.balancing = bool((switch_state_bytes >> 2) & 0x01)
-                if self.get_min_cell() is not None and self.get_max_cell() is not None and self.cell_count > 1:
+                min_cell = self.get_min_cell()
+                max_cell = self.get_max_cell()
+                if min_cell is not None and max_cell is not None and self.cell_count > 1:
                     for c in range(self.cell_count):
-                        if self.balancing and (self.get_min_cell() == c or self.get_max_cell() == c):
+                        if self.balancing and (min_cell == c or max_cell == c):
                             self.cells[c].balance = True
                         else:
                             self.cells[c].balance = False
@@ -7,6 +7,7 @@
 from battery import Battery, Cell
 from struct import unpack_from
 from utils_ble import Syncron_Ble
+from utils_stats import RollingWindow
 import time
 
 
@@ -16,6 +17,8 @@ class LiTime_Ble(Battery):
         self.type = self.BATTERYTYPE
         self.address = address
         self.poll_interval = 2000
+        # average current over the last 5 measurements
+        self.last_few_currents = RollingWindow(5)
 
     BATTERYTYPE = "LiTime"
 
@@ -26,7 +29,6 @@ class LiTime_Ble(Battery):
     last_remian_ah_time = 0
     last_remian_ah_initiation = 0
     current_based_on_remaning = 0
-    last_few_currents = []
 
     def test_connection(self):
         self.ble_handle = Syncron_Ble(
@@ -39,6 +41,15 @@ class LiTime_Ble(Battery):
     def unique_identifier(self) -> str:
         return self.address
 
+    def disconnect(self):
+        if self.ble_handle is not None:
+            self.ble_handle.disconnect()
+
+    def get_link_metrics(self) -> dict:
+        if self.ble_handle is None:
+            return {}
+        return self.ble_handle.connection.link_metrics()
+
     def connection_name(self) -> str:
         return "BLE " + self.address
 
@@ -110,11 +121,9 @@ class LiTime_Ble(Battery):
                 self.last_remian_ah_initiation = 2
 
         # Calculate average current over last 5 messurments due to sensor inacuracy
-        self.last_few_currents.append(current)
-        if len(self.last_few_currents) > 5:
-            self.last_few_currents.pop(0)
+        self.last_few_currents.add(current)
 
-        last_few_avg = sum(self.last_few_currents) / len(self.last_few_currents)
+        last_few_avg = self.last_few_currents.mean
 
         # if last update was long ago we use the current reported by the bms despite it beeing unstable,
         # we also use the current from the BMS if there is a very large discrepency betwen them
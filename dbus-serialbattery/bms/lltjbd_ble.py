@@ -4,16 +4,16 @@
 # Updated by https://github.com/idstein
 
 import asyncio
-import atexit
+import concurrent.futures
 import functools
 import os
-import threading
 import sys
 import re
 from asyncio import CancelledError
 from time import sleep
 from typing import Union, Optional
 from utils import logger
+from utils_ble import BleHub, BleConnection
 from bleak import BleakClient, BleakScanner, BLEDevice
 from bleak.exc import BleakDBusError
 from bms.lltjbd import LltJbdProtection, LltJbd
@@ -34,15 +34,11 @@ class LltJbd_Ble(LltJbd):
         self.address = address
         self.protection = LltJbdProtection()
         self.type = self.BATTERYTYPE
-        self.main_thread = threading.current_thread()
         self.data: bytearray = bytearray()
-        self.run = True
-        self.bt_thread = threading.Thread(name="LltJbd_Ble_Loop", target=self.background_loop, daemon=True)
-        self.bt_loop: Optional[asyncio.AbstractEventLoop] = None
-        self.bt_client: Optional[BleakClient] = None
+        # the connection is handled by the shared BLE hub
+        self.hub = BleHub.get_instance()
+        self.connection: Optional[BleConnection] = None
         self.device: Optional[BLEDevice] = None
-        self.response_queue: Optional[asyncio.Queue] = None
-        self.ready_event: Optional[asyncio.Event] = None
 
         self.hci_uart_ok = True
         if not os.path.isfile("/tmp/dbus-blebattery-hciattach"):
@@ -66,12 +62,16 @@ class LltJbd_Ble(LltJbd):
     def custom_name(self) -> str:
         return self.device.name
 
-    def on_disconnect(self, client):
-        logger.info("BLE client disconnected")
+    async def on_connect(self, client: BleakClient):
+        # notifications are subscribed per command in send_command()
+        pass
+
+    def connect(self) -> bool:
+        if self.connection is not None and self.connection.is_running():
+            return self.connection.ready.wait(5)
 
-    async def bt_main_loop(self):
         try:
-            self.device = await BleakScanner.find_device_by_address(self.address, cb=dict(use_bdaddr=True))
+            self.device = self.hub.run_coroutine(BleakScanner.find_device_by_address(self.address, cb=dict(use_bdaddr=True)))
 
         except Exception:
             exception_type, exception_object, exception_traceback = sys.exc_info()
@@ -83,74 +83,26 @@ class LltJbd_Ble(LltJbd):
                 logger.error(f"BleakScanner(): Exception occurred: {repr(exception_object)} of type {exception_type} " f"in {file} line #{line}")
 
             self.device = None
-            await asyncio.sleep(0.5)
             # allow the bluetooth connection to recover
             sleep(5)
 
         if not self.device:
-            self.run = False
-            return
-
-        try:
-            async with BleakClient(self.device, disconnected_callback=self.on_disconnect) as client:
-                self.bt_client = client
-                self.bt_loop = asyncio.get_event_loop()
-                self.response_queue = asyncio.Queue()
-                self.ready_event.set()
-                while self.run and client.is_connected and self.main_thread.is_alive():
-                    await asyncio.sleep(0.1)
-            self.bt_loop = None
-
-        # Exception occurred: TimeoutError() of type <class 'asyncio.exceptions.TimeoutError'>
-        except asyncio.exceptions.TimeoutError:
-            exception_type, exception_object, exception_traceback = sys.exc_info()
-            file = exception_traceback.tb_frame.f_code.co_filename
-            line = exception_traceback.tb_lineno
-            logger.error(f"BleakClient(): asyncio.exceptions.TimeoutError: {repr(exception_object)} of type {exception_type} " f"in {file} line #{line}")
-            # needed?
-            self.run = False
-            return
+            return False
 
-        except TimeoutError:
-            exception_type, exception_object, exception_traceback = sys.exc_info()
-            file = exception_traceback.tb_frame.f_code.co_filename
-            line = exception_traceback.tb_lineno
-            logger.error(f"BleakClient(): TimeoutError: {repr(exception_object)} of type {exception_type} " f"in {file} line #{line}")
-            # needed?
-            self.run = False
-            return
+        self.connection = self.hub.register(self.address, self.on_connect, device=self.device)
 
-        except Exception:
-            exception_type, exception_object, exception_traceback = sys.exc_info()
-            file = exception_traceback.tb_frame.f_code.co_filename
-            line = exception_traceback.tb_lineno
-            logger.error(f"BleakClient(): Exception occurred: {repr(exception_object)} of type {exception_type} " f"in {file} line #{line}")
-            # needed?
-            self.run = False
-            return
-
-    def background_loop(self):
-        while self.run and self.main_thread.is_alive():
-            asyncio.run(self.bt_main_loop())
-
-    async def async_test_connection(self):
-        if self.hci_uart_ok:
-            self.ready_event = asyncio.Event()
-            if not self.bt_thread.is_alive():
-                self.bt_thread.start()
-
-                def shutdown_ble_atexit(thread):
-                    self.run = False
-                    thread.join()
-
-                atexit.register(shutdown_ble_atexit, self.bt_thread)
-            try:
-                return await asyncio.wait_for(self.ready_event.wait(), timeout=5)
-            except asyncio.TimeoutError:
-                logger.error(">>> ERROR: Unable to connect with BLE device")
-                return False
-        else:
+        if not self.connection.ready.wait(5):
+            logger.error(">>> ERROR: Unable to connect with BLE device")
             return False
+        return True
+
+    def disconnect(self):
+        self.hub.unregister(self.address)
+
+    def get_link_metrics(self) -> dict:
+        if self.connection is None:
+            return {}
+        return self.connection.link_metrics()
 
     def test_connection(self):
         # call a function that will connect to the battery, send a command and retrieve the result.
@@ -161,8 +113,10 @@ class LltJbd_Ble(LltJbd):
         try:
             if self.address:
                 result = True
-            if result and asyncio.run(self.async_test_connection()):
+            if result and self.hci_uart_ok and self.connect():
                 result = True
+            else:
+                result = False
             if result:
                 result = super().test_connection()
             if not result:
@@ -187,11 +141,12 @@ class LltJbd_Ble(LltJbd):
         return string
 
     async def send_command(self, command) -> Union[bytearray, bool]:
-        if not self.bt_client:
+        if self.connection is None or not self.connection.is_connected():
             logger.error(">>> ERROR: No BLE client connection - returning")
             return False
 
-        fut = self.bt_loop.create_future()
+        client = self.connection.client
+        fut = asyncio.get_running_loop().create_future()
 
         def rx_callback(future: asyncio.Future, data: bytearray, sender, rx: bytearray):
             data.extend(rx)
@@ -205,79 +160,50 @@ class LltJbd_Ble(LltJbd):
                 future.set_result(data)
 
         rx_collector = functools.partial(rx_callback, fut, bytearray())
-        await self.bt_client.start_notify(BLE_CHARACTERISTICS_RX_UUID, rx_collector)
-        await self.bt_client.write_gatt_char(BLE_CHARACTERISTICS_TX_UUID, command, False)
+        await client.start_notify(BLE_CHARACTERISTICS_RX_UUID, rx_collector)
+        await client.write_gatt_char(BLE_CHARACTERISTICS_TX_UUID, command, False)
         result = await fut
-        await self.bt_client.stop_notify(BLE_CHARACTERISTICS_RX_UUID)
+        await client.stop_notify(BLE_CHARACTERISTICS_RX_UUID)
 
         return result
 
-    async def async_read_serial_data_llt(self, command):
-        if self.hci_uart_ok:
-            try:
-                bt_task = asyncio.run_coroutine_threadsafe(self.send_command(command), self.bt_loop)
-                result = await asyncio.wait_for(asyncio.wrap_future(bt_task), 20)
-                return result
-            except asyncio.TimeoutError:
-                logger.error(">>> ERROR: No reply - returning")
-                return False
-            except BleakDBusError:
-                exception_type, exception_object, exception_traceback = sys.exc_info()
-                file = exception_traceback.tb_frame.f_code.co_filename
-                line = exception_traceback.tb_lineno
-                logger.error(f"BleakDBusError: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
-                self.reset_bluetooth()
-                return False
-            except Exception:
-                exception_type, exception_object, exception_traceback = sys.exc_info()
-                file = exception_traceback.tb_frame.f_code.co_filename
-                line = exception_traceback.tb_lineno
-                logger.error(f"Exception occurred: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
-                self.reset_bluetooth()
-                return False
-        else:
-            return False
-
     def read_serial_data_llt(self, command):
-        if not self.bt_loop:
+        if not self.hci_uart_ok or self.connection is None or not self.connection.is_connected():
             return False
         try:
-            data = asyncio.run(self.async_read_serial_data_llt(command))
+            data = self.hub.run_coroutine(self.send_command(command), timeout=20)
             return self.validate_packet(data)
-        except CancelledError as e:
+        except concurrent.futures.TimeoutError:
+            logger.error(">>> ERROR: No reply - returning")
+            return False
+        except (CancelledError, concurrent.futures.CancelledError) as e:
             logger.error(">>> ERROR: No reply - canceled - returning")
             logger.error(e)
             return False
-        # except Exception as e:
-        #     logger.error(">>> ERROR: No reply - returning")
-        #     logger.error(e)
-        #     return False
+        except BleakDBusError:
+            exception_type, exception_object, exception_traceback = sys.exc_info()
+            file = exception_traceback.tb_frame.f_code.co_filename
+            line = exception_traceback.tb_lineno
+            logger.error(f"BleakDBusError: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
+            self.reset_bluetooth()
+            return False
         except Exception:
             exception_type, exception_object, exception_traceback = sys.exc_info()
             file = exception_traceback.tb_frame.f_code.co_filename
             line = exception_traceback.tb_lineno
             logger.error(f"Exception occurred: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
+            self.reset_bluetooth()
             return False
 
     def reset_bluetooth(self):
-        logger.error("Reset of system Bluetooth daemon triggered")
-        self.bt_loop = False
-
-        # process kill is needed, since the service/bluetooth driver is probably freezed
-        # os.system('pkill -f "bluetoothd"')
-        # stop will not work, if service/bluetooth driver is stuck
-        os.system("/etc/init.d/bluetooth stop")
-        sleep(2)
-        os.system("rfkill block bluetooth")
-        os.system("rfkill unblock bluetooth")
-        os.system("/etc/init.d/bluetooth start")
-        logger.error("System Bluetooth daemon should have been restarted")
-        sleep(5)
-        sys.exit(1)
+        logger.error("Bluetooth connection failed, reconnecting")
+        # the BLE hub reconnects with backoff and resets the adapter over D-Bus, if needed
+        if self.connection is not None:
+            self.connection.reconnect()
 
     def reset_hci_uart(self):
         logger.error("Reset of hci_uart stack... Reconnecting to: " + self.address)
-        self.run = False
+        self.hci_uart_ok = False
         os.system("pkill -f 'hciattach'")
         sleep(0.5)
         os.system("rmmod hci_uart")
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from battery import Battery, Cell
+from battery import Battery, Cell, PollTier, poll_tier
 from utils import bytearray_to_string, read_serial_data, unpack_from, logger
 from struct import unpack
 import struct
@@ -86,9 +86,7 @@ class Renogy(Battery):
         # call all functions that will refresh the battery data.
         # This will be called for every iteration (1 second)
         # Return True if success, False for failure
-        result = self.read_soc_data()
-        result = result and self.read_cell_data()
-        result = result and self.read_temp_data()
+        result = self.run_due_reads([self.read_soc_data, self.read_cell_data, self.read_temp_data])
 
         return result
 
@@ -152,6 +150,7 @@ class Renogy(Battery):
         self.soc = (self.capacity_remain / self.capacity) * 100
         return True
 
+    @poll_tier(PollTier.MEDIUM)
     def read_cell_data(self):
         cell_volt_data = self.read_serial_data_renogy(self.command_cell_voltages)
         cell_temp_data = self.read_serial_data_renogy(self.command_cell_temps)
@@ -197,6 +196,7 @@ class Renogy(Battery):
         return True
     """
 
+    @poll_tier(PollTier.MEDIUM)
     def read_temp_data(self):
         temp1 = self.read_serial_data_renogy(self.command_bms_temp1)
         temp2 = self.read_serial_data_renogy(self.command_bms_temp2)
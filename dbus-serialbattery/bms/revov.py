@@ -3,7 +3,7 @@
 # Deprecate Revov driver - replaced by LifePower
 # https://github.com/Louisvdw/dbus-serialbattery/pull/353/commits/c3ac9558fc86b386e5a6aefb313408165c86d240
 
-from battery import Protection, Battery, Cell
+from battery import Protection, Battery, Cell, PollTier, poll_tier
 from utils import *
 from struct import *
 import struct
@@ -89,8 +89,7 @@ class Revov(Battery):
         # call all functions that will refresh the battery data.
         # This will be called for every iteration (1 second)
         # Return True if success, False for failure
-        result = self.read_soc_data()
-        result = result and self.read_cell_data()
+        result = self.run_due_reads([self.read_soc_data, self.read_cell_data])
         # result = result and self.read_temp_data()
         return result
 
@@ -135,6 +134,7 @@ class Revov(Battery):
     # self.soc = self.capacity_remain / self.capacity * 100
     # return True
 
+    @poll_tier(PollTier.MEDIUM)
     def read_cell_data(self):
         packet = self.read_serial_data_revov(self.command_two)
 
@@ -191,6 +191,7 @@ class Revov(Battery):
         logger.warn("Cell Total: " + "%.2fv" % cell_total)
         return True
 
+    @poll_tier(PollTier.MEDIUM)
     def read_temp_data(self):
         return True
         # disabled for now.  I need to find what bytes map to the 2 temp sensors
@@ -4,7 +4,7 @@
 # Added by https://github.com/wollew
 # https://github.com/Louisvdw/dbus-serialbattery/pull/530
 
-from battery import Protection, Battery, Cell
+from battery import Protection, Battery, Cell, PollTier, poll_tier
 from utils import logger
 import serial
 import sys
@@ -143,10 +143,7 @@ class Seplos(Battery):
         # call all functions that will refresh the battery data.
         # This will be called for every iteration (self.poll_interval)
         # Return True if success, False for failure
-        result_status = self.read_status_data()
-        result_alarm = self.read_alarm_data()
-
-        return result_status and result_alarm
+        return self.run_due_reads([self.read_status_data, self.read_alarm_data], stop_on_failure=False)
 
     @staticmethod
     def decode_alarm_byte(data_byte: int, alarm_bit: int, warn_bit: int):
@@ -156,6 +153,7 @@ class Seplos(Battery):
             return Protection.WARNING
         return Protection.OK
 
+    @poll_tier(PollTier.SLOW)
     def read_alarm_data(self):
         logger.debug("read alarm data")
         data = self.read_serial_data_seplos(self.encode_cmd(self.address, cid2=self.COMMAND_ALARM, info=b"01"))
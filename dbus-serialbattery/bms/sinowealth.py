@@ -4,7 +4,7 @@
 # can be enabled by specifying it in the BMS_TYPE setting in the "config.ini"
 # https://github.com/Louisvdw/dbus-serialbattery/commit/7aab4c850a5c8d9c205efefc155fe62bb527da8e
 
-from battery import Battery, Cell
+from battery import Battery, Cell, PollTier, poll_tier
 from utils import kelvin_to_celsius, read_serial_data, logger
 from struct import unpack_from
 import sys
@@ -83,16 +83,19 @@ class Sinowealth(Battery):
         return True
 
     def refresh_data(self):
-        result = self.read_soc()
-        result = result and self.read_status_data()
-        result = result and self.read_battery_status()
-        result = result and self.read_pack_voltage()
-        result = result and self.read_pack_current()
-        result = result and self.read_cell_data()
-        result = result and self.read_temperature_data()
-        result = result and self.read_remaining_capacity()
-        result = result and self.read_cycle_count()
-        return result
+        return self.run_due_reads(
+            [
+                self.read_soc,
+                self.read_status_data,
+                self.read_battery_status,
+                self.read_pack_voltage,
+                self.read_pack_current,
+                self.read_cell_data,
+                self.read_temperature_data,
+                self.read_remaining_capacity,
+                self.read_cycle_count,
+            ]
+        )
 
     def read_status_data(self):
         status_data = self.read_serial_data_sinowealth(self.command_status)
@@ -115,6 +118,7 @@ class Sinowealth(Battery):
             self.read_pack_config_data()
         return True
 
+    @poll_tier(PollTier.SLOW)
     def read_battery_status(self):
         battery_status = self.read_serial_data_sinowealth(self.command_battery_status)
         # check if connection success
@@ -133,6 +137,7 @@ class Sinowealth(Battery):
         self.protection.low_temperature = 2 if bool(battery_status[0] >> 3 & int(1)) else 0  # UTD
         return True
 
+    @poll_tier(PollTier.MEDIUM)
     def read_soc(self):
         soc_data = self.read_serial_data_sinowealth(self.command_soc)
         # check if connection success
@@ -143,6 +148,7 @@ class Sinowealth(Battery):
         self.soc = soc
         return True
 
+    @poll_tier(PollTier.SLOW)
     def read_cycle_count(self):
         # TODO: cyclecount does not match cycles in the app
         cycle_count = self.read_serial_data_sinowealth(self.command_cycle_count)
@@ -174,6 +180,7 @@ class Sinowealth(Battery):
         self.current = current
         return True
 
+    @poll_tier(PollTier.MEDIUM)
     def read_remaining_capacity(self):
         remaining_capacity_data = self.read_serial_data_sinowealth(self.command_remaining_capacity)
         if remaining_capacity_data is False:
@@ -211,6 +218,7 @@ class Sinowealth(Battery):
         logger.debug(">>> INFO: Number of temperatur sensors: %u", self.temp_sensors)
         return True
 
+    @poll_tier(PollTier.MEDIUM)
     def read_cell_data(self):
         if self.cell_count is None:
             self.read_pack_config_data()
@@ -229,6 +237,7 @@ class Sinowealth(Battery):
         logger.debug(">>> INFO: Cell %u voltage: %f V", cell_index, cell_voltage)
         return cell_voltage
 
+    @poll_tier(PollTier.MEDIUM)
     def read_temperature_data(self):
         if self.temp_sensors is None:
             return False
@@ -1,18 +1,18 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
-import math
 import os
 import signal
 import sys
-from datetime import datetime
+import threading
 from time import sleep
-from typing import Union
+from typing import Callable, Dict, List, Union
 
 from dbus.mainloop.glib import DBusGMainLoop
 from gi.repository import GLib as gobject
 
 from battery import Battery
 from dbushelper import DbusHelper
+from utils_poll import BatteryPollThread
 from utils import (
     BMS_TYPE,
     bytearray_to_string,
@@ -22,6 +22,8 @@ from utils import (
     EXTERNAL_CURRENT_SENSOR_DBUS_PATH,
     logger,
     BATTERY_ADDRESSES,
+    CAN_REPLAY_FILE,
+    CAN_REPLAY_SPEED,
     POLL_INTERVAL,
     validate_config_values,
 )
@@ -87,37 +89,369 @@ logger.info("")
 logger.info("Starting dbus-serialbattery")
 
 
-# count loops
-count_for_loops = 5
-delayed_loop_count = 0
+def get_battery(
+    _port: str, _modbus_address: hex = None, _can_message_cache_callback: callable = None, _expected_bms_types: list = None
+) -> Union[Battery, None]:
+    """
+    Attempts to establish a connection to the battery and returns the battery object if successful.
+
+    :param _port: The port to connect to.
+    :param _modbus_address: The Modbus address to connect to (optional).
+    :param _can_message_cache_callback: The callback to get the CAN message cache (optional).
+    :param _expected_bms_types: The BMS types to test, defaults to `expected_bms_types` (optional).
+    :return: The battery object if a connection is established, otherwise None.
+    """
+    if _expected_bms_types is None:
+        _expected_bms_types = expected_bms_types
+
+    # Try to establish communications with the battery 3 times, else exit
+    retry = 1
+    retries = 3
+    while retry <= retries:
+        logger.info("-- Testing BMS: " + str(retry) + " of " + str(retries) + " rounds")
+        # Create a new battery object that can read the battery and run connection test
+        for test in _expected_bms_types:
+            # noinspection PyBroadException
+            try:
+                if _modbus_address is not None:
+                    # Convert hex string to bytes
+                    _bms_address = bytes.fromhex(_modbus_address.replace("0x", ""))
+                elif "address" in test:
+                    _bms_address = test["address"]
+                else:
+                    _bms_address = None
+
+                logger.info("Testing " + test["bms"].__name__ + (' at address "' + bytearray_to_string(_bms_address) + '"' if _bms_address is not None else ""))
+                batteryClass = test["bms"]
+                baud = test["baud"] if "baud" in test else None
+                battery: Battery = batteryClass(port=_port, baud=baud, address=_bms_address)
+                battery.set_message_cache_callback(_can_message_cache_callback)
+                if battery.test_connection() and battery.validate_data():
+                    logger.info("-- Connection established to " + battery.__class__.__name__)
+                    return battery
+            except KeyboardInterrupt:
+                return None
+            except Exception:
+                (
+                    exception_type,
+                    exception_object,
+                    exception_traceback,
+                ) = sys.exc_info()
+                file = exception_traceback.tb_frame.f_code.co_filename
+                line = exception_traceback.tb_lineno
+                logger.error("Non blocking exception occurred: " + f"{repr(exception_object)} of type {exception_type} in {file} line #{line}")
+                # Ignore any malfunction test_function()
+                pass
+        retry += 1
+        sleep(0.5)
+
+    return None
+
+
+def check_bms_types(supported_bms_types: list, type: str) -> bool:
+    """
+    Checks if BMS_TYPE is not empty and all specified BMS types are supported.
+
+    :param supported_bms_types: List of supported BMS types.
+    :param type: The type of BMS connection (ble, can, or serial).
+    :return: True if all BMS types are supported, else False
+    """
+    # Get only BMS_TYPE that end with "_Ble"
+    if type == "ble":
+        bms_types = [type for type in BMS_TYPE if type.endswith("_Ble")]
+
+    # Get only BMS_TYPE that end with "_Can"
+    if type == "can":
+        bms_types = [type for type in BMS_TYPE if type.endswith("_Can")]
+
+    # Get only BMS_TYPE that do not end with "_Ble" or "_Can"
+    if type == "serial":
+        bms_types = [type for type in BMS_TYPE if not type.endswith("_Ble") and not type.endswith("_Can")]
+
+    if len(bms_types) > 0:
+        for bms_type in bms_types:
+            if bms_type not in [bms["bms"].__name__ for bms in supported_bms_types]:
+                logger.error(
+                    f'ERROR >>> BMS type "{bms_type}" is not supported. Supported BMS types are: '
+                    + f"{', '.join([bms['bms'].__name__ for bms in supported_bms_types])}"
+                    + "; Disabled by default: ANT, MNB, Sinowealth"
+                )
+                return False
+
+    return True
+
+
+class BatteryPort:
+    """
+    Handles all batteries connected to one port: the BMS detection, a `DbusHelper` per battery
+    and the `BatteryPollThread` that reads the batteries.
+    """
+
+    def __init__(self, port: str, ble_addresses: List[str], mainloop, on_failure: Callable = None):
+        """
+        :param port: The serial port, CAN port or Bluetooth BMS type
+        :param ble_addresses: The Bluetooth addresses, only used for Bluetooth BMS
+        :param mainloop: The main loop of the driver
+        :param on_failure: Called with this port, if the port failed. If None, the main loop is stopped.
+        """
+        self.port = port
+        self.ble_addresses = ble_addresses
+        self.mainloop = mainloop
+        self.on_failure = on_failure
+        self.battery: Dict[Union[str, int], Battery] = {}
+        self.helper: Dict[Union[str, int], DbusHelper] = {}
+        self.poll_thread: Union[BatteryPollThread, None] = None
+        self.can_thread = None
+
+    def detect(self) -> bool:
+        """
+        Search for batteries on the port. Blocks until the detection finished.
+
+        :return: True if at least one battery was found, else False
+        """
+        port = self.port
 
+        # BLUETOOTH
+        if port.endswith("_Ble"):
+            """
+            Import BLE classes only if it's a BLE port; otherwise, the driver won't start due to missing Python modules.
+            This prevents issues when using the driver exclusively with a serial connection.
+            """
 
-def main():
-    global expected_bms_types, supported_bms_types
+            if len(self.ble_addresses) == 0:
+                logger.error("Bluetooth address is missing in the command line arguments")
+            else:
+                if port == "Jkbms_Ble":
+                    # noqa: F401 --> ignore flake "imported but unused" error
+                    from bms.jkbms_ble import Jkbms_Ble  # noqa: F401
 
-    def exit_driver(sig, frame, code: int = 0) -> None:
+                if port == "LltJbd_Ble":
+                    # noqa: F401 --> ignore flake "imported but unused" error
+                    from bms.lltjbd_ble import LltJbd_Ble  # noqa: F401
+
+                if port == "LiTime_Ble":
+                    # noqa: F401 --> ignore flake "imported but unused" error
+                    from bms.litime_ble import LiTime_Ble  # noqa: F401
+
+                class_ = eval(port)
+
+                # multiple addresses can be passed, all batteries share the same BLE hub in this process
+                for index, ble_address in enumerate(self.ble_addresses):
+                    # do not remove ble_ prefix, since the dbus service cannot be only numbers
+                    testbms = class_("ble_" + ble_address.replace(":", "").lower(), 9600, ble_address)
+
+                    if testbms.test_connection():
+                        logger.info("-- Connection established to " + testbms.__class__.__name__ + " at " + ble_address)
+                        self.battery[index] = testbms
+                    else:
+                        logger.warning("No battery connection at " + ble_address)
+
+        # CAN
+        elif port.startswith("can") or port.startswith("vecan"):
+            """
+            Import CAN classes only if it's a CAN port; otherwise, the driver won't start due to missing Python modules.
+            This prevents issues when using the driver exclusively with a serial connection.
+            """
+            from bms.daly_can import Daly_Can
+            from bms.jkbms_can import Jkbms_Can
+
+            # only try CAN BMS on CAN port
+            supported_can_bms_types = [
+                {"bms": Daly_Can},
+                {"bms": Jkbms_Can},
+            ]
+
+            # check if BMS_TYPE is not empty and all BMS types in the list are supported
+            if not check_bms_types(supported_can_bms_types, "can"):
+                return False
+
+            expected_can_bms_types = [
+                battery_type for battery_type in supported_can_bms_types if battery_type["bms"].__name__ in BMS_TYPE or len(BMS_TYPE) == 0
+            ]
+
+            # start the corresponding CanReceiverThread if BMS for this type found
+            from utils_can import CanReceiverThread
+
+            try:
+                self.can_thread = CanReceiverThread.get_instance(bustype="socketcan", channel=port, replay_file=CAN_REPLAY_FILE, replay_speed=CAN_REPLAY_SPEED)
+            except Exception as e:
+                print(f"Error: {e}")
+                return False
+
+            logger.debug("Wait shortly to make sure that all needed data is in the cache")
+            # Slowest message cycle trasmission is every 1 second, wait a bit more for the fist time to fetch all needed data
+            sleep(2)
+
+            # check if BATTERY_ADDRESSES is not empty
+            if BATTERY_ADDRESSES:
+                logger.info(">>> CAN multi device mode")
+                for address in BATTERY_ADDRESSES:
+                    checkbatt = get_battery(port, address, self.can_thread.get_message_cache, expected_can_bms_types)
+                    if checkbatt is not None:
+                        self.battery[address] = checkbatt
+                        logger.info("Successful battery connection at " + port + " and this device address " + str(address))
+                    else:
+                        logger.warning("No battery connection at " + port + " and this device address " + str(address))
+            # use default address
+            else:
+                self.battery[0] = get_battery(port, None, self.can_thread.get_message_cache, expected_can_bms_types)
+
+            # integrate the current of every received frame, not only the last one of each poll
+            for key_address in self.battery:
+                if self.battery[key_address] is not None:
+                    self.can_thread.add_listener(self.battery[key_address].can_frame_received)
+
+        # SERIAL
+        else:
+            # check if BMS_TYPE is not empty and all BMS types in the list are supported
+            if not check_bms_types(supported_bms_types, "serial"):
+                return False
+
+            # wait some seconds to be sure that the serial connection is ready
+            # else the error throw a lot of timeouts
+            sleep(16)
+
+            # check if BATTERY_ADDRESSES is not empty
+            if BATTERY_ADDRESSES:
+                for address in BATTERY_ADDRESSES:
+                    checkbatt = get_battery(port, address)
+                    if checkbatt is not None:
+                        self.battery[address] = checkbatt
+                        logger.info("Successful battery connection at " + port + " and this Modbus address " + str(address))
+                    else:
+                        logger.warning("No battery connection at " + port + " and this Modbus address " + str(address))
+            # use default address
+            else:
+                self.battery[0] = get_battery(port)
+
+        # remove addresses without battery
+        self.battery = {key_address: battery for key_address, battery in self.battery.items() if battery is not None}
+
+        # check if at least one BMS was found
+        if len(self.battery) == 0:
+            logger.error(
+                "ERROR >>> No battery connection at " + port + (" and this Modbus addresses: " + ", ".join(BATTERY_ADDRESSES) if BATTERY_ADDRESSES else "")
+            )
+            return False
+
+        return True
+
+    def setup(self) -> bool:
         """
-        Gracefully exit the driver.
-        Handles also signal for SIGINT and SIGTERM.
+        Register the dbus services of all found batteries and start polling them.
+        Has to be called in the main loop.
 
+        :return: True if all batteries were set up successfully, else False
+        """
+        # Get the initial values for the battery used by setup_vedbus
+        for key_address in self.battery:
+            self.helper[key_address] = DbusHelper(self.battery[key_address], key_address)
+            if not self.helper[key_address].setup_vedbus():
+                logger.error(
+                    "ERROR >>> Problem with battery set up at "
+                    + self.port
+                    + (" and this Modbus address: " + ", ".join(BATTERY_ADDRESSES) if BATTERY_ADDRESSES else "")
+                )
+                return False
+
+        # get first key from battery dict
+        first_key = list(self.battery.keys())[0]
+
+        # the blocking BMS I/O runs in a separate thread, the main loop only publishes the data
+        self.poll_thread = BatteryPollThread(self.battery, self.poll_battery)
+
+        # try using active callback on this battery (normally only used for Bluetooth BMS)
+        # the battery then triggers a poll as soon as new data arrives
+        if not self.battery[first_key].use_callback(self.poll_thread.trigger):
+            # change poll interval if set in config
+            if POLL_INTERVAL is not None:
+                self.battery[first_key].poll_interval = POLL_INTERVAL
+
+            logger.info(f"Polling interval: {self.battery[first_key].poll_interval/1000:.3f} s")
+
+        # print log at this point, else not all data is correctly populated
+        for key_address in self.battery:
+            self.battery[key_address].log_settings()
+
+        # check config, if there are any invalid values trigger "settings incorrect" error
+        # and set the battery in error state to prevent chargin/discharging
+        if not validate_config_values():
+            for key_address in self.battery:
+                self.battery[key_address].state = 10
+                self.battery[key_address].error_code = 119
+
+        # check, if external current sensor should be used
+        if EXTERNAL_CURRENT_SENSOR_DBUS_DEVICE is not None and EXTERNAL_CURRENT_SENSOR_DBUS_PATH is not None:
+            for key_address in self.battery:
+                self.battery[key_address].setup_external_current_sensor()
+
+        # poll the battery every poll_interval milliseconds
+        self.poll_thread.start()
+
+        return True
+
+    def poll_battery(self, snapshots: tuple) -> None:
+        """
+        Publishes the data of the last poll on the dbus.
+        Called in the main loop by the `BatteryPollThread` after it refreshed all batteries.
+        Calls `publish_battery` from DbusHelper for each battery instance.
+
+        :param snapshots: The `BatterySnapshot` of each battery
         :return: None
         """
-        logger.info("Exit signal received, exiting gracefully...")
+        for snapshot in snapshots:
+            # the port was stopped by a failing battery
+            if snapshot.key_address not in self.helper:
+                return
 
-        port = get_port()
+            # this port is passed as loop, so that a failing battery only stops this port
+            self.helper[snapshot.key_address].publish_battery(self, snapshot)
 
-        # Stop the main loop, if set
-        if "mainloop" in globals() and mainloop is not None:
-            mainloop.quit()
+        # time spent reading the batteries in the poll thread
+        # the poll interval is adapted by the PollIntervalController of the poll thread
+        logger.debug(f"Polling data took {sum(snapshot.runtime for snapshot in snapshots):.3f} seconds")
+
+    def quit(self) -> None:
+        """
+        Called by `DbusHelper.publish_battery()`, if the battery failed.
+
+        :return: None
+        """
+        if self.on_failure is None:
+            self.mainloop.quit()
+        else:
+            self.on_failure(self)
+
+    def stop(self, keep_can_receiver: bool = False) -> None:
+        """
+        Stop polling, remove the dbus services of this port and disconnect Bluetooth BMS.
+
+        :param keep_can_receiver: If True, the CAN receiver keeps running to be used by the next detection
+        :return: None
+        """
+        # Stop the poll thread, if started
+        if self.poll_thread is not None:
+            self.poll_thread.stop()
+            self.poll_thread = None
+
+        for key_address in self.helper:
+            self.helper[key_address].unregister_vedbus()
+        self.helper = {}
 
         # For BLE connections, disconnect from the BLE device
-        if port.endswith("_Ble"):
-            if battery and len(battery) > 0 and hasattr(battery[0], "disconnect") and callable(battery[0].disconnect):
-                battery[0].disconnect()
+        if self.port.endswith("_Ble"):
+            for key_address in self.battery:
+                if hasattr(self.battery[key_address], "disconnect") and callable(self.battery[key_address].disconnect):
+                    self.battery[key_address].disconnect()
 
         # Stop the CanReceiverThread
-        elif port.startswith("can") or port.startswith("vecan"):
-            can_thread.stop()
+        elif self.can_thread is not None:
+            for key_address in self.battery:
+                if self.battery[key_address] is not None:
+                    self.can_thread.remove_listener(self.battery[key_address].can_frame_received)
+
+            if not keep_can_receiver:
+                self.can_thread.stop()
 
         # Close the serial connection
         else:
@@ -125,108 +459,161 @@ def main():
             # TODO: Is it worth implementing this?
             pass
 
-        logger.info(f"Stopped dbus-serialbattery with exit code {code}")
-        sys.exit(code)
 
-    # Register the signal handler
-    signal.signal(signal.SIGINT, exit_driver)
-    signal.signal(signal.SIGTERM, exit_driver)
+class PortSupervisor:
+    """
+    Handles many ports in one process, instead of one process per port. All ports share the
+    Python interpreter, the config and the dbus connection, but each port has its own poll thread and dbus services.
+
+    A failing port is stopped and detected again after `RESTART_DELAY` seconds, the other ports keep running.
+    """
+
+    RESTART_DELAY = 60
+    """
+    Seconds to wait before a failed port is detected again
+    """
 
-    def poll_battery(loop) -> bool:
+    def __init__(self, port_specs: List[str], mainloop):
         """
-        Polls the battery for data and updates it on the dbus.
-        Calls `publish_battery` from DbusHelper for each battery instance.
+        :param port_specs: The ports to handle. Serial and CAN ports are passed as they are, e.g. `/dev/ttyUSB0` or `can0`.
+            Bluetooth BMS are passed with their addresses, e.g. `Jkbms_Ble:C8:47:8C:12:34:56,C8:47:8C:12:34:57`
+        :param mainloop: The main loop of the driver
+        """
+        self.mainloop = mainloop
+        self.ports: List[BatteryPort] = []
+
+        for port_spec in port_specs:
+            if port_spec in EXCLUDED_DEVICES:
+                logger.info(f"Supervisor: {port_spec} is excluded through the config file")
+                continue
 
-        :param loop: The main event loop
-        :return: Always returns True
+            port, _, ble_addresses = port_spec.partition(":")
+            self.ports.append(BatteryPort(port, [address for address in ble_addresses.split(",") if address], mainloop, self.on_port_failure))
+
+    def start(self) -> None:
         """
-        global count_for_loops, delayed_loop_count
+        Start the detection of all ports.
 
-        # count execution time in milliseconds
-        start = datetime.now()
+        :return: None
+        """
+        for battery_port in self.ports:
+            self.detect_port(battery_port)
+
+    def detect_port(self, battery_port: BatteryPort) -> bool:
+        """
+        Detect the batteries of a port in a separate thread, since the detection blocks for several seconds.
 
-        for key_address in battery:
-            helper[key_address].publish_battery(loop)
+        :param battery_port: The port
+        :return: False, to remove the timeout source when called by `GLib.timeout_add_seconds`
+        """
+        logger.info(f"Supervisor: detecting batteries on {battery_port.port}")
+        battery_port.battery = {}
+        threading.Thread(target=self.run_detection, args=(battery_port,), name="detect_" + battery_port.port, daemon=True).start()
+        return False
 
-        runtime = (datetime.now() - start).total_seconds()
-        logger.debug(f"Polling data took {runtime:.3f} seconds")
+    def run_detection(self, battery_port: BatteryPort) -> None:
+        """
+        Runs in the detection thread of a port.
 
-        # check if polling took too long and adjust poll interval, but only after 5 loops
-        # since the first polls are always slower
-        if runtime > battery[first_key].poll_interval / 1000:
-            delayed_loop_count += 1
-            if delayed_loop_count > 1:
-                logger.warning(f"Polling data took {runtime:.3f} seconds. Automatically increase interval in {count_for_loops - delayed_loop_count} cycles.")
+        :param battery_port: The port
+        :return: None
+        """
+        try:
+            found = battery_port.detect()
+        except Exception:
+            (
+                exception_type,
+                exception_object,
+                exception_traceback,
+            ) = sys.exc_info()
+            file = exception_traceback.tb_frame.f_code.co_filename
+            line = exception_traceback.tb_lineno
+            logger.error(f"Exception occurred: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
+            found = False
+
+        if found:
+            # the dbus services are registered in the main loop
+            gobject.idle_add(self.setup_port, battery_port)
         else:
-            delayed_loop_count = 0
+            gobject.idle_add(self.on_port_failure, battery_port)
 
-        if delayed_loop_count >= count_for_loops:
-            # round up to the next half second
-            new_poll_interval = math.ceil((runtime + 0.05) * 2) / 2 * 1000
+    def setup_port(self, battery_port: BatteryPort) -> bool:
+        """
+        Runs in the main loop.
 
-            # limit max poll interval to 60 seconds
-            if new_poll_interval > 60000:
-                new_poll_interval = 60000
+        :param battery_port: The port
+        :return: False, to remove the idle source
+        """
+        try:
+            if battery_port.setup():
+                logger.info(f"Supervisor: {battery_port.port} started with {len(battery_port.battery)} battery(s)")
+                return False
+        except Exception:
+            (
+                exception_type,
+                exception_object,
+                exception_traceback,
+            ) = sys.exc_info()
+            file = exception_traceback.tb_frame.f_code.co_filename
+            line = exception_traceback.tb_lineno
+            logger.error(f"Exception occurred: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
+
+        self.on_port_failure(battery_port)
+        return False
+
+    def on_port_failure(self, battery_port: BatteryPort) -> bool:
+        """
+        Stop a failed port and detect it again after `RESTART_DELAY` seconds. Runs in the main loop.
 
-            battery[first_key].poll_interval = new_poll_interval
-            logger.warning(f"Polling took too long for the last {count_for_loops} cycles. Set to {new_poll_interval/1000:.3f} s")
+        :param battery_port: The port
+        :return: False, to remove the idle source
+        """
+        logger.error(f"Supervisor: {battery_port.port} failed, detecting again in {self.RESTART_DELAY} seconds")
+        # keep the CAN receiver, since a stopped receiver cannot be started again
+        battery_port.stop(keep_can_receiver=True)
+        gobject.timeout_add_seconds(self.RESTART_DELAY, self.detect_port, battery_port)
+        return False
 
-            delayed_loop_count = 0
+    def stop(self) -> None:
+        """
+        Stop all ports.
 
-        return True
+        :return: None
+        """
+        for battery_port in self.ports:
+            battery_port.stop()
 
-    def get_battery(_port: str, _modbus_address: hex = None, _can_message_cache_callback: callable = None) -> Union[Battery, None]:
+
+def main():
+    mainloop = None
+    battery_port = None
+    supervisor = None
+
+    def exit_driver(sig, frame, code: int = 0) -> None:
         """
-        Attempts to establish a connection to the battery and returns the battery object if successful.
+        Gracefully exit the driver.
+        Handles also signal for SIGINT and SIGTERM.
 
-        :param _port: The port to connect to.
-        :param _modbus_address: The Modbus address to connect to (optional).
-        :return: The battery object if a connection is established, otherwise None.
+        :return: None
         """
-        # Try to establish communications with the battery 3 times, else exit
-        retry = 1
-        retries = 3
-        while retry <= retries:
-            logger.info("-- Testing BMS: " + str(retry) + " of " + str(retries) + " rounds")
-            # Create a new battery object that can read the battery and run connection test
-            for test in expected_bms_types:
-                # noinspection PyBroadException
-                try:
-                    if _modbus_address is not None:
-                        # Convert hex string to bytes
-                        _bms_address = bytes.fromhex(_modbus_address.replace("0x", ""))
-                    elif "address" in test:
-                        _bms_address = test["address"]
-                    else:
-                        _bms_address = None
-
-                    logger.info(
-                        "Testing " + test["bms"].__name__ + (' at address "' + bytearray_to_string(_bms_address) + '"' if _bms_address is not None else "")
-                    )
-                    batteryClass = test["bms"]
-                    baud = test["baud"] if "baud" in test else None
-                    battery: Battery = batteryClass(port=_port, baud=baud, address=_bms_address)
-                    battery.set_message_cache_callback(_can_message_cache_callback)
-                    if battery.test_connection() and battery.validate_data():
-                        logger.info("-- Connection established to " + battery.__class__.__name__)
-                        return battery
-                except KeyboardInterrupt:
-                    return None
-                except Exception:
-                    (
-                        exception_type,
-                        exception_object,
-                        exception_traceback,
-                    ) = sys.exc_info()
-                    file = exception_traceback.tb_frame.f_code.co_filename
-                    line = exception_traceback.tb_lineno
-                    logger.error("Non blocking exception occurred: " + f"{repr(exception_object)} of type {exception_type} in {file} line #{line}")
-                    # Ignore any malfunction test_function()
-                    pass
-            retry += 1
-            sleep(0.5)
-
-        return None
+        logger.info("Exit signal received, exiting gracefully...")
+
+        # Stop the main loop, if set
+        if mainloop is not None:
+            mainloop.quit()
+
+        # Stop polling, disconnect from BLE devices and stop the CanReceiverThread
+        if supervisor is not None:
+            supervisor.stop()
+        elif battery_port is not None:
+            battery_port.stop()
+
+        logger.info(f"Stopped dbus-serialbattery with exit code {code}")
+        sys.exit(code)
+
+    # Register the signal handler
+    signal.signal(signal.SIGINT, exit_driver)
+    signal.signal(signal.SIGTERM, exit_driver)
 
     def get_port() -> str:
         """
@@ -252,36 +639,6 @@ def main():
             sleep(60)
             exit_driver(None, None, 1)
 
-    def check_bms_types(supported_bms_types, type) -> None:
-        """
-        Checks if BMS_TYPE is not empty and all specified BMS types are supported.
-
-        :param supported_bms_types: List of supported BMS types.
-        :param type: The type of BMS connection (ble, can, or serial).
-        :return: None
-        """
-        # Get only BMS_TYPE that end with "_Ble"
-        if type == "ble":
-            bms_types = [type for type in BMS_TYPE if type.endswith("_Ble")]
-
-        # Get only BMS_TYPE that end with "_Can"
-        if type == "can":
-            bms_types = [type for type in BMS_TYPE if type.endswith("_Can")]
-
-        # Get only BMS_TYPE that do not end with "_Ble" or "_Can"
-        if type == "serial":
-            bms_types = [type for type in BMS_TYPE if not type.endswith("_Ble") and not type.endswith("_Can")]
-
-        if len(bms_types) > 0:
-            for bms_type in bms_types:
-                if bms_type not in [bms["bms"].__name__ for bms in supported_bms_types]:
-                    logger.error(
-                        f'ERROR >>> BMS type "{bms_type}" is not supported. Supported BMS types are: '
-                        + f"{', '.join([bms['bms'].__name__ for bms in supported_bms_types])}"
-                        + "; Disabled by default: ANT, MNB, Sinowealth"
-                    )
-                    exit_driver(None, None, 1)
-
     # read the version of Venus OS
     with open("/opt/victronenergy/version", "r") as f:
         venus_version = f.readline().strip()
@@ -296,172 +653,39 @@ def main():
     # show the version of the driver
     logger.info("dbus-serialbattery v" + str(DRIVER_VERSION))
 
-    port = get_port()
-    battery = {}
-
-    # BLUETOOTH
-    if port.endswith("_Ble"):
-        """
-        Import BLE classes only if it's a BLE port; otherwise, the driver won't start due to missing Python modules.
-        This prevents issues when using the driver exclusively with a serial connection.
-        """
-
+    # SUPERVISOR
+    # one process handles all ports passed as arguments, e.g.
+    # dbus-serialbattery.py --supervisor /dev/ttyUSB0 /dev/ttyUSB1 can0 Jkbms_Ble:C8:47:8C:12:34:56
+    if len(sys.argv) > 1 and sys.argv[1] == "--supervisor":
         if len(sys.argv) <= 2:
-            logger.error("Bluetooth address is missing in the command line arguments")
-        else:
-            ble_address = sys.argv[2]
-
-            if port == "Jkbms_Ble":
-                # noqa: F401 --> ignore flake "imported but unused" error
-                from bms.jkbms_ble import Jkbms_Ble  # noqa: F401
-
-            if port == "LltJbd_Ble":
-                # noqa: F401 --> ignore flake "imported but unused" error
-                from bms.lltjbd_ble import LltJbd_Ble  # noqa: F401
-
-            if port == "LiTime_Ble":
-                # noqa: F401 --> ignore flake "imported but unused" error
-                from bms.litime_ble import LiTime_Ble  # noqa: F401
-
-            class_ = eval(port)
-
-            # do not remove ble_ prefix, since the dbus service cannot be only numbers
-            testbms = class_("ble_" + ble_address.replace(":", "").lower(), 9600, ble_address)
-
-            if testbms.test_connection():
-                logger.info("-- Connection established to " + testbms.__class__.__name__)
-                battery[0] = testbms
-
-    # CAN
-    elif port.startswith("can") or port.startswith("vecan"):
-        """
-        Import CAN classes only if it's a CAN port; otherwise, the driver won't start due to missing Python modules.
-        This prevents issues when using the driver exclusively with a serial connection.
-        """
-        from bms.daly_can import Daly_Can
-        from bms.jkbms_can import Jkbms_Can
-
-        # only try CAN BMS on CAN port
-        supported_bms_types = [
-            {"bms": Daly_Can},
-            {"bms": Jkbms_Can},
-        ]
-
-        # check if BMS_TYPE is not empty and all BMS types in the list are supported
-        check_bms_types(supported_bms_types, "can")
+            logger.error("ERROR >>> No ports specified in the command line arguments")
+            exit_driver(None, None, 1)
 
-        expected_bms_types = [battery_type for battery_type in supported_bms_types if battery_type["bms"].__name__ in BMS_TYPE or len(BMS_TYPE) == 0]
+        # Have a mainloop, so we can send/receive asynchronous calls to and from dbus
+        DBusGMainLoop(set_as_default=True)
+        mainloop = gobject.MainLoop()
 
-        # start the corresponding CanReceiverThread if BMS for this type found
-        from utils_can import CanReceiverThread
+        supervisor = PortSupervisor(sys.argv[2:], mainloop)
+        supervisor.start()
 
-        try:
-            can_thread = CanReceiverThread.get_instance(bustype="socketcan", channel=port)
-        except Exception as e:
-            print(f"Error: {e}")
-
-        logger.debug("Wait shortly to make sure that all needed data is in the cache")
-        # Slowest message cycle trasmission is every 1 second, wait a bit more for the fist time to fetch all needed data
-        sleep(2)
-
-        # check if BATTERY_ADDRESSES is not empty
-        if BATTERY_ADDRESSES:
-            logger.info(">>> CAN multi device mode")
-            for address in BATTERY_ADDRESSES:
-                checkbatt = get_battery(port, address, can_thread.get_message_cache)
-                if checkbatt is not None:
-                    battery[address] = checkbatt
-                    logger.info("Successful battery connection at " + port + " and this device address " + str(address))
-                else:
-                    logger.warning("No battery connection at " + port + " and this device address " + str(address))
-        # use default address
-        else:
-            battery[0] = get_battery(port, None, can_thread.get_message_cache)
-
-    # SERIAL
     else:
-        # check if BMS_TYPE is not empty and all BMS types in the list are supported
-        check_bms_types(supported_bms_types, "serial")
-
-        # wait some seconds to be sure that the serial connection is ready
-        # else the error throw a lot of timeouts
-        sleep(16)
-
-        # check if BATTERY_ADDRESSES is not empty
-        if BATTERY_ADDRESSES:
-            for address in BATTERY_ADDRESSES:
-                checkbatt = get_battery(port, address)
-                if checkbatt is not None:
-                    battery[address] = checkbatt
-                    logger.info("Successful battery connection at " + port + " and this Modbus address " + str(address))
-                else:
-                    logger.warning("No battery connection at " + port + " and this Modbus address " + str(address))
-        # use default address
-        else:
-            battery[0] = get_battery(port)
-
-    # check if at least one BMS was found
-    battery_found = False
-
-    for key_address in battery:
-        if battery[key_address] is not None:
-            battery_found = True
-
-    if not battery_found:
-        logger.error(
-            "ERROR >>> No battery connection at " + port + (" and this Modbus addresses: " + ", ".join(BATTERY_ADDRESSES) if BATTERY_ADDRESSES else "")
-        )
-        exit_driver(None, None, 1)
-
-    # Have a mainloop, so we can send/receive asynchronous calls to and from dbus
-    DBusGMainLoop(set_as_default=True)
-    if sys.version_info.major == 2:
-        gobject.threads_init()
-    mainloop = gobject.MainLoop()
+        port = get_port()
 
-    # Get the initial values for the battery used by setup_vedbus
-    helper = {}
+        # for Bluetooth BMS multiple addresses can be passed
+        battery_port = BatteryPort(port, sys.argv[2:], None)
 
-    for key_address in battery:
-        helper[key_address] = DbusHelper(battery[key_address], key_address)
-        if not helper[key_address].setup_vedbus():
-            logger.error(
-                "ERROR >>> Problem with battery set up at " + port + (" and this Modbus address: " + ", ".join(BATTERY_ADDRESSES) if BATTERY_ADDRESSES else "")
-            )
+        if not battery_port.detect():
             exit_driver(None, None, 1)
 
-    # get first key from battery dict
-    first_key = list(battery.keys())[0]
-
-    # try using active callback on this battery (normally only used for Bluetooth BMS)
-    if not battery[first_key].use_callback(lambda: poll_battery(mainloop)):
-        # change poll interval if set in config
-        if POLL_INTERVAL is not None:
-            battery[first_key].poll_interval = POLL_INTERVAL
-
-        logger.info(f"Polling interval: {battery[first_key].poll_interval/1000:.3f} s")
-
-        # if not possible, poll the battery every poll_interval milliseconds
-        gobject.timeout_add(
-            battery[first_key].poll_interval,
-            lambda: poll_battery(mainloop),
-        )
+        # Have a mainloop, so we can send/receive asynchronous calls to and from dbus
+        DBusGMainLoop(set_as_default=True)
+        if sys.version_info.major == 2:
+            gobject.threads_init()
+        mainloop = gobject.MainLoop()
+        battery_port.mainloop = mainloop
 
-    # print log at this point, else not all data is correctly populated
-    for key_address in battery:
-        battery[key_address].log_settings()
-
-    # check config, if there are any invalid values trigger "settings incorrect" error
-    # and set the battery in error state to prevent chargin/discharging
-    if not validate_config_values():
-        for key_address in battery:
-            battery[key_address].state = 10
-            battery[key_address].error_code = 119
-
-    # check, if external current sensor should be used
-    if EXTERNAL_CURRENT_SENSOR_DBUS_DEVICE is not None and EXTERNAL_CURRENT_SENSOR_DBUS_PATH is not None:
-        for key_address in battery:
-            battery[key_address].setup_external_current_sensor()
+        if not battery_port.setup():
+            exit_driver(None, None, 1)
 
     # Run the main loop
     try:
@@ -469,6 +693,13 @@ def main():
     except KeyboardInterrupt:
         pass
 
+    # the main loop was stopped, since the battery failed
+    # stop polling and write the remaining changes of the charge state
+    if supervisor is not None:
+        supervisor.stop()
+    elif battery_port is not None:
+        battery_port.stop()
+
 
 if __name__ == "__main__":
     main()
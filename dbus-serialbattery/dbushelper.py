@@ -4,9 +4,19 @@ import os
 import platform
 import dbus
 import traceback
-from time import sleep, time
+from time import sleep
+from typing import Callable, List, Tuple, Union
 from utils import logger, publish_config_variables
 import utils
+import utils_clock
+from utils_clock import now, time, wall_time
+from utils_dbus import get_bus, get_object, get_setting_value, has_service
+from utils_persist import SettingsWriteBehind
+from utils_history import HistoryTracker
+from utils_profile import LoadProfile
+from utils_recorder import Recorder
+from utils_publish import PathPublisher
+from utils_stats import POWER_AVERAGE_WINDOWS
 from xml.etree import ElementTree
 import requests
 import threading
@@ -18,20 +28,6 @@ from ve_utils import get_vrm_portal_id  # noqa: E402
 from settingsdevice import SettingsDevice  # noqa: E402
 
 
-class SystemBus(dbus.bus.BusConnection):
-    def __new__(cls):
-        return dbus.bus.BusConnection.__new__(cls, dbus.bus.BusConnection.TYPE_SYSTEM)
-
-
-class SessionBus(dbus.bus.BusConnection):
-    def __new__(cls):
-        return dbus.bus.BusConnection.__new__(cls, dbus.bus.BusConnection.TYPE_SESSION)
-
-
-def get_bus() -> dbus.bus.BusConnection:
-    return SessionBus() if "DBUS_SESSION_BUS_ADDRESS" in os.environ else SystemBus()
-
-
 class DbusHelper:
     """
     This class is used to handle all the dbus communication.
@@ -39,6 +35,29 @@ class DbusHelper:
 
     EMPTY_DICT = {}
 
+    HISTORY_PATHS: List[Tuple[str, str]] = [
+        ("/History/DeepestDischarge", "deepest_discharge"),
+        ("/History/LastDischarge", "last_discharge"),
+        ("/History/AverageDischarge", "average_discharge"),
+        ("/History/ChargeCycles", "charge_cycles"),
+        ("/History/FullDischarges", "full_discharges"),
+        ("/History/TotalAhDrawn", "total_ah_drawn"),
+        ("/History/MinimumVoltage", "minimum_voltage"),
+        ("/History/MaximumVoltage", "maximum_voltage"),
+        ("/History/MinimumCellVoltage", "minimum_cell_voltage"),
+        ("/History/MaximumCellVoltage", "maximum_cell_voltage"),
+        ("/History/TimeSinceLastFullCharge", "time_since_last_full_charge"),
+        ("/History/LowVoltageAlarms", "low_voltage_alarms"),
+        ("/History/HighVoltageAlarms", "high_voltage_alarms"),
+        ("/History/MinimumTemperature", "minimum_temperature"),
+        ("/History/MaximumTemperature", "maximum_temperature"),
+        ("/History/DischargedEnergy", "discharged_energy"),
+        ("/History/ChargedEnergy", "charged_energy"),
+    ]
+    """
+    The dbus paths of the history and the attribute names in `History`
+    """
+
     def __init__(self, battery, bms_address=None):
         self.battery = battery
         self.instance = 1
@@ -50,19 +69,25 @@ class DbusHelper:
             + self.battery.port[self.battery.port.rfind("/") + 1 :]
             + ("__" + str(bms_address) if bms_address is not None and bms_address != 0 else "")
         )
-        self._dbusservice = VeDbusService(self._dbusname, get_bus(), register=False)
+        self._dbusservice = VeDbusService(self._dbusname, get_bus(private=True), register=False)
+        self.publisher = PathPublisher(self._dbusservice)
         self.bms_id = "".join(
             # remove all non alphanumeric characters except underscore from the identifier
             c if c.isalnum() else "_"
             for c in self.battery.unique_identifier()
         )
         self.path_battery = None
-        self.save_charge_details_last = {
-            "allow_max_voltage": self.battery.allow_max_voltage,
-            "max_voltage_start_time": self.battery.max_voltage_start_time,
-            "soc_reset_last_reached": self.battery.soc_reset_last_reached,
-            "soc_calc": (self.battery.soc_calc if self.battery.soc_calc is not None else ""),
-        }
+        self.persistence: Union[SettingsWriteBehind, None] = None
+        self.load_profile: Union[LoadProfile, None] = None
+        self.history_tracker: Union[HistoryTracker, None] = None
+        self.recorder: Union[Recorder, None] = None
+        self.cell_paths: List[Tuple[str, Union[str, None]]] = []
+        """
+        Table with the dbus paths (voltage, balancing or None) per cell, created in `setup_vedbus()`
+        """
+        self.cell_sum_path: Union[str, None] = None
+        self.cell_diff_path: Union[str, None] = None
+        self.cell_publish_last: float = 0
         self.telemetry_upload_error_count: int = 0
         self.telemetry_upload_interval: int = 60 * 60 * 24 * 7  # 1 week
         self.telemetry_upload_last: int = 0
@@ -392,6 +417,23 @@ class DbusHelper:
 
         self.settings.addSettings(settings)
         self.battery.role, self.instance = self.get_role_instance()
+
+        # the charge state is written behind by the main loop, to not block the poll loop and to reduce flash wear
+        self.persistence = SettingsWriteBehind(self.path_battery, error_callback=lambda: self.battery.manage_error_code(8))
+        self.persistence.start(
+            {setting_name: settings[setting_name][1] for setting_name in ("AllowMaxVoltage", "MaxVoltageStartTime", "SocCalc", "SocResetLastReached")}
+        )
+
+        # fills the history values that the BMS does not provide
+        self.history_tracker = HistoryTracker(os.path.join(utils.DATA_PATH, f"history_{self.bms_id}.bin"))
+
+        if utils.RECORDER_SIZE > 0:
+            self.recorder = Recorder(os.path.join(utils.DATA_PATH, f"recording_{self.bms_id}.bin"))
+            if not self.recorder.open():
+                self.recorder = None
+
+        if utils.TIME_TO_SOC_LOAD_PROFILE:
+            self.load_profile = LoadProfile(os.path.join(utils.DATA_PATH, f"load_profile_{self.bms_id}.bin"))
         logger.info(f"Use DeviceInstance: {self.instance}")
 
         logger.debug(f"Found DeviceInstances: {device_instances_used}")
@@ -596,23 +638,8 @@ class DbusHelper:
         )
         self._dbusservice.add_path("/System/MinVoltageCellId", None, writeable=True)
 
-        self._dbusservice.add_path("/History/DeepestDischarge", None, writeable=True)
-        self._dbusservice.add_path("/History/LastDischarge", None, writeable=True)
-        self._dbusservice.add_path("/History/AverageDischarge", None, writeable=True)
-        self._dbusservice.add_path("/History/ChargeCycles", None, writeable=True)
-        self._dbusservice.add_path("/History/FullDischarges", None, writeable=True)
-        self._dbusservice.add_path("/History/TotalAhDrawn", None, writeable=True)
-        self._dbusservice.add_path("/History/MinimumVoltage", None, writeable=True)
-        self._dbusservice.add_path("/History/MaximumVoltage", None, writeable=True)
-        self._dbusservice.add_path("/History/MinimumCellVoltage", None, writeable=True)
-        self._dbusservice.add_path("/History/MaximumCellVoltage", None, writeable=True)
-        self._dbusservice.add_path("/History/TimeSinceLastFullCharge", None, writeable=True)
-        self._dbusservice.add_path("/History/LowVoltageAlarms", None, writeable=True)
-        self._dbusservice.add_path("/History/HighVoltageAlarms", None, writeable=True)
-        self._dbusservice.add_path("/History/MinimumTemperature", None, writeable=True)
-        self._dbusservice.add_path("/History/MaximumTemperature", None, writeable=True)
-        self._dbusservice.add_path("/History/DischargedEnergy", None, writeable=True)
-        self._dbusservice.add_path("/History/ChargedEnergy", None, writeable=True)
+        for path, _ in self.HISTORY_PATHS:
+            self._dbusservice.add_path(path, None, writeable=True)
 
         self._dbusservice.add_path("/Balancing", None, writeable=True)
         self._dbusservice.add_path("/Io/AllowToCharge", 0, writeable=True)
@@ -622,19 +649,19 @@ class DbusHelper:
             "/Io/ForceChargingOff",
             (0 if "force_charging_off_callback" in self.battery.available_callbacks else None),
             writeable=True,
-            onchangecallback=self.battery.force_charging_off_callback,
+            onchangecallback=self.between_polls(self.battery.force_charging_off_callback),
         )
         self._dbusservice.add_path(
             "/Io/ForceDischargingOff",
             (0 if "force_discharging_off_callback" in self.battery.available_callbacks else None),
             writeable=True,
-            onchangecallback=self.battery.force_discharging_off_callback,
+            onchangecallback=self.between_polls(self.battery.force_discharging_off_callback),
         )
         self._dbusservice.add_path(
             "/Io/TurnBalancingOff",
             (0 if "turn_balancing_off_callback" in self.battery.available_callbacks else None),
             writeable=True,
-            onchangecallback=self.battery.turn_balancing_off_callback,
+            onchangecallback=self.between_polls(self.battery.turn_balancing_off_callback),
         )
         # self._dbusservice.add_path('/SystemSwitch', 1, writeable=True)
 
@@ -658,30 +685,45 @@ class DbusHelper:
 
         # cell voltages
         if utils.BATTERY_CELL_DATA_FORMAT > 0:
-            for i in range(1, self.battery.cell_count + 1):
-                cellpath = "/Cell/%s/Volts" if (utils.BATTERY_CELL_DATA_FORMAT & 2) else "/Voltages/Cell%s"
+            # build the paths once, they are used on every publish
+            cellpath = "/Cell/%s/Volts" if (utils.BATTERY_CELL_DATA_FORMAT & 2) else "/Voltages/Cell%s"
+            self.cell_paths = [
+                (cellpath % (str(i)), "/Balances/Cell%s" % (str(i)) if (utils.BATTERY_CELL_DATA_FORMAT & 1) else None)
+                for i in range(1, self.battery.cell_count + 1)
+            ]
+            for voltage_path, balance_path in self.cell_paths:
                 self._dbusservice.add_path(
-                    cellpath % (str(i)),
+                    voltage_path,
                     None,
                     writeable=True,
                     gettextcallback=lambda p, v: "{:0.3f}V".format(v),
                 )
-                if utils.BATTERY_CELL_DATA_FORMAT & 1:
-                    self._dbusservice.add_path("/Balances/Cell%s" % (str(i)), None, writeable=True)
+                if balance_path is not None:
+                    self._dbusservice.add_path(balance_path, None, writeable=True)
             pathbase = "Cell" if (utils.BATTERY_CELL_DATA_FORMAT & 2) else "Voltages"
+            self.cell_sum_path = "/%s/Sum" % pathbase
+            self.cell_diff_path = "/%s/Diff" % pathbase
             self._dbusservice.add_path(
-                "/%s/Sum" % pathbase,
+                self.cell_sum_path,
                 None,
                 writeable=True,
                 gettextcallback=lambda p, v: "{:2.2f}V".format(v),
             )
             self._dbusservice.add_path(
-                "/%s/Diff" % pathbase,
+                self.cell_diff_path,
                 None,
                 writeable=True,
                 gettextcallback=lambda p, v: "{:0.3f}V".format(v),
             )
 
+        for name, _, _ in POWER_AVERAGE_WINDOWS:
+            self._dbusservice.add_path(
+                "/Statistics/PowerAvg/" + name,
+                None,
+                writeable=True,
+                gettextcallback=lambda p, v: "{:0.0f}W".format(v),
+            )
+
         self._dbusservice.add_path("/TimeToGo", None, writeable=True)
         self._dbusservice.add_path(
             "/CurrentAvg",
@@ -695,6 +737,25 @@ class DbusHelper:
             for num in utils.TIME_TO_SOC_POINTS:
                 self._dbusservice.add_path("/TimeToSoC/" + str(num), None, writeable=True)
 
+        # link quality metrics of wireless connections
+        for key in self.battery.get_link_metrics():
+            self._dbusservice.add_path("/Link/" + key, None, writeable=True)
+
+        # poll statistics, calculated by the poll thread
+        self._dbusservice.add_path(
+            "/Poll/Interval",
+            None,
+            writeable=True,
+            gettextcallback=lambda p, v: "{:0.3f}s".format(v),
+        )
+        for percentile in ("P50", "P95", "P99"):
+            self._dbusservice.add_path(
+                "/Poll/Latency/" + percentile,
+                None,
+                writeable=True,
+                gettextcallback=lambda p, v: "{:0.3f}s".format(v),
+            )
+
         logger.debug(f"Publish config values: {utils.PUBLISH_CONFIG_VALUES}")
         if utils.PUBLISH_CONFIG_VALUES:
             publish_config_variables(self._dbusservice)
@@ -705,7 +766,7 @@ class DbusHelper:
                 "/Settings/ResetSoc",
                 0,
                 writeable=True,
-                onchangecallback=self.battery.reset_soc_callback,
+                onchangecallback=self.between_polls(self.battery.reset_soc_callback),
             )
 
         # register VeDbusService after all paths where added
@@ -715,16 +776,61 @@ class DbusHelper:
 
         return True
 
-    def publish_battery(self, loop) -> None:
+    def unregister_vedbus(self) -> None:
+        """
+        Removes the dbus service of the battery and releases the pid file,
+        e.g. if the port of the battery is restarted by the supervisor.
+
+        :return: None
+        """
+        # write the remaining changes of the charge state
+        if self.persistence is not None:
+            self.persistence.stop()
+            self.persistence = None
+
+        if self.load_profile is not None:
+            self.load_profile.save()
+
+        if self.history_tracker is not None:
+            self.history_tracker.save()
+
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+        self._dbusservice.__del__()
+
+        if getattr(self, "pid_file", None) is not None:
+            self.pid_file.close()
+            self.pid_file = None
+
+    def publish_battery(self, loop, snapshot=None) -> None:
         """
         Publishes the battery data to dbus.
         This is called every battery.poll_interval milli second as set up per battery type to read and update the data
 
-        :param loop: The main loop of the driver.
+        :param loop: The main loop of the driver or the port of the supervisor, `quit()` is called if the battery failed.
+        :param snapshot: The `BatterySnapshot` of the poll thread, if `refresh_data()` was already called there.
+            If None, `refresh_data()` is called here.
         """
         try:
-            # Call the battery's refresh_data function
-            result = self.battery.refresh_data()
+            # sample the clock once, so that all decisions of this cycle are based on the same time
+            utils_clock.tick()
+
+            if snapshot is None:
+                # Call the battery's refresh_data function
+                self.battery.metrics = None
+                result = self.battery.refresh_data()
+                self.battery.update_metrics()
+            else:
+                # refresh_data raised an exception in the poll thread
+                if snapshot.exception is not None:
+                    logger.error(snapshot.exception)
+                    loop.quit()
+                    return
+
+                result = snapshot.result
+
             if result:
                 # reset error variables
                 self.error["count"] = 0
@@ -742,9 +848,9 @@ class DbusHelper:
             else:
                 # update error variables
                 if self.error["count"] == 0:
-                    self.error["timestamp_first"] = int(time())
+                    self.error["timestamp_first"] = int(now())
 
-                self.error["timestamp_last"] = int(time())
+                self.error["timestamp_last"] = int(now())
                 self.error["count"] += 1
 
                 time_since_first_error = self.error["timestamp_last"] - self.error["timestamp_first"]
@@ -796,12 +902,12 @@ class DbusHelper:
             # Check if external current sensor is still connected
             if utils.EXTERNAL_CURRENT_SENSOR_DBUS_DEVICE is not None and utils.EXTERNAL_CURRENT_SENSOR_DBUS_PATH is not None:
                 # Check if external current sensor was and is still connected
-                if self.battery.dbus_external_objects is not None and utils.EXTERNAL_CURRENT_SENSOR_DBUS_DEVICE not in get_bus().list_names():
+                if self.battery.dbus_external_objects is not None and not has_service(utils.EXTERNAL_CURRENT_SENSOR_DBUS_DEVICE):
                     logger.error("External current sensor was disconnected, falling back to internal sensor")
                     self.battery.dbus_external_objects = None
 
                 # Check if external current sensor was not connected and is now connected
-                elif self.battery.dbus_external_objects is None and utils.EXTERNAL_CURRENT_SENSOR_DBUS_DEVICE in get_bus().list_names():
+                elif self.battery.dbus_external_objects is None and has_service(utils.EXTERNAL_CURRENT_SENSOR_DBUS_DEVICE):
                     logger.info("External current sensor was connected, switching to external sensor")
                     self.battery.setup_external_current_sensor()
 
@@ -813,11 +919,11 @@ class DbusHelper:
 
             # Manage battery error code reset
             # Check if the error code should be reset every hour
-            if self.battery.error_code_last_reset_check < int(time()) - 3600:
+            if self.battery.error_code_last_reset_check < now() - 3600:
                 # Check if the error code should be reset
                 self.battery.manage_error_code_reset()
                 # Update the last check time
-                self.battery.error_code_last_reset_check = int(time())
+                self.battery.error_code_last_reset_check = now()
 
             # Manage battery state, if not set to error (10)
             # change state from initializing to running, if there is no error
@@ -832,8 +938,20 @@ class DbusHelper:
             if self.battery.state == 14 and (self.battery.get_allow_to_charge() or self.battery.get_allow_to_discharge()):
                 self.battery.state = 9
 
-            # publish all the data from the battery object to dbus
-            self.publish_dbus()
+            # publish all the data from the battery object to dbus in one ItemsChanged signal
+            with self.publisher.batch():
+                self.publish_dbus()
+
+                # publish the poll statistics of the poll thread
+                if snapshot is not None:
+                    self.publisher["/Poll/Interval"] = round(snapshot.poll_interval / 1000, 3)
+                    self.publisher["/Poll/Latency/P50"] = round(snapshot.latency_p50, 3)
+                    self.publisher["/Poll/Latency/P95"] = round(snapshot.latency_p95, 3)
+                    self.publisher["/Poll/Latency/P99"] = round(snapshot.latency_p99, 3)
+
+            # record the data of this poll, after the limits were calculated
+            if self.recorder is not None:
+                self.recorder.record(self.battery, wall_time())
 
             # upload telemetry data
             self.telemetry_upload()
@@ -845,142 +963,143 @@ class DbusHelper:
     def publish_dbus(self) -> None:
         """
         Publishes the battery data to dbus and refresh it.
+        Only values that changed more than the deadband of their path are sent, see `PathPublisher`.
         """
-        self._dbusservice["/System/NrOfCellsPerBattery"] = self.battery.cell_count
+        self.publisher["/System/NrOfCellsPerBattery"] = self.battery.cell_count
         if utils.SOC_CALCULATION:
-            self._dbusservice["/Soc"] = round(self.battery.soc_calc, 2) if self.battery.soc_calc is not None else None
+            self.publisher["/Soc"] = round(self.battery.soc_calc, 2) if self.battery.soc_calc is not None else None
             # add original SOC for comparing
-            self._dbusservice["/SocBms"] = round(self.battery.soc, 2) if self.battery.soc is not None else None
+            self.publisher["/SocBms"] = round(self.battery.soc, 2) if self.battery.soc is not None else None
         else:
-            self._dbusservice["/Soc"] = round(self.battery.soc, 2) if self.battery.soc is not None else None
-        self._dbusservice["/Dc/0/Voltage"] = round(self.battery.voltage, 2) if self.battery.voltage is not None else None
-        self._dbusservice["/Dc/0/Current"] = round(self.battery.get_current(), 2) if self.battery.get_current() is not None else None
-        self._dbusservice["/Dc/0/Power"] = (
-            round(self.battery.voltage * self.battery.get_current(), 2)
-            if self.battery.get_current() is not None and self.battery.get_current() is not None
-            else None
-        )
-        self._dbusservice["/Dc/0/Temperature"] = self.battery.get_temp()
-        self._dbusservice["/Capacity"] = self.battery.get_capacity_remain()
-        self._dbusservice["/ConsumedAmphours"] = (
-            None if self.battery.capacity is None or self.battery.get_capacity_remain() is None else self.battery.capacity - self.battery.get_capacity_remain()
-        )
+            self.publisher["/Soc"] = round(self.battery.soc, 2) if self.battery.soc is not None else None
+        # calculate only once per cycle
+        current = self.battery.get_current()
+        capacity_remain = self.battery.get_capacity_remain()
+
+        self.publisher["/Dc/0/Voltage"] = round(self.battery.voltage, 2) if self.battery.voltage is not None else None
+        self.publisher["/Dc/0/Current"] = round(current, 2) if current is not None else None
+        self.publisher["/Dc/0/Power"] = round(self.battery.voltage * current, 2) if self.battery.voltage is not None and current is not None else None
+        self.publisher["/Dc/0/Temperature"] = self.battery.get_temp()
+        self.publisher["/Capacity"] = capacity_remain
+        self.publisher["/ConsumedAmphours"] = None if self.battery.capacity is None or capacity_remain is None else self.battery.capacity - capacity_remain
 
         midpoint, deviation = self.battery.get_midvoltage()
         if midpoint is not None:
-            self._dbusservice["/Dc/0/MidVoltage"] = midpoint
-            self._dbusservice["/Dc/0/MidVoltageDeviation"] = deviation
+            self.publisher["/Dc/0/MidVoltage"] = midpoint
+            self.publisher["/Dc/0/MidVoltageDeviation"] = deviation
 
         # Update battery extras
-        self._dbusservice["/State"] = self.battery.state
+        self.publisher["/State"] = self.battery.state
         # https://github.com/victronenergy/veutil/blob/master/inc/veutil/ve_regs_payload.h
         # https://github.com/victronenergy/veutil/blob/master/src/qt/bms_error.cpp
-        self._dbusservice["/ErrorCode"] = self.battery.error_code
-        self._dbusservice["/ConnectionInformation"] = self.battery.connection_info
-
-        self._dbusservice["/History/DeepestDischarge"] = self.battery.history.deepest_discharge
-        self._dbusservice["/History/LastDischarge"] = self.battery.history.last_discharge
-        self._dbusservice["/History/AverageDischarge"] = self.battery.history.average_discharge
-        self._dbusservice["/History/ChargeCycles"] = self.battery.history.charge_cycles
-        self._dbusservice["/History/FullDischarges"] = self.battery.history.full_discharges
-        self._dbusservice["/History/TotalAhDrawn"] = self.battery.history.total_ah_drawn
-        self._dbusservice["/History/MinimumVoltage"] = self.battery.history.minimum_voltage
-        self._dbusservice["/History/MaximumVoltage"] = self.battery.history.maximum_voltage
-        self._dbusservice["/History/MinimumCellVoltage"] = self.battery.history.minimum_cell_voltage
-        self._dbusservice["/History/MaximumCellVoltage"] = self.battery.history.maximum_cell_voltage
-        self._dbusservice["/History/TimeSinceLastFullCharge"] = self.battery.history.time_since_last_full_charge
-        self._dbusservice["/History/LowVoltageAlarms"] = self.battery.history.low_voltage_alarms
-        self._dbusservice["/History/HighVoltageAlarms"] = self.battery.history.high_voltage_alarms
-        self._dbusservice["/History/DischargedEnergy"] = self.battery.history.discharged_energy
-        self._dbusservice["/History/ChargedEnergy"] = self.battery.history.charged_energy
-
-        self._dbusservice["/Io/AllowToCharge"] = 1 if self.battery.get_allow_to_charge() else 0
-        self._dbusservice["/Io/AllowToDischarge"] = 1 if self.battery.get_allow_to_discharge() else 0
-        self._dbusservice["/Io/AllowToBalance"] = 1 if self.battery.get_allow_to_balance() else 0
-        self._dbusservice["/System/NrOfModulesBlockingCharge"] = 0 if self.battery.get_allow_to_charge() else 1
-        self._dbusservice["/System/NrOfModulesBlockingDischarge"] = 0 if self.battery.get_allow_to_discharge() else 1
-        self._dbusservice["/System/NrOfModulesOnline"] = 1 if self.battery.online else 0
-        self._dbusservice["/System/NrOfModulesOffline"] = 0 if self.battery.online else 1
-        self._dbusservice["/System/MinCellTemperature"] = self.battery.get_min_temp()
-        self._dbusservice["/System/MinTemperatureCellId"] = self.battery.get_min_temp_id()
-        self._dbusservice["/System/MaxCellTemperature"] = self.battery.get_max_temp()
-        self._dbusservice["/System/MaxTemperatureCellId"] = self.battery.get_max_temp_id()
-        self._dbusservice["/System/MOSTemperature"] = self.battery.get_mos_temp()
-        self._dbusservice["/System/Temperature1"] = self.battery.temp1
-        self._dbusservice["/System/Temperature1Name"] = utils.TEMP_1_NAME
-        self._dbusservice["/System/Temperature2"] = self.battery.temp2
-        self._dbusservice["/System/Temperature2Name"] = utils.TEMP_2_NAME
-        self._dbusservice["/System/Temperature3"] = self.battery.temp3
-        self._dbusservice["/System/Temperature3Name"] = utils.TEMP_3_NAME
-        self._dbusservice["/System/Temperature4"] = self.battery.temp4
-        self._dbusservice["/System/Temperature4Name"] = utils.TEMP_4_NAME
+        self.publisher["/ErrorCode"] = self.battery.error_code
+        self.publisher["/ConnectionInformation"] = self.battery.connection_info
+
+        # the values of the BMS have priority, missing values are filled by the history tracker
+        if self.history_tracker is not None:
+            self.history_tracker.update(self.battery)
+
+        for path, field in self.HISTORY_PATHS:
+            value = getattr(self.battery.history, field)
+            if value is None and self.history_tracker is not None:
+                value = self.history_tracker.get_value(field)
+            self.publisher[path] = value
+
+        self.publisher["/Io/AllowToCharge"] = 1 if self.battery.get_allow_to_charge() else 0
+        self.publisher["/Io/AllowToDischarge"] = 1 if self.battery.get_allow_to_discharge() else 0
+        self.publisher["/Io/AllowToBalance"] = 1 if self.battery.get_allow_to_balance() else 0
+        self.publisher["/System/NrOfModulesBlockingCharge"] = 0 if self.battery.get_allow_to_charge() else 1
+        self.publisher["/System/NrOfModulesBlockingDischarge"] = 0 if self.battery.get_allow_to_discharge() else 1
+        self.publisher["/System/NrOfModulesOnline"] = 1 if self.battery.online else 0
+        self.publisher["/System/NrOfModulesOffline"] = 0 if self.battery.online else 1
+        self.publisher["/System/MinCellTemperature"] = self.battery.get_min_temp()
+        self.publisher["/System/MinTemperatureCellId"] = self.battery.get_min_temp_id()
+        self.publisher["/System/MaxCellTemperature"] = self.battery.get_max_temp()
+        self.publisher["/System/MaxTemperatureCellId"] = self.battery.get_max_temp_id()
+        self.publisher["/System/MOSTemperature"] = self.battery.get_mos_temp()
+        self.publisher["/System/Temperature1"] = self.battery.temp1
+        self.publisher["/System/Temperature1Name"] = utils.TEMP_1_NAME
+        self.publisher["/System/Temperature2"] = self.battery.temp2
+        self.publisher["/System/Temperature2Name"] = utils.TEMP_2_NAME
+        self.publisher["/System/Temperature3"] = self.battery.temp3
+        self.publisher["/System/Temperature3Name"] = utils.TEMP_3_NAME
+        self.publisher["/System/Temperature4"] = self.battery.temp4
+        self.publisher["/System/Temperature4Name"] = utils.TEMP_4_NAME
 
         # Voltage control
-        self._dbusservice["/Info/MaxChargeVoltage"] = (
+        self.publisher["/Info/MaxChargeVoltage"] = (
             round(self.battery.control_voltage + utils.VOLTAGE_DROP, 2) if self.battery.control_voltage is not None else None
         )
 
         # Charge control
-        self._dbusservice["/Info/MaxChargeCurrent"] = self.battery.control_charge_current
-        self._dbusservice["/Info/MaxDischargeCurrent"] = self.battery.control_discharge_current
+        self.publisher["/Info/MaxChargeCurrent"] = self.battery.control_charge_current
+        self.publisher["/Info/MaxDischargeCurrent"] = self.battery.control_discharge_current
 
         # Voltage and charge control info (custom dbus paths)
-        self._dbusservice["/Info/ChargeMode"] = self.battery.charge_mode
-        self._dbusservice["/Info/ChargeModeDebug"] = self.battery.charge_mode_debug
-        self._dbusservice["/Info/ChargeModeDebugFloat"] = self.battery.charge_mode_debug_float
-        self._dbusservice["/Info/ChargeModeDebugBulk"] = self.battery.charge_mode_debug_bulk
-        self._dbusservice["/Info/ChargeLimitation"] = self.battery.charge_limitation
-        self._dbusservice["/Info/DischargeLimitation"] = self.battery.discharge_limitation
+        self.publisher["/Info/ChargeMode"] = self.battery.charge_mode
+        self.publisher["/Info/ChargeModeDebug"] = self.battery.charge_mode_debug
+        self.publisher["/Info/ChargeModeDebugFloat"] = self.battery.charge_mode_debug_float
+        self.publisher["/Info/ChargeModeDebugBulk"] = self.battery.charge_mode_debug_bulk
+        self.publisher["/Info/ChargeLimitation"] = self.battery.charge_limitation
+        self.publisher["/Info/DischargeLimitation"] = self.battery.discharge_limitation
 
         # Updates from cells
-        self._dbusservice["/System/MinVoltageCellId"] = self.battery.get_min_cell_desc()
-        self._dbusservice["/System/MaxVoltageCellId"] = self.battery.get_max_cell_desc()
-        self._dbusservice["/System/MinCellVoltage"] = self.battery.get_min_cell_voltage()
-        self._dbusservice["/System/MaxCellVoltage"] = self.battery.get_max_cell_voltage()
-        self._dbusservice["/Balancing"] = self.battery.get_balancing()
+        self.publisher["/System/MinVoltageCellId"] = self.battery.get_min_cell_desc()
+        self.publisher["/System/MaxVoltageCellId"] = self.battery.get_max_cell_desc()
+        self.publisher["/System/MinCellVoltage"] = self.battery.get_min_cell_voltage()
+        self.publisher["/System/MaxCellVoltage"] = self.battery.get_max_cell_voltage()
+        self.publisher["/Balancing"] = self.battery.get_balancing()
 
         # Update the alarms
-        self._dbusservice["/Alarms/LowVoltage"] = self.battery.protection.low_voltage
-        self._dbusservice["/Alarms/LowCellVoltage"] = self.battery.protection.low_cell_voltage
+        self.publisher["/Alarms/LowVoltage"] = self.battery.protection.low_voltage
+        self.publisher["/Alarms/LowCellVoltage"] = self.battery.protection.low_cell_voltage
         # disable high voltage warning temporarly, if loading to bulk voltage and bulk voltage reached is 30 minutes ago
-        self._dbusservice["/Alarms/HighVoltage"] = (
+        self.publisher["/Alarms/HighVoltage"] = (
             self.battery.protection.high_voltage
-            if (self.battery.soc_reset_requested is False and self.battery.soc_reset_last_reached < int(time()) - (60 * 30))
+            if (self.battery.soc_reset_requested is False and self.battery.soc_reset_last_reached < int(wall_time()) - (60 * 30))
             else 0
         )
-        self._dbusservice["/Alarms/HighCellVoltage"] = (
+        self.publisher["/Alarms/HighCellVoltage"] = (
             self.battery.protection.high_cell_voltage
-            if (self.battery.soc_reset_requested is False and self.battery.soc_reset_last_reached < int(time()) - (60 * 30))
+            if (self.battery.soc_reset_requested is False and self.battery.soc_reset_last_reached < int(wall_time()) - (60 * 30))
             else 0
         )
-        self._dbusservice["/Alarms/LowSoc"] = self.battery.protection.low_soc
-        self._dbusservice["/Alarms/HighChargeCurrent"] = self.battery.protection.high_charge_current
-        self._dbusservice["/Alarms/HighDischargeCurrent"] = self.battery.protection.high_discharge_current
-        self._dbusservice["/Alarms/CellImbalance"] = self.battery.protection.cell_imbalance
-        self._dbusservice["/Alarms/InternalFailure"] = self.battery.protection.internal_failure
-        self._dbusservice["/Alarms/HighChargeTemperature"] = self.battery.protection.high_charge_temp
-        self._dbusservice["/Alarms/LowChargeTemperature"] = self.battery.protection.low_charge_temp
-        self._dbusservice["/Alarms/HighTemperature"] = self.battery.protection.high_temperature
-        self._dbusservice["/Alarms/LowTemperature"] = self.battery.protection.low_temperature
-        self._dbusservice["/Alarms/BmsCable"] = 2 if self.battery.block_because_disconnect else 0
-        self._dbusservice["/Alarms/HighInternalTemperature"] = self.battery.protection.high_internal_temp
-        self._dbusservice["/Alarms/FuseBlown"] = self.battery.protection.fuse_blown
+        self.publisher["/Alarms/LowSoc"] = self.battery.protection.low_soc
+        self.publisher["/Alarms/HighChargeCurrent"] = self.battery.protection.high_charge_current
+        self.publisher["/Alarms/HighDischargeCurrent"] = self.battery.protection.high_discharge_current
+        self.publisher["/Alarms/CellImbalance"] = self.battery.protection.cell_imbalance
+        self.publisher["/Alarms/InternalFailure"] = self.battery.protection.internal_failure
+        self.publisher["/Alarms/HighChargeTemperature"] = self.battery.protection.high_charge_temp
+        self.publisher["/Alarms/LowChargeTemperature"] = self.battery.protection.low_charge_temp
+        self.publisher["/Alarms/HighTemperature"] = self.battery.protection.high_temperature
+        self.publisher["/Alarms/LowTemperature"] = self.battery.protection.low_temperature
+        self.publisher["/Alarms/BmsCable"] = 2 if self.battery.block_because_disconnect else 0
+        self.publisher["/Alarms/HighInternalTemperature"] = self.battery.protection.high_internal_temp
+        self.publisher["/Alarms/FuseBlown"] = self.battery.protection.fuse_blown
 
         # cell voltages
-        if utils.BATTERY_CELL_DATA_FORMAT > 0:
+        # published every PUBLISH_CELL_INTERVAL seconds, so that many cells do not dominate the publish cost
+        if self.cell_paths and now() - self.cell_publish_last >= utils.PUBLISH_CELL_INTERVAL:
+            self.cell_publish_last = now()
             try:
+                cells = self.battery.cells
+                cell_count = min(len(cells), self.battery.cell_count)
                 voltage_sum = 0
-                for i in range(self.battery.cell_count):
-                    voltage = self.battery.get_cell_voltage(i)
-                    cellpath = "/Cell/%s/Volts" if (utils.BATTERY_CELL_DATA_FORMAT & 2) else "/Voltages/Cell%s"
-                    self._dbusservice[cellpath % (str(i + 1))] = voltage
-                    if utils.BATTERY_CELL_DATA_FORMAT & 1:
-                        self._dbusservice["/Balances/Cell%s" % (str(i + 1))] = self.battery.get_cell_balancing(i)
+                for i, (voltage_path, balance_path) in enumerate(self.cell_paths):
+                    if i < cell_count:
+                        # read the columns of the cell array directly, without the compatibility views
+                        voltage = cells.get_voltage(i)
+                        balance = 1 if cells.get_balance(i) else 0
+                    else:
+                        voltage = None
+                        balance = None
+                    self.publisher[voltage_path] = voltage
+                    if balance_path is not None:
+                        self.publisher[balance_path] = balance
                     if voltage:
                         voltage_sum += voltage
-                pathbase = "Cell" if (utils.BATTERY_CELL_DATA_FORMAT & 2) else "Voltages"
-                self._dbusservice["/%s/Sum" % pathbase] = round(voltage_sum, 2)
-                self._dbusservice["/%s/Diff" % pathbase] = round(
+                self.publisher[self.cell_sum_path] = round(voltage_sum, 2)
+                self.publisher[self.cell_diff_path] = round(
                     self.battery.get_max_cell_voltage() - self.battery.get_min_cell_voltage(),
                     3,
                 )
@@ -994,20 +1113,26 @@ class DbusHelper:
                 logger.error("Non blocking exception occurred: " + f"{repr(exception_object)} of type {exception_type} in {file} line #{line}")
 
         # Calculate average current for the last 300 cycles
-        if self.battery.get_current() is not None:
-            self.battery.current_avg_lst.append(self.battery.get_current())
-            # delete oldest value
-            if len(self.battery.current_avg_lst) > 300:
-                del self.battery.current_avg_lst[0]
-
-            self.battery.current_avg = round(
-                sum(self.battery.current_avg_lst) / len(self.battery.current_avg_lst),
-                2,
-            )
+        if current is not None:
+            self.battery.current_avg_window.add(current)
+            self.battery.current_avg = round(self.battery.current_avg_window.mean, 2)
         else:
             self.battery.current_avg = None
 
-        self._dbusservice["/CurrentAvg"] = self.battery.current_avg
+        self.publisher["/CurrentAvg"] = self.battery.current_avg
+
+        # average power over the last minute, 5 minutes and hour, each add is O(1)
+        power = self.battery.voltage * current if self.battery.voltage is not None and current is not None else None
+        for name, power_avg in self.battery.power_avg.items():
+            if power is not None:
+                power_avg.add(power)
+            else:
+                power_avg.expire(now())
+            self.publisher["/Statistics/PowerAvg/" + name] = round(power_avg.mean, 2) if power_avg.mean is not None else None
+
+        # learn the load profile from every sample, the estimate below only reads the precomputed sums
+        if self.load_profile is not None and current is not None:
+            self.load_profile.add(current, wall_time())
 
         # Update TimeToGo and/or TimeToSoC
         try:
@@ -1016,48 +1141,32 @@ class DbusHelper:
             if (
                 self.battery.capacity is not None
                 and (utils.TIME_TO_GO_ENABLE or len(utils.TIME_TO_SOC_POINTS) > 0)
-                and (int(time()) - self.battery.time_to_soc_update >= utils.TIME_TO_SOC_RECALCULATE_EVERY)
+                and (self.battery.time_to_soc_update is None or now() - self.battery.time_to_soc_update >= utils.TIME_TO_SOC_RECALCULATE_EVERY)
             ):
-                self.battery.time_to_soc_update = int(time())
+                self.battery.time_to_soc_update = now()
 
                 percent_per_seconds = abs(self.battery.current_avg / (self.battery.capacity / 100)) / 3600
 
                 # Update TimeToGo item
                 if utils.TIME_TO_GO_ENABLE and percent_per_seconds is not None:
 
-                    # Get settings from dbus
-                    settings_battery_life = self.get_settings_with_values(
-                        get_bus(),
-                        "com.victronenergy.settings",
-                        "/Settings/CGwacs/BatteryLife",
-                    )
-                    settings_hub4mode = self.get_settings_with_values(
-                        get_bus(),
-                        "com.victronenergy.settings",
-                        "/Settings/CGwacs/Hub4Mode",
-                    )
+                    # Get settings from the in-memory mirror, which is updated by dbus signals
+                    hub4mode = get_setting_value("/Settings/CGwacs/Hub4Mode")
+                    state = get_setting_value("/Settings/CGwacs/BatteryLife/State")
+                    minimum_soc_limit = get_setting_value("/Settings/CGwacs/BatteryLife/MinimumSocLimit")
+                    soc_limit = get_setting_value("/Settings/CGwacs/BatteryLife/SocLimit")
 
-                    hub4mode = int(settings_hub4mode["Settings"]["CGwacs"]["Hub4Mode"]) if "Settings" in settings_hub4mode else None
-                    state = (
-                        int(settings_battery_life["Settings"]["CGwacs"]["BatteryLife"]["State"])
-                        if "Settings" in settings_battery_life and "State" in settings_battery_life["Settings"]["CGwacs"]["BatteryLife"]
-                        else None
-                    )
+                    hub4mode = int(hub4mode) if hub4mode is not None else None
+                    state = int(state) if state is not None else None
 
-                    if (
-                        hub4mode == 1
-                        and state != 9
-                        and "Settings" in settings_battery_life
-                        and "MinimumSocLimit" in settings_battery_life["Settings"]["CGwacs"]["BatteryLife"]
-                        and "SocLimit" in settings_battery_life["Settings"]["CGwacs"]["BatteryLife"]
-                    ):
+                    if hub4mode == 1 and state != 9 and minimum_soc_limit is not None and soc_limit is not None:
                         # Optimized without BatteryLife
                         if state >= 10 and state <= 12:
-                            time_to_go_soc = int(float(settings_battery_life["Settings"]["CGwacs"]["BatteryLife"]["MinimumSocLimit"]))
+                            time_to_go_soc = int(float(minimum_soc_limit))
                             logger.debug(f"Time-to-Go: Use /Settings/CGwacs/BatteryLife/MinimumSocLimit: {time_to_go_soc}")
                         # Optimized with BatteryLife
                         else:
-                            time_to_go_soc = int(float(settings_battery_life["Settings"]["CGwacs"]["BatteryLife"]["SocLimit"]))
+                            time_to_go_soc = int(float(soc_limit))
                             logger.debug(f"Time-to-Go: Use /Settings/CGwacs/BatteryLife/SocLimit: {time_to_go_soc}")
                     # External control
                     # Keep batteries charged
@@ -1072,15 +1181,18 @@ class DbusHelper:
                         (time_to_go_soc if self.battery.current_avg < 0 else 100),
                         percent_per_seconds,
                         True,
+                        self.load_profile,
                     )
 
                     # Check that time_to_go is not None and current is not near zero
-                    self._dbusservice["/TimeToGo"] = abs(int(time_to_go)) if time_to_go is not None and abs(self.battery.current_avg) > 0.1 else None
+                    self.publisher["/TimeToGo"] = abs(int(time_to_go)) if time_to_go is not None and abs(self.battery.current_avg) > 0.1 else None
 
                 # Update TimeToSoc items
                 if len(utils.TIME_TO_SOC_POINTS) > 0:
                     for num in utils.TIME_TO_SOC_POINTS:
-                        self._dbusservice["/TimeToSoC/" + str(num)] = self.battery.get_timeToSoc(num, percent_per_seconds) if self.battery.current_avg else None
+                        self.publisher["/TimeToSoC/" + str(num)] = (
+                            self.battery.get_timeToSoc(num, percent_per_seconds, load_profile=self.load_profile) if self.battery.current_avg else None
+                        )
 
         except Exception:
             # set error code, to show in the GUI that something is wrong
@@ -1091,16 +1203,18 @@ class DbusHelper:
             line = exception_traceback.tb_lineno
             logger.error("Non blocking exception occurred: " + f"{repr(exception_object)} of type {exception_type} in {file} line #{line}")
 
-        # save settings every 15 seconds to dbus
-        if int(time()) % 15:
-            self.save_current_battery_state()
+        for key, value in self.battery.get_link_metrics().items():
+            self.publisher["/Link/" + key] = value
+
+        # queue the charge state, it's written to the settings every PERSIST_INTERVAL seconds
+        self.save_current_battery_state()
 
         if self.battery.soc is not None:
             logger.debug("logged to dbus [%s]" % str(round(self.battery.soc, 2)))
             self.battery.log_cell_data()
 
         if self.battery.has_settings:
-            self._dbusservice["/Settings/ResetSoc"] = self.battery.reset_soc
+            self.publisher["/Settings/ResetSoc"] = self.battery.reset_soc
 
     def get_settings_with_values(self, bus, service: str, object_path: str, recursive: bool = True) -> dict:
         """
@@ -1113,7 +1227,7 @@ class DbusHelper:
         :return: A dictionary with all settings and values.
         """
         # print(object_path)
-        obj = bus.get_object(service, object_path)
+        obj = get_object(bus, service, object_path)
         iface = dbus.Interface(obj, "org.freedesktop.DBus.Introspectable")
         xml_string = iface.Introspect()
         # print(xml_string)
@@ -1163,7 +1277,7 @@ class DbusHelper:
         if value is None:
             return False
 
-        obj = bus.get_object(service, object_path + "/" + setting_name)
+        obj = get_object(bus, service, object_path + "/" + setting_name)
         # iface = dbus.Interface(obj, "org.freedesktop.DBus.Introspectable")
         # xml_string = iface.Introspect()
         # print(xml_string)
@@ -1187,7 +1301,7 @@ class DbusHelper:
         :param object_path: The object path.
         :param setting_name: The setting name.
         """
-        obj = bus.get_object(service, object_path)
+        obj = get_object(bus, service, object_path)
         # iface = dbus.Interface(obj, "org.freedesktop.DBus.Introspectable")
         # xml_string = iface.Introspect()
         # print(xml_string)
@@ -1240,6 +1354,21 @@ class DbusHelper:
             else:
                 dict1[key] = dict2[key]
 
+    def between_polls(self, callback: Callable) -> Callable:
+        """
+        Wrap a callback of a dbus path, so that it does not change the battery while `refresh_data()` runs
+        in the poll thread. The main loop waits at most for the running poll.
+
+        :param callback: The callback, that changes the battery
+        :return: The wrapped callback
+        """
+
+        def locked_callback(path, value):
+            with self.battery.poll_lock:
+                return callback(path, value)
+
+        return locked_callback
+
     def custom_name_callback(self, path, value) -> str:
         """
         Callback function to set a custom name for the battery.
@@ -1267,64 +1396,20 @@ class DbusHelper:
         """
         Save the current battery state to dbus.
 
-        This function saves the current battery state to dbus. It checks if the values have changed and
-        only saves the values that have changed.
+        The values are queued and written behind by the `SettingsWriteBehind`, which coalesces the changes
+        and writes only significant changes every `PERSIST_INTERVAL` seconds and all changes on shutdown.
 
-        :return: True if the values have been saved, otherwise False.
+        :return: True if the values have been queued, otherwise False.
         """
-        result = True
-
-        if self.battery.allow_max_voltage != self.save_charge_details_last["allow_max_voltage"]:
-            result = result + self.set_settings(
-                get_bus(),
-                "com.victronenergy.settings",
-                self.path_battery,
-                "AllowMaxVoltage",
-                1 if self.battery.allow_max_voltage else 0,
-            )
-            logger.debug(f"Saved AllowMaxVoltage. Before {self.save_charge_details_last['allow_max_voltage']}, " + f"after {self.battery.allow_max_voltage}")
-            self.save_charge_details_last["allow_max_voltage"] = self.battery.allow_max_voltage
-
-        if self.battery.max_voltage_start_time != self.save_charge_details_last["max_voltage_start_time"]:
-            result = result and self.set_settings(
-                get_bus(),
-                "com.victronenergy.settings",
-                self.path_battery,
-                "MaxVoltageStartTime",
-                (self.battery.max_voltage_start_time if self.battery.max_voltage_start_time is not None else ""),
-            )
-            logger.debug(
-                f"Saved MaxVoltageStartTime. Before {self.save_charge_details_last['max_voltage_start_time']}, "
-                + f"after {self.battery.max_voltage_start_time}"
-            )
-            self.save_charge_details_last["max_voltage_start_time"] = self.battery.max_voltage_start_time
-
-        if self.battery.soc_calc != self.save_charge_details_last["soc_calc"]:
-            result = result and self.set_settings(
-                get_bus(),
-                "com.victronenergy.settings",
-                self.path_battery,
-                "SocCalc",
-                self.battery.soc_calc,
-            )
-            logger.debug(f"soc_calc written to dbus: {self.battery.soc_calc}")
-            self.save_charge_details_last["soc_calc"] = self.battery.soc_calc
+        if self.persistence is None:
+            return False
 
-        if self.battery.soc_reset_last_reached != self.save_charge_details_last["soc_reset_last_reached"]:
-            result = result and self.set_settings(
-                get_bus(),
-                "com.victronenergy.settings",
-                self.path_battery,
-                "SocResetLastReached",
-                self.battery.soc_reset_last_reached,
-            )
-            logger.debug(
-                f"Saved SocResetLastReached. Before {self.save_charge_details_last['soc_reset_last_reached']}, "
-                + f"after {self.battery.soc_reset_last_reached}",
-            )
-            self.save_charge_details_last["soc_reset_last_reached"] = self.battery.soc_reset_last_reached
+        self.persistence.set("AllowMaxVoltage", 1 if self.battery.allow_max_voltage else 0)
+        self.persistence.set("MaxVoltageStartTime", (self.battery.max_voltage_start_time if self.battery.max_voltage_start_time is not None else ""))
+        self.persistence.set("SocCalc", self.battery.soc_calc)
+        self.persistence.set("SocResetLastReached", self.battery.soc_reset_last_reached)
 
-        return result
+        return True
 
     def telemetry_upload(self) -> None:
         """
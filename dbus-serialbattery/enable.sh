@@ -248,7 +248,9 @@ if [ "$bluetooth_length" -gt 0 ]; then
             echo "trap 'kill -TERM \$PID' TERM INT"
             echo
             # close all open connections, else the driver can't connect
-            echo "bluetoothctl disconnect $3 > /dev/null 2>&1"
+            for mac in $3; do
+                echo "bluetoothctl disconnect $mac > /dev/null 2>&1"
+            done
             echo
             echo "# Start the main process"
             echo "exec 2>&1"
@@ -272,12 +274,14 @@ if [ "$bluetooth_length" -gt 0 ]; then
     # Example
     # install_blebattery_service 0 Jkbms_Ble C8:47:8C:00:00:00
     # install_blebattery_service 1 Jkbms_Ble C8:47:8C:00:00:11
+    # install_blebattery_service 2 Jkbms_Ble "C8:47:8C:00:00:22 C8:47:8C:00:00:33"
 
     for (( i=0; i<bluetooth_length; i++ ));
     do
         # split BMS type and MAC address
         IFS=' ' read -r -a bms <<< "${bms_array[$i]}"
-        install_blebattery_service $i "${bms[0]}" "${bms[1]}"
+        # all further MAC addresses of the same entry share one driver process
+        install_blebattery_service $i "${bms[0]}" "${bms[*]:1}"
     done
 
     echo
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Export the data recorded by the driver (see RECORDER_SIZE in the config) as CSV or JSON lines.
+
+The records are streamed to stdout, so large time ranges can be exported without much memory.
+The CSV columns are compatible with simulate_charge_control.py, unknown values are written as empty fields.
+
+Usage:
+    python export_recording.py <recording> [--from <time>] [--to <time>] [--format csv|json]
+
+    <time> is a Unix timestamp or a local date and time like 2024-12-31T18:00
+
+Example:
+    python export_recording.py /data/apps/dbus-serialbattery_data/recording_<bms id>.bin --from 2024-12-31 > recording.csv
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+from datetime import datetime
+
+# add ext folder to sys.path
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), "ext"))
+
+from utils_recorder import RecordingReader  # noqa: E402
+
+
+def parse_time(value: str) -> float:
+    """
+    :param value: A Unix timestamp or a local date and time in ISO format
+    :return: The Unix timestamp
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the data recorded by the driver as CSV or JSON lines.")
+    parser.add_argument("recording", help="file of the recording")
+    parser.add_argument("--from", dest="start", type=parse_time, help="first time to export, Unix timestamp or local date and time")
+    parser.add_argument("--to", dest="end", type=parse_time, help="last time to export, Unix timestamp or local date and time")
+    parser.add_argument("--format", choices=["csv", "json"], default="csv", help="output format, default: csv")
+    args = parser.parse_args()
+
+    try:
+        reader = RecordingReader(args.recording)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    records = reader.read(args.start, args.end)
+
+    try:
+        if args.format == "json":
+            for timestamp, record in records:
+                sys.stdout.write(json.dumps({"timestamp": timestamp, **record}) + "\n")
+        else:
+            columns = ["voltage", "current", "soc"]
+            columns += ["cell" + str(cell + 1) for cell in range(reader.get_max_cell_count())]
+            columns += ["temp1", "temp2", "temp3", "temp4", "balancing", "cvl", "ccl", "dcl", "charge_mode"]
+
+            writer = csv.writer(sys.stdout)
+            writer.writerow(["timestamp"] + columns)
+            for timestamp, record in records:
+                writer.writerow([timestamp] + [record.get(column) for column in columns])
+
+    # e.g. if the output is piped to head
+    except BrokenPipeError:
+        sys.stderr.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Run the charge control (CVL, CCL and DCL) of the driver offline over a recorded time series,
+to evaluate settings like LINEAR_RECALCULATION_EVERY, SOC_RESET_* or the CCCM curves without waiting days.
+
+The battery is simulated with a clock that follows the timestamps of the recording,
+so the data is evaluated as fast as the CPU allows. On a desktop CPU this is about 20,000 samples per second,
+so a month with a sample every second (2.6 million samples) takes about two minutes. A GX device is a lot slower,
+so copy the data to a computer for long periods or use only every n-th sample.
+
+The input is a CSV file with a header and the columns:
+    timestamp   Unix time in seconds
+    voltage     Battery voltage in V
+    current     Battery current in A, positive while charging
+    soc         SoC reported by the BMS in % (optional)
+    cell1..cellN    Cell voltages in V, the number of columns sets the cell count
+    temp1..temp4    Temperatures in °C (optional)
+
+Empty fields are unknown values, like in the export of export_recording.py. Rows without voltage or current
+are skipped, since the driver would not have published them. Empty cell voltages are unknown cells.
+
+The output is a CSV file with the CVL, CCL, DCL and charge mode of every sample. The transitions of the charge mode
+are printed to stdout.
+
+Usage:
+    python simulate_charge_control.py <input csv> --capacity <Ah> [--output <csv>] [--set NAME=VALUE ...]
+
+Example:
+    python simulate_charge_control.py /data/battery-2024-01.csv --capacity 280 --set LINEAR_RECALCULATION_EVERY=30
+"""
+import argparse
+import csv
+import os
+import sys
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Dict, Iterator, List, Union
+
+# add ext folder to sys.path
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), "ext"))
+
+import utils  # noqa: E402
+from battery import Battery, Cell  # noqa: E402
+from utils import logger  # noqa: E402
+from utils_clock import SimulatedClock, set_clock  # noqa: E402
+
+
+class SimulatedBattery(Battery):
+    """
+    Battery that gets its values from the recorded samples instead of a BMS.
+    """
+
+    BATTERYTYPE = "Simulated"
+
+    def __init__(self, capacity: float, cell_count: int):
+        super(SimulatedBattery, self).__init__("simulation", -1, "")
+        self.type = self.BATTERYTYPE
+        self.capacity = capacity
+        self.cell_count = cell_count
+        for _ in range(cell_count):
+            self.cells.append(Cell(False))
+        self.cell_columns = ["cell" + str(i + 1) for i in range(cell_count)]
+        self.charge_fet = True
+        self.discharge_fet = True
+        self.control_allow_charge = True
+        self.control_allow_discharge = True
+
+    def test_connection(self) -> bool:
+        return True
+
+    def get_settings(self) -> bool:
+        return True
+
+    def refresh_data(self) -> bool:
+        return True
+
+    def load_sample(self, sample: Dict[str, str]) -> None:
+        """
+        Set the values of one row of the recording.
+
+        :param sample: The row of the CSV file
+        :return: None
+        """
+        self.voltage = parse_float(sample.get("voltage"))
+        self.current = parse_float(sample.get("current"))
+        if sample.get("soc"):
+            self.soc = float(sample["soc"])
+        # write to the cell array directly, this is the hot path of the simulation
+        cells = self.cells
+        for i, column in enumerate(self.cell_columns):
+            cells.set_voltage(i, parse_float(sample.get(column)))
+        for i in range(1, 5):
+            if sample.get("temp" + str(i)):
+                setattr(self, "temp" + str(i), float(sample["temp" + str(i)]))
+
+
+def parse_float(value: Union[str, None]) -> Union[float, None]:
+    """
+    :param value: A field of the CSV file
+    :return: The value, None if the field is empty or missing
+    """
+    return float(value) if value else None
+
+
+def parse_config_value(name: str, value: str) -> Union[bool, int, float, str, List[float]]:
+    """
+    Convert a value from the command line to the type of the config value in `utils`.
+
+    :param name: The name of the config value, e.g. `LINEAR_RECALCULATION_EVERY`
+    :param value: The value as string, lists are comma separated
+    :return: The converted value
+    """
+    if not hasattr(utils, name):
+        raise ValueError(f"Unknown config value {name}")
+
+    current = getattr(utils, name)
+
+    if isinstance(current, bool):
+        return value.lower() in ("true", "1", "yes")
+    if isinstance(current, int):
+        return int(value)
+    if isinstance(current, float):
+        return float(value)
+    if isinstance(current, list):
+        return [float(item) for item in value.split(",") if item.strip() != ""]
+    return value
+
+
+@contextmanager
+def simulation(clock: SimulatedClock, config: Dict[str, Union[bool, int, float, str, List[float]]]) -> Iterator[None]:
+    """
+    Replace the clock and the config values while the simulation runs and restore them afterwards.
+
+    :param clock: The simulated clock
+    :param config: The config values to change
+    :return: the context manager
+    """
+    originals = {name: getattr(utils, name) for name in config}
+    limit_curves = utils.LIMIT_CURVES
+    previous_clock = set_clock(clock)
+
+    try:
+        for name, value in config.items():
+            setattr(utils, name, value)
+        # the curves are compiled from the config lists
+        utils.LIMIT_CURVES = utils.compile_limit_curves()
+        yield
+    finally:
+        for name, value in originals.items():
+            setattr(utils, name, value)
+        utils.LIMIT_CURVES = limit_curves
+        set_clock(previous_clock)
+
+
+def simulate(input_file: str, capacity: float, output_file: str, config: Dict[str, Union[bool, int, float, str, List[float]]]) -> int:
+    """
+    Run the charge control over the recording.
+
+    :param input_file: Path to the recording
+    :param capacity: Capacity of the battery in Ah
+    :param output_file: Path to the output file
+    :param config: The config values to change
+    :return: Number of simulated samples
+    """
+    clock = SimulatedClock()
+    samples = 0
+    skipped = 0
+    transitions = 0
+    charge_mode_last = None
+
+    with open(input_file, newline="") as input_csv, open(output_file, "w", newline="") as output_csv:
+        reader = csv.DictReader(input_csv)
+        cell_count = len([column for column in reader.fieldnames if column.startswith("cell")])
+
+        writer = csv.writer(output_csv)
+        writer.writerow(["timestamp", "voltage", "current", "soc", "soc_calc", "cvl", "ccl", "dcl", "charge_mode", "charge_limitation", "discharge_limitation"])
+
+        with simulation(clock, config):
+            battery = SimulatedBattery(capacity, cell_count)
+
+            for sample in reader:
+                # e.g. the poll failed, while the data was recorded
+                if not sample.get("voltage") or not sample.get("current"):
+                    skipped += 1
+                    continue
+
+                clock.set(float(sample["timestamp"]))
+
+                # like `DbusHelper.publish_battery()` does after each poll
+                battery.metrics = None
+                battery.load_sample(sample)
+                battery.update_metrics()
+                battery.manage_charge_voltage()
+                battery.manage_charge_and_discharge_current()
+
+                writer.writerow(
+                    [
+                        sample["timestamp"],
+                        battery.voltage,
+                        battery.current,
+                        battery.soc,
+                        battery.soc_calc,
+                        round(battery.control_voltage + utils.VOLTAGE_DROP, 2) if battery.control_voltage is not None else None,
+                        battery.control_charge_current,
+                        battery.control_discharge_current,
+                        battery.charge_mode,
+                        battery.charge_limitation,
+                        battery.discharge_limitation,
+                    ]
+                )
+
+                if battery.charge_mode != charge_mode_last:
+                    print(f"{sample['timestamp']}: {charge_mode_last} -> {battery.charge_mode} (CVL {battery.control_voltage} V, SoC {battery.soc_calc} %)")
+                    charge_mode_last = battery.charge_mode
+                    transitions += 1
+
+                samples += 1
+
+    print(f"{samples} samples, {transitions} charge mode transitions" + (f", {skipped} rows without voltage or current skipped" if skipped else ""))
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the charge control of the driver offline over a recorded time series.")
+    parser.add_argument("input", help="CSV file with the recorded samples")
+    parser.add_argument("--capacity", type=float, required=True, help="capacity of the battery in Ah")
+    parser.add_argument("--output", help="CSV file for the results, default: <input>.simulation.csv")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE", help="change a config value, lists are comma separated")
+    args = parser.parse_args()
+
+    config = {}
+    for setting in args.set:
+        name, _, value = setting.partition("=")
+        try:
+            config[name.strip()] = parse_config_value(name.strip(), value.strip())
+        except ValueError as e:
+            logger.error(str(e))
+            sys.exit(1)
+
+    # the charge control logs every decision, which slows down the simulation
+    logger.setLevel("WARNING")
+
+    start = perf_counter()
+    samples = simulate(args.input, args.capacity, args.output or args.input + ".simulation.csv", config)
+    print(f"Simulated in {perf_counter() - start:.1f} seconds ({samples / max(perf_counter() - start, 1e-9):.0f} samples/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,12 @@
 import bisect
 import configparser
 import logging
+import os
 import sys
 from pathlib import Path
 from struct import unpack_from
 from time import sleep
-from typing import List, Any, Callable, Union
+from typing import Dict, List, Any, Callable, Union
 
 # Third-party imports
 import serial
@@ -196,6 +197,28 @@ SOC_CALC_CURRENT_MEASURED_BY_USER: list = get_list_from_config("DEFAULT", "SOC_C
 SOC_CALC_CURRENT: bool = SOC_CALC_CURRENT_REPORTED_BY_BMS != SOC_CALC_CURRENT_MEASURED_BY_USER
 
 
+# --------- Bluetooth BMS ---------
+BLUETOOTH_RECONNECT_DELAY_MAX: float = get_float_from_config("DEFAULT", "BLUETOOTH_RECONNECT_DELAY_MAX")
+"""
+Maximum delay in seconds between two reconnect attempts
+"""
+BLUETOOTH_ADAPTER_RESET_AFTER_FAILURES: int = get_int_from_config("DEFAULT", "BLUETOOTH_ADAPTER_RESET_AFTER_FAILURES")
+"""
+Number of consecutive failed connection attempts after which the Bluetooth adapter is reset
+"""
+
+
+# --------- CAN BMS ---------
+CAN_REPLAY_FILE: Union[str, None] = config["DEFAULT"]["CAN_REPLAY_FILE"] or None
+"""
+Recorded CAN log file (candump, ASC, BLF) which is replayed instead of reading from the CAN port
+"""
+CAN_REPLAY_SPEED: float = get_float_from_config("DEFAULT", "CAN_REPLAY_SPEED")
+"""
+Replay speed factor, 1.0 = real time, 0 = as fast as possible
+"""
+
+
 # --------- Daisy Chain Configuration (Multiple BMS on one cable) ---------
 BATTERY_ADDRESSES: list = get_list_from_config("DEFAULT", "BATTERY_ADDRESSES", str)
 
@@ -386,6 +409,14 @@ TIME_TO_SOC_POINTS: List[int] = get_list_from_config("DEFAULT", "TIME_TO_SOC_POI
 TIME_TO_SOC_VALUE_TYPE: int = get_int_from_config("DEFAULT", "TIME_TO_SOC_VALUE_TYPE")
 TIME_TO_SOC_RECALCULATE_EVERY: int = max(get_int_from_config("DEFAULT", "TIME_TO_SOC_RECALCULATE_EVERY"), 5)
 TIME_TO_SOC_INC_FROM: bool = get_bool_from_config("DEFAULT", "TIME_TO_SOC_INC_FROM")
+TIME_TO_SOC_LOAD_PROFILE: bool = get_bool_from_config("DEFAULT", "TIME_TO_SOC_LOAD_PROFILE")
+"""
+Use the learned load profile for Time-To-Go and Time-To-SoC
+"""
+LOAD_PROFILE_WEIGHT: float = min(max(get_float_from_config("DEFAULT", "LOAD_PROFILE_WEIGHT"), 0.01), 1)
+"""
+Weight of a new hour in the load profile
+"""
 
 # --------- Additional settings ---------
 BMS_TYPE: List[str] = get_list_from_config("DEFAULT", "BMS_TYPE", str)
@@ -394,8 +425,44 @@ POLL_INTERVAL: Union[float, None] = float(config["DEFAULT"]["POLL_INTERVAL"]) *
 """
 Poll interval in milliseconds
 """
+POLL_INTERVAL_MEDIUM: float = max(get_float_from_config("DEFAULT", "POLL_INTERVAL_MEDIUM"), 0)
+"""
+Minimum time in seconds between two reads of medium changing data like cell voltages and temperatures
+"""
+POLL_INTERVAL_SLOW: float = max(get_float_from_config("DEFAULT", "POLL_INTERVAL_SLOW"), 0)
+"""
+Minimum time in seconds between two reads of slow changing data like alarms
+"""
 PUBLISH_CONFIG_VALUES: bool = get_bool_from_config("DEFAULT", "PUBLISH_CONFIG_VALUES")
+PUBLISH_REFRESH_INTERVAL: int = get_int_from_config("DEFAULT", "PUBLISH_REFRESH_INTERVAL")
+"""
+Seconds after which a value held back by the deadband of its dbus path is published anyway, 0 disables the deadbands
+"""
+PUBLISH_ITEMS_CHANGED: bool = get_bool_from_config("DEFAULT", "PUBLISH_ITEMS_CHANGED")
+"""
+Send all changes of a poll in one `ItemsChanged` signal instead of one `PropertiesChanged` signal per path
+"""
+PERSIST_INTERVAL: int = max(get_int_from_config("DEFAULT", "PERSIST_INTERVAL"), 1)
+"""
+Seconds between two writes of the charge state to the settings
+"""
+DATA_PATH: str = config["DEFAULT"]["DATA_PATH"]
+"""
+Folder for data that is learned by the driver and has to survive an update
+"""
+HISTORY_CHECKPOINT_INTERVAL: int = max(get_int_from_config("DEFAULT", "HISTORY_CHECKPOINT_INTERVAL"), 60)
+"""
+Seconds between two saves of the history tracked by the driver
+"""
+RECORDER_SIZE: int = max(get_int_from_config("DEFAULT", "RECORDER_SIZE"), 0)
+"""
+Size of the recording of every poll in MB, 0 disables it
+"""
 BATTERY_CELL_DATA_FORMAT: int = get_int_from_config("DEFAULT", "BATTERY_CELL_DATA_FORMAT")
+PUBLISH_CELL_INTERVAL: float = max(get_float_from_config("DEFAULT", "PUBLISH_CELL_INTERVAL"), 0)
+"""
+Minimum time in seconds between two publishes of the cell voltages and balancing states
+"""
 MIDPOINT_ENABLE: bool = get_bool_from_config("DEFAULT", "MIDPOINT_ENABLE")
 TEMP_BATTERY: int = get_int_from_config("DEFAULT", "TEMP_BATTERY")
 TEMP_1_NAME: str = config["DEFAULT"]["TEMP_1_NAME"]
@@ -475,34 +542,20 @@ def map_range_constrain(in_value: float, in_min: float, in_max: float, out_min:
 def calc_linear_relationship(in_value: float, in_array: List[float], out_array: List[float]) -> float:
     """
     Calculate a linear relationship between two arrays.
+    Compiles the curve on every call, use a `LimitCurve` for curves that are evaluated repeatedly.
 
     :param in_value: Input value
     :param in_array: Input array
     :param out_array: Output array
     :return: Calculated value
     """
-    # Change compare-direction in array
-    if in_array[0] > in_array[-1]:
-        return calc_linear_relationship(in_value, in_array[::-1], out_array[::-1])
-
-    # Handle out of bounds
-    if in_value <= in_array[0]:
-        return out_array[0]
-    if in_value >= in_array[-1]:
-        return out_array[-1]
-
-    # Calculate linear current between the setpoints
-    idx = bisect.bisect(in_array, in_value)
-    upper_in = in_array[idx - 1]
-    upper_out = out_array[idx - 1]
-    lower_in = in_array[idx]
-    lower_out = out_array[idx]
-    return map_range_constrain(in_value, lower_in, upper_in, lower_out, upper_out)
+    return LimitCurve(in_array, out_array).linear(in_value)
 
 
 def calc_step_relationship(in_value: float, in_array: List[float], out_array: List[float], return_lower: bool) -> float:
     """
     Calculate a step relationship between two arrays.
+    Compiles the curve on every call, use a `LimitCurve` for curves that are evaluated repeatedly.
 
     :param in_value: Input value
     :param in_array: Input array
@@ -510,19 +563,96 @@ def calc_step_relationship(in_value: float, in_array: List[float], out_array: Li
     :param return_lower: Return lower value if True, else return higher value
     :return: Calculated value
     """
-    # Change compare-direction in array
-    if in_array[0] > in_array[-1]:
-        return calc_step_relationship(in_value, in_array[::-1], out_array[::-1], return_lower)
+    return LimitCurve(in_array, out_array).step(in_value, return_lower)
+
+
+class LimitCurve:
+    """
+    Piecewise linear or step curve, e.g. the maximum charge current depending on the cell voltage.
+
+    The breakpoints are sorted ascending and the slopes of the segments are calculated once,
+    so evaluating the curve needs only a single bisect.
+    """
+
+    def __init__(self, in_array: List[float], out_array: List[float]):
+        """
+        :param in_array: Input values of the breakpoints, ascending or descending
+        :param out_array: Output values of the breakpoints
+        """
+        # Change compare-direction in array
+        if len(in_array) > 0 and in_array[0] > in_array[-1]:
+            in_array = in_array[::-1]
+            out_array = out_array[::-1]
+
+        self.inputs: List[float] = list(in_array)
+        self.outputs: List[float] = list(out_array)
+        self.slopes: List[float] = [
+            (self.outputs[i + 1] - self.outputs[i]) / (self.inputs[i + 1] - self.inputs[i]) if self.inputs[i + 1] != self.inputs[i] else 0
+            for i in range(min(len(self.inputs), len(self.outputs)) - 1)
+        ]
 
-    # Handle out of bounds
-    if in_value <= in_array[0]:
-        return out_array[0]
-    if in_value >= in_array[-1]:
-        return out_array[-1]
+    def linear(self, in_value: float) -> float:
+        """
+        Calculate the value between the breakpoints linearly.
 
-    # Get index between the setpoints
-    idx = bisect.bisect(in_array, in_value)
-    return out_array[idx] if return_lower else out_array[idx - 1]
+        :param in_value: Input value
+        :return: Calculated value
+        """
+        inputs = self.inputs
+        outputs = self.outputs
+
+        # Handle out of bounds
+        if in_value <= inputs[0]:
+            return outputs[0]
+        if in_value >= inputs[-1]:
+            return outputs[-1]
+
+        idx = bisect.bisect(inputs, in_value) - 1
+        return constrain(outputs[idx] + (in_value - inputs[idx]) * self.slopes[idx], outputs[idx], outputs[idx + 1])
+
+    def step(self, in_value: float, return_lower: bool) -> float:
+        """
+        Get the value of the breakpoint below or above the input value.
+
+        :param in_value: Input value
+        :param return_lower: Return lower value if True, else return higher value
+        :return: Calculated value
+        """
+        inputs = self.inputs
+        outputs = self.outputs
+
+        # Handle out of bounds
+        if in_value <= inputs[0]:
+            return outputs[0]
+        if in_value >= inputs[-1]:
+            return outputs[-1]
+
+        idx = bisect.bisect(inputs, in_value)
+        return outputs[idx] if return_lower else outputs[idx - 1]
+
+
+def compile_limit_curves() -> Dict[str, LimitCurve]:
+    """
+    Compile the curves of the config lists. Call it again and assign the result to `LIMIT_CURVES`,
+    if the lists changed, the consumers look up the curves on every call.
+
+    :return: The curves by name
+    """
+    return {
+        "charge_cell_voltage": LimitCurve(CELL_VOLTAGES_WHILE_CHARGING, MAX_CHARGE_CURRENT_CV),
+        "discharge_cell_voltage": LimitCurve(CELL_VOLTAGES_WHILE_DISCHARGING, MAX_DISCHARGE_CURRENT_CV),
+        "charge_temperature": LimitCurve(TEMPERATURES_WHILE_CHARGING, MAX_CHARGE_CURRENT_T),
+        "discharge_temperature": LimitCurve(TEMPERATURES_WHILE_DISCHARGING, MAX_DISCHARGE_CURRENT_T),
+        "charge_soc": LimitCurve(SOC_WHILE_CHARGING, MAX_CHARGE_CURRENT_SOC),
+        "discharge_soc": LimitCurve(SOC_WHILE_DISCHARGING, MAX_DISCHARGE_CURRENT_SOC),
+        "soc_calc_current": LimitCurve(SOC_CALC_CURRENT_REPORTED_BY_BMS, SOC_CALC_CURRENT_MEASURED_BY_USER),
+    }
+
+
+LIMIT_CURVES: Dict[str, LimitCurve] = compile_limit_curves()
+"""
+Curves of the charge/discharge current limitation and the SoC current correction
+"""
 
 
 def is_bit_set(value: Any) -> bool:
@@ -555,6 +685,39 @@ def bytearray_to_string(data: bytearray) -> str:
     return "".join(f"\\x{byte:02x}" for byte in data)
 
 
+def write_file_atomic(path: str, data: bytes) -> bool:
+    """
+    Write a file to a temporary file first and replace the file with it, so a power loss does not corrupt it.
+    The temporary file is synced before the rename and the folder after it,
+    else the rename can be persisted before the data and the file is empty after a power loss.
+    The folder is created, if it does not exist.
+
+    :param path: Path of the file
+    :param data: Content of the file
+    :return: True if the file was written, else False
+    """
+    try:
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        with open(path + ".tmp", "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + ".tmp", path)
+
+        # persist the rename
+        folder_fd = os.open(folder, os.O_RDONLY)
+        try:
+            os.fsync(folder_fd)
+        finally:
+            os.close(folder_fd)
+    except OSError as error:
+        logger.error(f"File {path} could not be written: {error}")
+        return False
+
+    return True
+
+
 def open_serial_port(port: str, baud: int) -> Union[serial.Serial, None]:
     """
     Open a serial port.
@@ -1,23 +1,454 @@
 from utils import logger
+import utils
+import atexit
 import threading
 import asyncio
-from bleak import BleakClient
+import concurrent.futures
+import random
+import sys
+from time import monotonic
+from typing import Awaitable, Callable, Dict, Optional, Union
+from bleak import BleakClient, BLEDevice, exc
 
 
-# Class that enables synchronous writing and reading to a bluetooh device
-class Syncron_Ble:
+class BleConnection:
+    """
+    A connection to one Bluetooth LE device, maintained by the `BleHub`.
+
+    The hub connects to the device, awaits `on_connect(client)` to let the driver subscribe to
+    notifications and request initial data, and reconnects with an exponential backoff starting at
+    `reconnect_delay` seconds if the connection is lost.
+    """
+
+    def __init__(
+        self,
+        hub: "BleHub",
+        address: str,
+        on_connect: Callable[[BleakClient], Awaitable[None]],
+        on_disconnect: Optional[Callable[[], None]] = None,
+        device: Optional[BLEDevice] = None,
+        reconnect_delay: float = 1,
+    ):
+        self.hub = hub
+        self.address = address
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.device = device
+        self.reconnect_delay = reconnect_delay
+
+        self.client: Optional[BleakClient] = None
+        self.task: Optional[concurrent.futures.Future] = None
+        self.run = True
+
+        # set as soon as the device is connected and `on_connect` finished, can be waited on from any thread
+        self.ready = threading.Event()
+
+        # created in the hub thread, since it's bound to the hub event loop
+        self.disconnected_event: Optional[asyncio.Event] = None
+
+        # link metrics, the BlueZ values are updated by the `BleLinkSupervisor`
+        self.consecutive_failures = 0
+        self.reconnects = 0
+        self.rssi: Optional[int] = None
+        self.bluez_connected: Optional[bool] = None
+        self.services_resolved: Optional[bool] = None
+
+    def is_running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def is_connected(self) -> bool:
+        return self.ready.is_set() and self.client is not None and self.client.is_connected
+
+    def link_metrics(self) -> dict:
+        """
+        Link quality metrics of the connection, published on the D-Bus by the battery.
+
+        :return: dict with the metric names as keys
+        """
+        return {
+            "Rssi": self.rssi,
+            "Connected": 1 if self.is_connected() else 0,
+            "ServicesResolved": None if self.services_resolved is None else int(self.services_resolved),
+            "Reconnects": self.reconnects,
+            "ConnectFailures": self.consecutive_failures,
+            "AdapterResets": self.hub.supervisor.adapter_resets,
+        }
+
+    def next_reconnect_delay(self) -> float:
+        """
+        Exponential backoff with jitter, based on the number of consecutive failures.
+
+        :return: The delay in seconds before the next connection attempt
+        """
+        delay = min(utils.BLUETOOTH_RECONNECT_DELAY_MAX, self.reconnect_delay * 2 ** min(self.consecutive_failures, 16))
+        # jitter, so that multiple devices do not reconnect at the same time
+        return delay * random.uniform(0.5, 1.0)
+
+    def reconnect(self) -> None:
+        """
+        Drop the connection and reconnect, e.g. if no data was received for a long time.
+        Can be called from any thread.
+        """
+        logger.info(f"BLE hub: reconnect to {self.address} requested")
+        self.consecutive_failures += 1
+        if self.disconnected_event is not None:
+            self.hub.loop.call_soon_threadsafe(self.disconnected_event.set)
+
+    def client_disconnected(self, client: BleakClient) -> None:
+        logger.info(f"BLE device {self.address} disconnected")
+        if self.disconnected_event is not None:
+            self.disconnected_event.set()
+
+    async def maintain(self) -> None:
+        """
+        Connect to the device and keep the connection alive until the connection is stopped.
+        """
+        self.disconnected_event = asyncio.Event()
+
+        while self.run:
+            self.disconnected_event.clear()
+            self.client = BleakClient(self.device if self.device is not None else self.address, disconnected_callback=self.client_disconnected)
+
+            try:
+                logger.debug(f"BLE hub: connecting to {self.address}")
+                await self.client.connect()
+                logger.info(f"BLE hub: connected to {self.address}")
+
+                await self.on_connect(self.client)
+                self.ready.set()
+                self.consecutive_failures = 0
+
+                # wait until the device disconnects or the connection is stopped
+                if self.client.is_connected and self.run:
+                    await self.disconnected_event.wait()
+
+            except asyncio.CancelledError:
+                raise
+
+            except exc.BleakDeviceNotFoundError:
+                logger.info(f"BLE hub: device not found: {self.address}")
+
+            except Exception:
+                (
+                    exception_type,
+                    exception_object,
+                    exception_traceback,
+                ) = sys.exc_info()
+                file = exception_traceback.tb_frame.f_code.co_filename
+                line = exception_traceback.tb_lineno
+                logger.error(f"BLE hub: Exception occurred on {self.address}: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
+
+            finally:
+                if not self.ready.is_set():
+                    self.consecutive_failures += 1
+                self.ready.clear()
+                await self.disconnect()
+
+            if self.run:
+                if self.on_disconnect is not None:
+                    self.on_disconnect()
+
+                # reset the adapter only as last resort
+                if utils.BLUETOOTH_ADAPTER_RESET_AFTER_FAILURES > 0 and self.consecutive_failures >= utils.BLUETOOTH_ADAPTER_RESET_AFTER_FAILURES:
+                    await self.hub.supervisor.reset_adapter(self.address)
+
+                delay = self.next_reconnect_delay()
+                logger.info(f"BLE hub: reconnecting to {self.address} in {delay:.1f} s ({self.consecutive_failures} consecutive failures)")
+                await asyncio.sleep(delay)
+                self.reconnects += 1
+
+        logger.debug(f"BLE hub: stopped connection to {self.address}")
+
+    async def disconnect(self) -> None:
+        if self.client is not None and self.client.is_connected:
+            try:
+                await self.client.disconnect()
+            except Exception:
+                (
+                    exception_type,
+                    exception_object,
+                    exception_traceback,
+                ) = sys.exc_info()
+                file = exception_traceback.tb_frame.f_code.co_filename
+                line = exception_traceback.tb_lineno
+                logger.error(f"BLE hub: error while disconnecting {self.address}: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
+
+    def stop(self, timeout: float = 10) -> bool:
+        """
+        Stop maintaining the connection and disconnect from the device.
+
+        :param timeout: Maximum time in seconds to wait for the disconnect
+        :return: True if the connection was stopped in time, else False
+        """
+        self.run = False
+        if self.disconnected_event is not None:
+            self.hub.loop.call_soon_threadsafe(self.disconnected_event.set)
+
+        if self.task is None:
+            return True
+
+        try:
+            self.task.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            self.task.cancel()
+            return False
+        except Exception:
+            pass
+        return True
+
+
+class BleLinkSupervisor:
+    """
+    Supervises the links of all connections of the `BleHub` over the BlueZ D-Bus API.
+
+    Reads RSSI, Connected and ServicesResolved of each device, drops connections BlueZ already lost
+    and resets (power cycles) the adapter if a device can't be reconnected. All calls are done
+    asynchronously in the hub thread over one D-Bus connection, without starting any processes.
+    """
+
+    BLUEZ_SERVICE = "org.bluez"
+    ADAPTER_INTERFACE = "org.bluez.Adapter1"
+    DEVICE_INTERFACE = "org.bluez.Device1"
+    ADAPTER_RESET_MIN_INTERVAL = 600
+
+    def __init__(self, hub: "BleHub", interval: float = 10):
+        self.hub = hub
+        self.interval = interval
+        self.bus = None
+        self.device_paths: Dict[str, str] = {}
+        self.adapter_resets = 0
+        self.adapter_reset_last = None
+
+    async def get_bus(self):
+        if self.bus is None or not self.bus.connected:
+            # dbus_fast is a dependency of bleak on Linux
+            from dbus_fast import BusType
+            from dbus_fast.aio import MessageBus
+
+            self.bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+        return self.bus
+
+    async def call(self, path: str, interface: str, member: str, signature: str = "", body: list = None) -> list:
+        from dbus_fast import Message, MessageType
+
+        bus = await self.get_bus()
+        reply = await bus.call(
+            Message(destination=self.BLUEZ_SERVICE, path=path, interface=interface, member=member, signature=signature, body=body if body is not None else [])
+        )
+        if reply.message_type == MessageType.ERROR:
+            raise Exception(f"{reply.error_name}: {reply.body[0] if reply.body else ''}")
+        return reply.body
+
+    async def get_managed_objects(self) -> dict:
+        (objects,) = await self.call("/", "org.freedesktop.DBus.ObjectManager", "GetManagedObjects")
+        return objects
+
+    async def get_device_path(self, address: str) -> Optional[str]:
+        if address not in self.device_paths:
+            for path, interfaces in (await self.get_managed_objects()).items():
+                device = interfaces.get(self.DEVICE_INTERFACE)
+                if device is not None and device["Address"].value.upper() == address.upper():
+                    self.device_paths[address] = path
+                    break
+            else:
+                return None
+        return self.device_paths[address]
+
+    async def get_adapter_path(self, address: str) -> Optional[str]:
+        device_path = await self.get_device_path(address)
+        if device_path is not None:
+            # e.g. /org/bluez/hci0/dev_C8_47_8C_00_00_00
+            return device_path.rsplit("/", 1)[0]
 
-    ble_async_thread_ready = threading.Event()
-    ble_connection_ready = threading.Event()
-    ble_async_thread_event_loop = False
-    client = False
-    address = None
-    response_event = False
-    response_data = False
-    main_thread = False
+        # device is unknown to BlueZ, use the first adapter
+        for path, interfaces in (await self.get_managed_objects()).items():
+            if self.ADAPTER_INTERFACE in interfaces:
+                return path
+        return None
 
-    write_characteristic = None
-    read_characteristic = None
+    async def update_link(self, connection: BleConnection) -> None:
+        device_path = await self.get_device_path(connection.address)
+        if device_path is None:
+            connection.rssi = None
+            connection.bluez_connected = False
+            connection.services_resolved = None
+            return
+
+        (properties,) = await self.call(device_path, "org.freedesktop.DBus.Properties", "GetAll", "s", [self.DEVICE_INTERFACE])
+        # RSSI is only available while BlueZ receives advertisements of the device
+        connection.rssi = properties["RSSI"].value if "RSSI" in properties else None
+        connection.bluez_connected = properties["Connected"].value if "Connected" in properties else None
+        connection.services_resolved = properties["ServicesResolved"].value if "ServicesResolved" in properties else None
+
+        # BlueZ lost the link, but the client was not notified
+        if connection.is_connected() and connection.bluez_connected is False:
+            logger.warning(f"BLE supervisor: BlueZ reports {connection.address} as disconnected, dropping connection")
+            connection.disconnected_event.set()
+
+    async def reset_adapter(self, address: str) -> bool:
+        """
+        Power cycle the adapter the device is connected to, at most every `ADAPTER_RESET_MIN_INTERVAL` seconds.
+
+        :param address: The address of the device that can't be reached
+        :return: True if the adapter was reset, else False
+        """
+        if self.adapter_reset_last is not None and monotonic() - self.adapter_reset_last < self.ADAPTER_RESET_MIN_INTERVAL:
+            return False
+        self.adapter_reset_last = monotonic()
+
+        try:
+            from dbus_fast import Variant
+
+            adapter_path = await self.get_adapter_path(address)
+            if adapter_path is None:
+                logger.error("BLE supervisor: no Bluetooth adapter found")
+                return False
+
+            logger.warning(f"BLE supervisor: {address} can't be reached, resetting Bluetooth adapter {adapter_path}")
+            await self.call(adapter_path, "org.freedesktop.DBus.Properties", "Set", "ssv", [self.ADAPTER_INTERFACE, "Powered", Variant("b", False)])
+            await asyncio.sleep(2)
+            await self.call(adapter_path, "org.freedesktop.DBus.Properties", "Set", "ssv", [self.ADAPTER_INTERFACE, "Powered", Variant("b", True)])
+
+            self.adapter_resets += 1
+            self.device_paths.clear()
+            return True
+
+        except Exception:
+            (
+                exception_type,
+                exception_object,
+                exception_traceback,
+            ) = sys.exc_info()
+            file = exception_traceback.tb_frame.f_code.co_filename
+            line = exception_traceback.tb_lineno
+            logger.error(f"BLE supervisor: Exception occurred: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
+            return False
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+
+            for connection in list(self.hub.connections.values()):
+                try:
+                    await self.update_link(connection)
+                except Exception:
+                    (
+                        exception_type,
+                        exception_object,
+                        exception_traceback,
+                    ) = sys.exc_info()
+                    logger.debug(f"BLE supervisor: unable to read link state of {connection.address}: {repr(exception_object)}")
+                    # the device path may have changed, e.g. after an adapter reset
+                    self.device_paths.pop(connection.address, None)
+
+
+class BleHub:
+    """
+    Process wide Bluetooth LE hub.
+
+    One asyncio event loop in one thread owns all Bluetooth LE connections of the process,
+    so that multiple batteries can share one process and one D-Bus connection to BlueZ.
+    Each battery registers its address and gets a `BleConnection`. Coroutines are run in the
+    hub thread with `run_coroutine()` (blocking) or `submit()` (non blocking).
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.connections: Dict[str, BleConnection] = {}
+        self.thread = threading.Thread(name="BMS_bluetooth_hub_thread", target=self.run_loop, daemon=True)
+        self.thread.start()
+
+        self.supervisor = BleLinkSupervisor(self)
+        self.submit(self.supervisor.run())
+
+        # disconnect all devices on exit, else BlueZ keeps the connections open
+        atexit.register(self.shutdown)
+
+    @classmethod
+    def get_instance(cls) -> "BleHub":
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def run_loop(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine) -> concurrent.futures.Future:
+        """
+        Schedule a coroutine in the hub thread without waiting for its result.
+
+        :param coroutine: The coroutine to run
+        :return: The future of the coroutine
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run_coroutine(self, coroutine, timeout: Union[float, None] = None):
+        """
+        Run a coroutine in the hub thread and wait for its result.
+
+        :param coroutine: The coroutine to run
+        :param timeout: Maximum time in seconds to wait for the result
+        :return: The result of the coroutine
+        """
+        task = self.submit(coroutine)
+        try:
+            return task.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            # make sure the coroutine does not keep running in the hub thread
+            task.cancel()
+            raise
+
+    def register(
+        self,
+        address: str,
+        on_connect: Callable[[BleakClient], Awaitable[None]],
+        on_disconnect: Optional[Callable[[], None]] = None,
+        device: Optional[BLEDevice] = None,
+        reconnect_delay: float = 1,
+    ) -> BleConnection:
+        """
+        Register a device and start maintaining the connection to it.
+
+        :param address: The address of the device
+        :param on_connect: Coroutine function called with the `BleakClient` after each (re)connect
+        :param on_disconnect: Function called in the hub thread after the connection was lost
+        :param device: An already discovered device, else the device is looked up by address
+        :param reconnect_delay: Seconds to wait before reconnecting
+        :return: The connection
+        """
+        if address in self.connections and self.connections[address].is_running():
+            raise Exception(f"BLE device {address} is already registered")
+
+        connection = BleConnection(self, address, on_connect, on_disconnect, device, reconnect_delay)
+        self.connections[address] = connection
+        connection.task = self.submit(connection.maintain())
+        return connection
+
+    def unregister(self, address: str, timeout: float = 10) -> bool:
+        """
+        Disconnect from a device and stop maintaining the connection.
+
+        :param address: The address of the device
+        :param timeout: Maximum time in seconds to wait for the disconnect
+        :return: True if the connection was stopped in time, else False
+        """
+        connection = self.connections.pop(address, None)
+        if connection is None:
+            return True
+        return connection.stop(timeout)
+
+    def shutdown(self) -> None:
+        for address in list(self.connections):
+            self.unregister(address, timeout=5)
+
+
+# Class that enables synchronous writing and reading to a bluetooh device
+class Syncron_Ble:
 
     def __init__(self, address, read_characteristic, write_characteristic):
         """
@@ -31,68 +462,55 @@ class Syncron_Ble:
         self.read_characteristic = read_characteristic
         self.address = address
 
-        # Start a new thread that will run bleak the async bluetooth LE library
-        self.main_thread = threading.current_thread()
-        ble_async_thread = threading.Thread(name="BMS_bluetooth_async_thread", target=self.initiate_ble_thread_main, daemon=True)
-        ble_async_thread.start()
-
-        thread_start_ok = self.ble_async_thread_ready.wait(2)
-        connected_ok = self.ble_connection_ready.wait(10)
-        if not thread_start_ok:
-            logger.error("bluetooh LE thread took to long to start")
-        if not connected_ok:
-            logger.error(f"bluetooh LE connection to address: {self.address} took to long to inititate")
-
-    def initiate_ble_thread_main(self):
-        asyncio.run(self.async_main(self.address))
-
-    async def async_main(self, address):
-        self.ble_async_thread_event_loop = asyncio.get_event_loop()
-        self.ble_async_thread_ready.set()
+        # response slot and lock are created once and reused for every request,
+        # they are created in the hub thread, since they are bound to its event loop
+        self.response_event: Optional[asyncio.Event] = None
+        self.request_lock: Optional[asyncio.Lock] = None
+        self.response_data = False
+        self.response_pending = False
 
-        # try to connect over and over if the connection fails
-        while self.main_thread.is_alive():
-            await self.connect_to_bms(self.address)
-            await asyncio.sleep(1)  # sleep one second before trying to reconnecting
+        # the connection is handled by the shared BLE hub
+        self.hub = BleHub.get_instance()
+        logger.info("initiating BLE connection to: " + address)
+        self.connection = self.hub.register(address, self.on_connect)
 
-    def client_disconnected(self, client):
-        logger.error(f"bluetooh device with address: {self.address} disconnected")
+        if not self.connection.ready.wait(10):
+            logger.error(f"bluetooh LE connection to address: {self.address} took to long to inititate")
 
-    async def connect_to_bms(self, address):
-        self.client = BleakClient(address, disconnected_callback=self.client_disconnected)
-        try:
-            logger.info("initiating BLE connection to: " + address)
-            await self.client.connect()
-            logger.info("connected to bluetooh device" + address)
-            await self.client.start_notify(self.read_characteristic, self.notify_read_callback)
+    async def on_connect(self, client: BleakClient):
+        if self.response_event is None:
+            self.response_event = asyncio.Event()
+            self.request_lock = asyncio.Lock()
 
-        except Exception as e:
-            logger.error("Failed when trying to connect", e)
-            return False
-        finally:
-            self.ble_connection_ready.set()
-            while self.client.is_connected and self.main_thread.is_alive():
-                await asyncio.sleep(0.1)
-            await self.client.disconnect()
+        await client.start_notify(self.read_characteristic, self.notify_read_callback)
 
     # saves response and tells the command sender that the response has arived
+    # notifications that arrive while no request is pending (e.g. late answers of a timed out request) are dropped
     def notify_read_callback(self, sender, data: bytearray):
+        if not self.response_pending:
+            return
         self.response_data = data
+        self.response_pending = False
         self.response_event.set()
 
     async def ble_thread_send_com(self, command):
-        self.response_event = asyncio.Event()
-        self.response_data = False
-        await self.client.write_gatt_char(self.write_characteristic, command, True)
-        await asyncio.wait_for(self.response_event.wait(), timeout=1)  # Wait for the response notification
-        self.response_event = False
-        return self.response_data
-
-    async def send_coroutine_to_ble_thread_and_wait_for_result(self, coroutine):
-        bt_task = asyncio.run_coroutine_threadsafe(coroutine, self.ble_async_thread_event_loop)
-        result = await asyncio.wait_for(asyncio.wrap_future(bt_task), timeout=1.5)
-        return result
+        # only one request at a time can use the response slot
+        async with self.request_lock:
+            self.response_event.clear()
+            self.response_data = False
+            self.response_pending = True
+            try:
+                await self.connection.client.write_gatt_char(self.write_characteristic, command, True)
+                await asyncio.wait_for(self.response_event.wait(), timeout=1)  # Wait for the response notification
+                return self.response_data
+            finally:
+                self.response_pending = False
 
     def send_data(self, data):
-        data = asyncio.run(self.send_coroutine_to_ble_thread_and_wait_for_result(self.ble_thread_send_com(data)))
+        if not self.connection.is_connected():
+            raise Exception(f"bluetooh device with address: {self.address} is not connected")
+        data = self.hub.run_coroutine(self.ble_thread_send_com(data), timeout=1.5)
         return data
+
+    def disconnect(self):
+        self.hub.unregister(self.address)
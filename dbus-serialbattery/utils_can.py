@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
+import sys
 import threading
 import can
 import subprocess
+import utils_clock
+from time import monotonic, sleep
+from typing import Callable, Generator, List, Union
 from utils import logger
 
 
@@ -9,7 +13,7 @@ class CanReceiverThread(threading.Thread):
 
     _instances = {}
 
-    def __init__(self, channel, bustype):
+    def __init__(self, channel, bustype, replay_file: Union[str, None] = None, replay_speed: float = 1.0):
 
         # singleton for tuple
         if (channel, bustype) in CanReceiverThread._instances:
@@ -18,22 +22,29 @@ class CanReceiverThread(threading.Thread):
         super().__init__()
         self.channel = channel
         self.bustype = bustype
+        self.replay_file = replay_file  # if set, frames are read from this log file instead of the bus
+        self.replay_speed = replay_speed  # 1.0 = real time, 10.0 = 10 times faster, 0 = as fast as possible
         self.message_cache = {}  # cache can frames here
         self.cache_lock = threading.Lock()  # lock for thread safety
+        self.listeners: List[Callable[[int, bytearray, float], None]] = []  # called with every received frame
         CanReceiverThread._instances[(channel, bustype)] = self
         self.daemon = True
         self._running = True  # flag to control the running state
 
     @classmethod
-    def get_instance(cls, channel, bustype):
+    def get_instance(cls, channel, bustype, replay_file: Union[str, None] = None, replay_speed: float = 1.0):
         # check for instance
         if (channel, bustype) not in cls._instances:
             # create new one
-            instance = cls(channel, bustype)
+            instance = cls(channel, bustype, replay_file, replay_speed)
             instance.start()
         return cls._instances[(channel, bustype)]
 
     def run(self):
+        if self.replay_file is not None:
+            self.run_replay()
+            return
+
         bus = can.interface.Bus(channel=self.channel, bustype=self.bustype)
 
         # fetch the bitrate from the current port, for logging only
@@ -44,11 +55,92 @@ class CanReceiverThread(threading.Thread):
             message = bus.recv(timeout=1.0)  # timeout 1 sec
 
             if message is not None:
-                with self.cache_lock:
-                    # cache data with arbitration id as key
-                    self.message_cache[message.arbitration_id] = message.data
+                self.cache_message(message)
                 # print(f"[{self.channel}] Empfangen: ID={hex(message.arbitration_id)}, Daten={message.data}")
 
+    def run_replay(self):
+        """
+        Feed the frames of a recorded log file into the message cache instead of reading them from the bus.
+        The log is restarted from the beginning once it ends, so that the driver does not go offline.
+
+        The listeners get the recorded time of the frames, mapped onto the monotonic clock, instead of the time of the replay.
+        So the current is integrated over the recorded time at any replay speed.
+        """
+        logger.info(f"Replaying CAN log {self.replay_file} " + (f"at {self.replay_speed}x speed" if self.replay_speed > 0 else "as fast as possible"))
+
+        replay_time = None
+
+        while self._running:
+            count = 0
+            recorded_start = None
+            for message in self.replay_messages(self.replay_file, self.replay_speed):
+                if not self._running:
+                    break
+
+                if recorded_start is None:
+                    recorded_start = message.timestamp
+                    # continue after the end of the previous round, so that the time never goes backwards
+                    replay_start = utils_clock.monotonic() if replay_time is None else max(utils_clock.monotonic(), replay_time)
+
+                replay_time = replay_start + message.timestamp - recorded_start
+                self.cache_message(message, replay_time)
+                count += 1
+
+            # prevent a busy loop, if the log file contains no usable frames
+            if count == 0:
+                logger.error(f"No CAN frames found in {self.replay_file}")
+                sleep(1)
+
+    def cache_message(self, message: can.Message, timestamp: float = None) -> None:
+        """
+        Store the payload of a received frame in the message cache and pass it to the listeners.
+
+        :param message: The received CAN message
+        :param timestamp: Monotonic time of the frame in seconds, the time of the reception if None
+        :return: None
+        """
+        with self.cache_lock:
+            # cache data with arbitration id as key
+            self.message_cache[message.arbitration_id] = message.data
+            listeners = self.listeners
+
+        if listeners:
+            # the timestamp of the message is the wall time, which is not monotonic
+            if timestamp is None:
+                timestamp = utils_clock.monotonic()
+            for listener in listeners:
+                try:
+                    listener(message.arbitration_id, message.data, timestamp)
+                except Exception:
+                    # a failing listener must not stop the reception
+                    (
+                        exception_type,
+                        exception_object,
+                        exception_traceback,
+                    ) = sys.exc_info()
+                    file = exception_traceback.tb_frame.f_code.co_filename
+                    line = exception_traceback.tb_lineno
+                    logger.error(f"CAN frame listener failed: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
+
+    def add_listener(self, listener: Callable[[int, bytearray, float], None]) -> None:
+        """
+        Call the listener in the receiver thread with every received frame, e.g. to integrate every current sample.
+
+        :param listener: Called with the arbitration id, the payload and the monotonic time of the reception in seconds
+        :return: None
+        """
+        with self.cache_lock:
+            # replace the list, so that cache_message() can iterate it without holding the lock
+            self.listeners = self.listeners + [listener]
+
+    def remove_listener(self, listener: Callable[[int, bytearray, float], None]) -> None:
+        """
+        :param listener: The listener added with `add_listener()`
+        :return: None
+        """
+        with self.cache_lock:
+            self.listeners = [registered for registered in self.listeners if registered != listener]
+
     def stop(self):
         self._running = False
         logger.info("CAN receiver stopped")
@@ -59,6 +151,36 @@ class CanReceiverThread(threading.Thread):
             # return a copy of the current cache
             return dict(self.message_cache)
 
+    @staticmethod
+    def replay_messages(replay_file: str, replay_speed: float = 1.0) -> Generator[can.Message, None, None]:
+        """
+        Read the data frames of a candump (.log), ASC, BLF or any other log format supported by `can.LogReader`
+        and yield them paced by their recorded timestamps.
+
+        :param replay_file: Path to the log file
+        :param replay_speed: 1.0 = real time, 10.0 = 10 times faster, 0 = as fast as possible
+        :return: Generator of CAN messages
+        """
+        playback_start = None
+        recorded_start = None
+
+        with can.LogReader(replay_file) as reader:
+            for message in reader:
+                # only data frames are stored in the message cache
+                if message.is_error_frame or message.is_remote_frame:
+                    continue
+
+                if replay_speed > 0:
+                    if recorded_start is None:
+                        recorded_start = message.timestamp
+                        playback_start = monotonic()
+
+                    sleep_period = playback_start + (message.timestamp - recorded_start) / replay_speed - monotonic()
+                    if sleep_period > 0.0001:
+                        sleep(sleep_period)
+
+                yield message
+
     @staticmethod
     def get_bitrate(channel):
         try:
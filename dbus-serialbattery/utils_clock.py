@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import time as system_time
+
+
+class Clock:
+    """
+    Source of the time for the driver.
+
+    Durations like timers and recalculation intervals are measured with `monotonic()`, which is not affected
+    by NTP adjustments of the wall clock, e.g. when the GX device synchronizes the time after boot.
+    `time()` is only used for timestamps that are persisted or shown to the user.
+    """
+
+    def monotonic(self) -> float:
+        return system_time.monotonic()
+
+    def time(self) -> float:
+        return system_time.time()
+
+
+class SimulatedClock(Clock):
+    """
+    Clock that only advances when it's set, e.g. to run a recorded time series faster than real time.
+    """
+
+    def __init__(self, now: float = 0):
+        """
+        :param now: The start time as Unix timestamp in seconds
+        """
+        self.now = now
+
+    def set(self, now: float) -> None:
+        """
+        Set the time and start a new cycle.
+
+        :param now: The new time as Unix timestamp in seconds
+        :return: None
+        """
+        self.now = now
+        tick()
+
+    def advance(self, seconds: float) -> None:
+        """
+        Advance the time and start a new cycle.
+
+        :param seconds: The seconds to advance
+        :return: None
+        """
+        self.set(self.now + seconds)
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+
+clock: Clock = Clock()
+"""
+The clock used by the driver, replaced with `set_clock()`
+"""
+
+cycle_monotonic: float = clock.monotonic()
+"""
+Monotonic time of the current cycle in seconds, see `tick()`
+"""
+
+cycle_time: float = clock.time()
+"""
+Wall time of the current cycle as Unix timestamp in seconds, see `tick()`
+"""
+
+
+def set_clock(new_clock: Clock) -> Clock:
+    """
+    Replace the clock of the driver and start a new cycle.
+
+    :param new_clock: The new clock
+    :return: The previous clock, to restore it later
+    """
+    global clock
+
+    previous_clock = clock
+    clock = new_clock
+    tick()
+
+    return previous_clock
+
+
+def tick() -> None:
+    """
+    Sample the clock once at the start of a cycle, so that all decisions of the cycle are based on the same time.
+
+    :return: None
+    """
+    global cycle_monotonic, cycle_time
+
+    cycle_monotonic = clock.monotonic()
+    cycle_time = clock.time()
+
+
+def now() -> float:
+    """
+    :return: The monotonic time of the current cycle in seconds, for durations
+    """
+    return cycle_monotonic
+
+
+def wall_time() -> float:
+    """
+    :return: The wall time of the current cycle as Unix timestamp in seconds, for persisted timestamps
+    """
+    return cycle_time
+
+
+def monotonic() -> float:
+    """
+    :return: The monotonic time in seconds, read from the clock on every call
+    """
+    return clock.monotonic()
+
+
+def time() -> float:
+    """
+    :return: The wall time as Unix timestamp in seconds, read from the clock on every call
+    """
+    return clock.time()
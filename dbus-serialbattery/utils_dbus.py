@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+from typing import Dict, Set, Tuple, Union
+import dbus
+from utils import logger
+
+
+class SystemBus(dbus.bus.BusConnection):
+    def __new__(cls):
+        return dbus.bus.BusConnection.__new__(cls, dbus.bus.BusConnection.TYPE_SYSTEM)
+
+
+class SessionBus(dbus.bus.BusConnection):
+    def __new__(cls):
+        return dbus.bus.BusConnection.__new__(cls, dbus.bus.BusConnection.TYPE_SESSION)
+
+
+class DbusConnection:
+    """
+    Holds the dbus connection that is shared by all batteries of this process.
+
+    Proxy objects of often used services like `com.victronenergy.settings` are cached,
+    and the available services are tracked with the `NameOwnerChanged` signal,
+    so checking if a service exists does not need a `ListNames` call.
+
+    Values read with `get_value()` are mirrored in memory and updated by the `PropertiesChanged`
+    and `ItemsChanged` signals of the service, so reading them again does not need a dbus call.
+
+    The main loop has to be set with `DBusGMainLoop(set_as_default=True)` before the first call,
+    else the signal is not received.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    CACHED_SERVICES = ("com.victronenergy.settings",)
+    """
+    Services of which the proxy objects are cached
+    """
+
+    def __init__(self):
+        self.bus: dbus.bus.BusConnection = SessionBus() if "DBUS_SESSION_BUS_ADDRESS" in os.environ else SystemBus()
+        self.objects: Dict[Tuple[str, str], dbus.proxies.ProxyObject] = {}
+        self.items: Dict[Tuple[str, str], object] = {}
+        self.services: Union[Set[str], None] = None
+
+    @classmethod
+    def get_instance(cls) -> "DbusConnection":
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def get_object(self, service: str, object_path: str) -> dbus.proxies.ProxyObject:
+        """
+        Get the proxy object of a dbus path. Proxy objects of `CACHED_SERVICES` are created only once.
+
+        :param service: The service name
+        :param object_path: The object path
+        :return: The proxy object
+        """
+        if service not in self.CACHED_SERVICES:
+            return self.bus.get_object(service, object_path)
+
+        key = (service, object_path)
+        obj = self.objects.get(key)
+
+        if obj is None:
+            # the methods are always called with an explicit interface, so no introspection is needed
+            obj = self.objects[key] = self.bus.get_object(service, object_path, introspect=False)
+
+        return obj
+
+    def get_value(self, service: str, object_path: str) -> Union[int, float, str, None]:
+        """
+        Get the value of a dbus path from the in-memory mirror. On the first call the value is read
+        and the signals of the path are subscribed.
+
+        :param service: The service name
+        :param object_path: The object path
+        :return: The value, None if the path does not exist or is invalid
+        """
+        key = (service, object_path)
+        item = self.items.get(key)
+
+        if item is None:
+            # imported here, since the path to velib is added by the dbushelper
+            from vedbus import VeDbusItemImport
+
+            # subscribe NameOwnerChanged, to recreate the item if the service restarts
+            self.has_service(service)
+
+            item = self.items[key] = VeDbusItemImport(self.bus, service, object_path)
+
+        return item.get_value()
+
+    def has_service(self, service: str) -> bool:
+        """
+        Check if a service is available on the dbus.
+
+        :param service: The service name
+        :return: True if the service is available, else False
+        """
+        if self.services is None:
+            # subscribe first, so that no change is lost between the two calls
+            self.bus.add_signal_receiver(
+                self.on_name_owner_changed,
+                signal_name="NameOwnerChanged",
+                dbus_interface="org.freedesktop.DBus",
+                bus_name="org.freedesktop.DBus",
+                path="/org/freedesktop/DBus",
+            )
+            self.services = set(str(name) for name in self.bus.list_names())
+
+        return service in self.services
+
+    def on_name_owner_changed(self, name: str, old_owner: str, new_owner: str) -> None:
+        """
+        Called by the dbus, if a service appears, disappears or changes the owner.
+
+        :param name: The service name
+        :param old_owner: The unique name of the old owner, empty if the service appeared
+        :param new_owner: The unique name of the new owner, empty if the service disappeared
+        :return: None
+        """
+        # ignore unique names of connections
+        if name.startswith(":"):
+            return
+
+        if new_owner:
+            self.services.add(str(name))
+        else:
+            self.services.discard(str(name))
+
+        # a restarted service gets a new owner, drop the proxy objects and mirrored items bound to the old one
+        # they are created again on the next access
+        if name in self.CACHED_SERVICES:
+            for key in [key for key in self.objects if key[0] == name]:
+                del self.objects[key]
+
+        for key in [key for key in self.items if key[0] == name]:
+            self.items[key].__del__()
+            del self.items[key]
+
+        logger.debug(f"dbus service {name} {'appeared' if new_owner else 'disappeared'}")
+
+
+def get_bus(private: bool = False) -> dbus.bus.BusConnection:
+    """
+    Returns the dbus connection that is shared by all batteries of this process.
+
+    :param private: If True, a new connection is returned. Each `VeDbusService` needs its own connection,
+        since it exports the root path "/" on it.
+    :return: the dbus connection
+    """
+    if private:
+        return SessionBus() if "DBUS_SESSION_BUS_ADDRESS" in os.environ else SystemBus()
+
+    return DbusConnection.get_instance().bus
+
+
+def get_object(bus: dbus.bus.BusConnection, service: str, object_path: str) -> dbus.proxies.ProxyObject:
+    """
+    Get the proxy object of a dbus path, cached if the shared connection is used.
+
+    :param bus: The dbus connection
+    :param service: The service name
+    :param object_path: The object path
+    :return: The proxy object
+    """
+    connection = DbusConnection.get_instance()
+
+    if bus is connection.bus:
+        return connection.get_object(service, object_path)
+
+    return bus.get_object(service, object_path)
+
+
+def has_service(service: str) -> bool:
+    """
+    Check if a service is available on the shared dbus connection.
+
+    :param service: The service name
+    :return: True if the service is available, else False
+    """
+    return DbusConnection.get_instance().has_service(service)
+
+
+def get_setting_value(object_path: str) -> Union[int, float, str, None]:
+    """
+    Get the value of a setting of `com.victronenergy.settings` from the in-memory mirror.
+
+    :param object_path: The object path, e.g. `/Settings/CGwacs/Hub4Mode`
+    :return: The value, None if the setting does not exist
+    """
+    return DbusConnection.get_instance().get_value("com.victronenergy.settings", object_path)
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+import math
+import struct
+import sys
+from array import array
+from typing import Dict, Union
+from utils import logger, write_file_atomic, HISTORY_CHECKPOINT_INTERVAL
+from utils_clock import now, wall_time
+
+
+class HistoryTracker:
+    """
+    Tracks the history of a battery in the driver, independent of the BMS.
+
+    Lifetime extremes, energy and charge counters and discharge statistics are updated from each poll in O(1).
+    The values are used for the `History` paths, that the BMS does not provide.
+
+    All values are stored in one array of doubles, which is saved to a small binary file
+    at most every `HISTORY_CHECKPOINT_INTERVAL` seconds, if something changed, and on shutdown.
+    """
+
+    FIELDS = (
+        # values with the same name as in `History`
+        "deepest_discharge",
+        "last_discharge",
+        "average_discharge",
+        "charge_cycles",
+        "full_discharges",
+        "total_ah_drawn",
+        "minimum_voltage",
+        "maximum_voltage",
+        "minimum_cell_voltage",
+        "maximum_cell_voltage",
+        "low_voltage_alarms",
+        "high_voltage_alarms",
+        "minimum_temperature",
+        "maximum_temperature",
+        "discharged_energy",
+        "charged_energy",
+        # internal state
+        "last_full_charge",
+        "discharge_depth",
+        "discharges",
+        "discharges_sum",
+    )
+    """
+    Fields of the values array, NaN means unknown
+    """
+
+    COUNTERS = ("charge_cycles", "full_discharges", "low_voltage_alarms", "high_voltage_alarms")
+    """
+    Fields that are published as integer
+    """
+
+    ZERO_FIELDS = COUNTERS + ("total_ah_drawn", "discharged_energy", "charged_energy", "discharges", "discharges_sum")
+    """
+    Fields that start with zero instead of unknown, since they count from the start of the tracking
+    """
+
+    MAX_GAP = 60
+    """
+    Maximum seconds between two polls that are integrated, longer gaps e.g. after a lost connection are skipped
+    """
+
+    FULL_DISCHARGE_REARM_SOC = 10
+    """
+    SoC in percent, above which the next full discharge is counted
+    """
+
+    FILE_HEADER = struct.Struct("<4sHH")
+    """
+    Header of the file as (magic, version, number of fields), followed by the values as double
+    """
+
+    FILE_MAGIC = b"SBHI"
+    FILE_VERSION = 1
+
+    def __init__(self, path: Union[str, None] = None, interval: int = HISTORY_CHECKPOINT_INTERVAL):
+        """
+        :param path: The file to load the history from and save it to, None to keep it only in memory
+        :param interval: Minimum seconds between two checkpoints
+        """
+        self.path = path
+        self.interval = interval
+        self.index: Dict[str, int] = {field: i for i, field in enumerate(self.FIELDS)}
+        self.values: array = array("d", (0.0 if field in self.ZERO_FIELDS else math.nan for field in self.FIELDS))
+        self.dirty: bool = False
+        self.saved_last: float = now()
+        self.last_time: Union[float, None] = None
+        self.last_current: Union[float, None] = None
+        self.last_power: Union[float, None] = None
+        self.soc_full: bool = False
+        self.soc_empty: bool = False
+        self.low_voltage_alarm: bool = False
+        self.high_voltage_alarm: bool = False
+
+        if self.path is not None:
+            self.load()
+
+    def load(self) -> bool:
+        """
+        Load the history from the file. If the file does not exist or is invalid, the history starts empty.
+
+        :return: True if the history was loaded, else False
+        """
+        try:
+            with open(self.path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return False
+        except OSError as error:
+            logger.error(f"History could not be read from {self.path}: {error}")
+            return False
+
+        values = array("d")
+
+        if len(data) != self.FILE_HEADER.size + len(self.FIELDS) * values.itemsize or self.FILE_HEADER.unpack_from(data) != (
+            self.FILE_MAGIC,
+            self.FILE_VERSION,
+            len(self.FIELDS),
+        ):
+            logger.warning(f"History {self.path} is invalid, starting with an empty history")
+            return False
+
+        values.frombytes(data[self.FILE_HEADER.size :])
+
+        # the file is written in little endian
+        if sys.byteorder == "big":
+            values.byteswap()
+
+        self.values = values
+        return True
+
+    def save(self) -> bool:
+        """
+        Save the history to the file.
+
+        :return: True if the history was saved, else False
+        """
+        self.saved_last = now()
+
+        if self.path is None or not self.dirty:
+            return False
+
+        values = array("d", self.values)
+        if sys.byteorder == "big":
+            values.byteswap()
+
+        if write_file_atomic(self.path, self.FILE_HEADER.pack(self.FILE_MAGIC, self.FILE_VERSION, len(self.FIELDS)) + values.tobytes()):
+            self.dirty = False
+            return True
+
+        return False
+
+    def get_value(self, field: str) -> Union[int, float, None]:
+        """
+        Get a value as it's published on the dbus.
+
+        :param field: The field name, e.g. `minimum_cell_voltage`
+        :return: The value, None if it's unknown
+        """
+        if field == "time_since_last_full_charge":
+            last_full_charge = self.values[self.index["last_full_charge"]]
+            return None if math.isnan(last_full_charge) else max(int(wall_time() - last_full_charge), 0)
+
+        value = self.values[self.index[field]]
+
+        if math.isnan(value):
+            return None
+
+        return int(value) if field in self.COUNTERS else round(value, 3)
+
+    def set_min(self, field: str, value: Union[float, None]) -> None:
+        i = self.index[field]
+        # NaN compares False, so an unknown value is always replaced
+        if value is not None and not value >= self.values[i]:
+            self.values[i] = value
+            self.dirty = True
+
+    def set_max(self, field: str, value: Union[float, None]) -> None:
+        i = self.index[field]
+        if value is not None and not value <= self.values[i]:
+            self.values[i] = value
+            self.dirty = True
+
+    def add(self, field: str, value: float) -> float:
+        i = self.index[field]
+        self.values[i] = value if math.isnan(self.values[i]) else self.values[i] + value
+        self.dirty = True
+        return self.values[i]
+
+    def update(self, battery) -> None:
+        """
+        Update the history with the values of the current poll.
+
+        :param battery: The battery
+        :return: None
+        """
+        current_time = now()
+        voltage = battery.voltage
+        current = battery.get_current()
+
+        self.set_min("minimum_voltage", voltage)
+        self.set_max("maximum_voltage", voltage)
+        self.set_min("minimum_cell_voltage", battery.get_min_cell_voltage())
+        self.set_max("maximum_cell_voltage", battery.get_max_cell_voltage())
+        self.set_min("minimum_temperature", battery.get_min_temp())
+        self.set_max("maximum_temperature", battery.get_max_temp())
+
+        # integrate the current and power of the last poll until now
+        if self.last_time is not None and self.last_current is not None and 0 < current_time - self.last_time <= self.MAX_GAP:
+            hours = (current_time - self.last_time) / 3600
+            charge = self.last_current * hours
+
+            if charge < 0:
+                self.add("total_ah_drawn", -charge)
+                depth = self.add("discharge_depth", -charge)
+                self.set_max("deepest_discharge", depth)
+                self.set_max("last_discharge", depth)
+            elif charge > 0 and not math.isnan(self.values[self.index["discharge_depth"]]):
+                self.values[self.index["discharge_depth"]] = max(self.values[self.index["discharge_depth"]] - charge, 0)
+
+            if self.last_power is not None:
+                energy = self.last_power * hours / 1000
+                if energy < 0:
+                    self.add("discharged_energy", -energy)
+                elif energy > 0:
+                    self.add("charged_energy", energy)
+
+            if battery.capacity:
+                self.values[self.index["charge_cycles"]] = self.values[self.index["total_ah_drawn"]] // battery.capacity
+
+        self.last_time = current_time
+        self.last_current = current
+        self.last_power = voltage * current if voltage is not None and current is not None else None
+
+        soc = battery.soc_calc if battery.soc_calc is not None else battery.soc
+        if soc is not None:
+            self.update_soc(soc)
+
+        self.update_alarms(battery.protection)
+
+        if self.dirty and current_time - self.saved_last >= self.interval:
+            self.save()
+
+    def update_soc(self, soc: float) -> None:
+        """
+        Detect full charges and full discharges.
+
+        :param soc: The SoC in percent
+        :return: None
+        """
+        if soc >= 100:
+            self.values[self.index["last_full_charge"]] = wall_time()
+
+            # a discharge cycle ends with a full charge
+            if not self.soc_full:
+                self.soc_full = True
+                last_discharge = self.values[self.index["last_discharge"]]
+                if not math.isnan(last_discharge) and last_discharge > 0:
+                    discharges = self.add("discharges", 1)
+                    discharges_sum = self.add("discharges_sum", last_discharge)
+                    self.values[self.index["average_discharge"]] = discharges_sum / discharges
+                    self.values[self.index["last_discharge"]] = 0
+                self.values[self.index["discharge_depth"]] = 0
+                self.dirty = True
+        else:
+            self.soc_full = False
+
+        if soc <= 0 and not self.soc_empty:
+            self.soc_empty = True
+            self.add("full_discharges", 1)
+        elif soc >= self.FULL_DISCHARGE_REARM_SOC:
+            self.soc_empty = False
+
+    def update_alarms(self, protection) -> None:
+        """
+        Count the low and high voltage alarms.
+
+        :param protection: The `Protection` of the battery
+        :return: None
+        """
+        # only count the start of an alarm
+        low_voltage_alarm = protection.low_voltage == protection.ALARM
+        if low_voltage_alarm and not self.low_voltage_alarm:
+            self.add("low_voltage_alarms", 1)
+        self.low_voltage_alarm = low_voltage_alarm
+
+        high_voltage_alarm = protection.high_voltage == protection.ALARM
+        if high_voltage_alarm and not self.high_voltage_alarm:
+            self.add("high_voltage_alarms", 1)
+        self.high_voltage_alarm = high_voltage_alarm
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+from typing import Callable, Dict, Set, Union
+import dbus
+from gi.repository import GLib
+from utils import logger, PERSIST_INTERVAL
+from utils_dbus import get_bus, get_object
+
+
+PERSIST_THRESHOLDS: Dict[str, float] = {
+    "SocCalc": 0.1,
+}
+"""
+Minimum change of a numeric setting to be written on the next flush. Smaller changes are only written on shutdown.
+Settings that are not listed are written on every change.
+"""
+
+
+class SettingsWriteBehind:
+    """
+    Persists the charge state of a battery to `com.victronenergy.settings` without blocking the main loop.
+
+    Changes are collected with `set()` and written every `PERSIST_INTERVAL` seconds with asynchronous
+    `SetValue` calls. Multiple changes of a setting between two flushes are coalesced to one write
+    and small changes below the threshold of the setting are held back, which reduces the wear of the flash.
+    On shutdown `stop()` writes all remaining changes synchronously.
+    """
+
+    SERVICE = "com.victronenergy.settings"
+
+    def __init__(self, path: str, interval: int = PERSIST_INTERVAL, error_callback: Callable[[], None] = None):
+        """
+        :param path: The settings path of the battery, e.g. `/Settings/Devices/serialbattery_<bms_id>`
+        :param interval: Seconds between two flushes
+        :param error_callback: Called in the main loop, if a write failed
+        """
+        self.path = path
+        self.interval = interval
+        self.error_callback = error_callback
+        self.persisted: Dict[str, Union[int, float, str]] = {}
+        """
+        Last value written to or read from the settings per setting name
+        """
+        self.latest: Dict[str, Union[int, float, str]] = {}
+        """
+        Last value passed to `set()` per setting name
+        """
+        self.in_flight: Set[str] = set()
+        self.timer: Union[int, None] = None
+
+    def start(self, persisted: Dict[str, Union[int, float, str]]) -> None:
+        """
+        Start the periodic flush.
+
+        :param persisted: The values that are currently stored in the settings
+        :return: None
+        """
+        self.persisted.update(persisted)
+
+        if self.timer is None and self.interval > 0:
+            self.timer = GLib.timeout_add_seconds(self.interval, self.on_timer)
+
+    def stop(self) -> None:
+        """
+        Stop the periodic flush and write all remaining changes synchronously.
+
+        :return: None
+        """
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+
+        self.flush(force=True)
+
+    def set(self, setting_name: str, value: Union[int, float, str, None]) -> None:
+        """
+        Queue a value to be written on the next flush. Never blocks.
+
+        :param setting_name: The setting name below the path
+        :param value: The new value, None is ignored
+        :return: None
+        """
+        if value is not None:
+            self.latest[setting_name] = value
+
+    def is_pending(self, setting_name: str, force: bool = False) -> bool:
+        """
+        Check if a setting has to be written.
+
+        :param setting_name: The setting name
+        :param force: If True, every change is written regardless of the threshold
+        :return: True if the setting has to be written, else False
+        """
+        value = self.latest[setting_name]
+        persisted = self.persisted.get(setting_name)
+
+        if value == persisted or (setting_name in self.in_flight and not force):
+            return False
+
+        threshold = PERSIST_THRESHOLDS.get(setting_name)
+
+        if (
+            not force
+            and threshold is not None
+            and isinstance(value, (int, float))
+            and isinstance(persisted, (int, float))
+            # add a small value to avoid that rounding errors hold back changes of exactly the threshold
+            and abs(value - persisted) + 1e-9 < threshold
+        ):
+            return False
+
+        return True
+
+    def on_timer(self) -> bool:
+        """
+        Called by the main loop every `interval` seconds.
+
+        :return: True, to keep the timer running
+        """
+        self.flush()
+        return True
+
+    def flush(self, force: bool = False) -> None:
+        """
+        Write the pending changes.
+
+        :param force: If True, all changes are written synchronously regardless of the thresholds, e.g. on shutdown
+        :return: None
+        """
+        for setting_name in [setting_name for setting_name in self.latest if self.is_pending(setting_name, force)]:
+            value = self.latest[setting_name]
+
+            try:
+                method = dbus.Interface(get_object(get_bus(), self.SERVICE, self.path + "/" + setting_name), "com.victronenergy.BusItem").get_dbus_method(
+                    "SetValue"
+                )
+
+                if force:
+                    self.on_reply(setting_name, value, method(value))
+                else:
+                    self.in_flight.add(setting_name)
+                    method(
+                        value,
+                        reply_handler=lambda result, setting_name=setting_name, value=value: self.on_reply(setting_name, value, result),
+                        error_handler=lambda error, setting_name=setting_name: self.on_error(setting_name, error),
+                    )
+
+            except dbus.exceptions.DBusException as error:
+                self.on_error(setting_name, error)
+
+    def on_reply(self, setting_name: str, value: Union[int, float, str], result: int) -> None:
+        """
+        Called, when `SetValue` returned.
+
+        :param setting_name: The setting name
+        :param value: The written value
+        :param result: The return value of `SetValue`, 0 on success
+        :return: None
+        """
+        self.in_flight.discard(setting_name)
+
+        if result != 0:
+            self.on_error(setting_name, f"SetValue returned {result}")
+            return
+
+        logger.debug(f"Saved {setting_name}. Before {self.persisted.get(setting_name)}, after {value}")
+        self.persisted[setting_name] = value
+
+    def on_error(self, setting_name: str, error) -> None:
+        """
+        Called, when `SetValue` failed. The value is written again on the next flush.
+
+        :param setting_name: The setting name
+        :param error: The exception or error message
+        :return: None
+        """
+        self.in_flight.discard(setting_name)
+        logger.error(f"Failed to set setting {self.path}/{setting_name}: {error}")
+
+        if self.error_callback is not None:
+            self.error_callback()
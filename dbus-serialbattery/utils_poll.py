@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+import math
+import sys
+import threading
+import traceback
+from collections import deque
+from time import monotonic
+from typing import Callable, Dict, NamedTuple, Tuple, Union
+from gi.repository import GLib
+from utils import logger
+
+
+class BatterySnapshot(NamedTuple):
+    """
+    Result of one `refresh_data()` call, handed over from the poll thread to the main loop.
+
+    It does not contain the battery values. The values are published directly from the battery object,
+    which is consistent because the handoff is lock-step: the poll thread blocks on `published_event`
+    and does not call `refresh_data()` again, until the main loop has published the previous poll.
+    """
+
+    key_address: Union[str, int]
+    """
+    Key of the battery in the battery dict
+    """
+
+    result: bool
+    """
+    Return value of `refresh_data()`
+    """
+
+    exception: Union[str, None]
+    """
+    Formatted traceback, if `refresh_data()` raised an exception
+    """
+
+    timestamp: float
+    """
+    Monotonic time in seconds, when `refresh_data()` returned
+    """
+
+    runtime: float
+    """
+    Duration of `refresh_data()` in seconds
+    """
+
+    latency_p50: float
+    """
+    Median duration of `refresh_data()` in seconds over the last polls
+    """
+
+    latency_p95: float
+    """
+    95th percentile of the duration of `refresh_data()` in seconds over the last polls
+    """
+
+    latency_p99: float
+    """
+    99th percentile of the duration of `refresh_data()` in seconds over the last polls
+    """
+
+    poll_interval: float
+    """
+    Effective poll interval in milliseconds after this poll
+    """
+
+
+class LatencyHistogram:
+    """
+    Keeps the durations of the last polls in a rolling window to calculate percentiles.
+    """
+
+    def __init__(self, size: int = 120):
+        """
+        :param size: Number of polls to keep
+        """
+        self.values: deque = deque(maxlen=size)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def add(self, value: float) -> None:
+        """
+        Add the duration of a poll.
+
+        :param value: The duration in seconds
+        :return: None
+        """
+        self.values.append(value)
+
+    def percentile(self, percent: float) -> float:
+        """
+        Return the percentile of the durations using the nearest-rank method.
+
+        :param percent: The percentile to return, e.g. 95
+        :return: The percentile in seconds, 0 if no values are available
+        """
+        if len(self.values) == 0:
+            return 0
+        values_sorted = sorted(self.values)
+        index = max(0, min(len(values_sorted) - 1, math.ceil(percent / 100 * len(values_sorted)) - 1))
+        return values_sorted[index]
+
+
+class PollIntervalController:
+    """
+    Adapts the poll interval to the time the batteries need to respond.
+
+    The interval is loosened, if a poll takes longer than the interval for several polls in a row,
+    and tightened again down to the default interval of the BMS, once the link is fast enough.
+    The decisions are based on the 95th percentile of the last polls, so single slow polls are ignored.
+    """
+
+    LOOSEN_AFTER_POLLS = 5
+    """
+    Number of polls in a row that have to be slower than the interval to loosen it
+    """
+
+    TIGHTEN_AFTER_POLLS = 60
+    """
+    Number of polls in a row that have to be fast enough to tighten the interval
+    """
+
+    HEADROOM = 1.5
+    """
+    Factor between the 95th percentile of the poll duration and the interval that is set
+    """
+
+    MAX_INTERVAL = 60000
+    """
+    Maximum poll interval in milliseconds
+    """
+
+    def __init__(self, default_interval: float):
+        """
+        :param default_interval: The default poll interval of the BMS in milliseconds, the interval never gets lower
+        """
+        self.default_interval = default_interval
+        self.interval = default_interval
+        self.latency = LatencyHistogram()
+        self.slow_polls = 0
+        self.fast_polls = 0
+
+    def target_interval(self) -> float:
+        """
+        Interval that fits the recent poll durations, rounded up to the next half second.
+
+        :return: The interval in milliseconds
+        """
+        target = math.ceil(self.latency.percentile(95) * self.HEADROOM * 2) / 2 * 1000
+        return min(max(target, self.default_interval), self.MAX_INTERVAL)
+
+    def update(self, runtime: float) -> float:
+        """
+        Add the duration of a poll and adapt the interval.
+
+        :param runtime: Duration of the poll of all batteries in seconds
+        :return: The new interval in milliseconds
+        """
+        self.latency.add(runtime)
+
+        if runtime > self.interval / 1000:
+            self.slow_polls += 1
+            self.fast_polls = 0
+            if self.slow_polls > 1:
+                logger.warning(
+                    f"Polling data took {runtime:.3f} seconds. Automatically increase interval in {self.LOOSEN_AFTER_POLLS - self.slow_polls} cycles."
+                )
+        else:
+            self.slow_polls = 0
+            # the interval can only get tighter, if the link is fast enough including the headroom
+            if self.interval > self.default_interval and self.target_interval() < self.interval:
+                self.fast_polls += 1
+            else:
+                self.fast_polls = 0
+
+        if self.slow_polls >= self.LOOSEN_AFTER_POLLS:
+            # use at least the last duration, the percentile could still contain older fast polls
+            self.interval = max(self.target_interval(), min(math.ceil(runtime * self.HEADROOM * 2) / 2 * 1000, self.MAX_INTERVAL))
+            logger.warning(f"Polling took too long for the last {self.LOOSEN_AFTER_POLLS} cycles. Set to {self.interval/1000:.3f} s")
+            self.slow_polls = 0
+
+        elif self.fast_polls >= self.TIGHTEN_AFTER_POLLS:
+            self.interval = self.target_interval()
+            logger.info(f"Polling was fast enough for the last {self.TIGHTEN_AFTER_POLLS} cycles. Set to {self.interval/1000:.3f} s")
+            self.fast_polls = 0
+
+        return self.interval
+
+
+class BatteryPollThread(threading.Thread):
+    """
+    Runs the blocking BMS I/O (`refresh_data()`) of all batteries in a dedicated thread,
+    so that the GLib main loop, which handles all D-Bus requests, is never blocked by a slow BMS.
+
+    After each poll the `BatterySnapshot` of each battery is handed over to the main loop with `GLib.idle_add`.
+    The values themselves stay in the battery objects. The handoff is lock-step: this thread waits on
+    `published_event` and does not touch the batteries again, until the main loop has published them.
+    So the main loop always sees consistent values without holding a lock during the I/O.
+
+    The poll interval of the first battery is adapted by a `PollIntervalController`.
+    """
+
+    def __init__(self, battery: Dict[Union[str, int], object], publish_callback: Callable[[Tuple[BatterySnapshot, ...]], None]):
+        """
+        :param battery: The battery dict of the driver
+        :param publish_callback: Called in the main loop with the snapshots of each poll
+        """
+        super().__init__(name="BatteryPollThread", daemon=True)
+        self.battery = battery
+        self.publish_callback = publish_callback
+        self.wake_event = threading.Event()
+        self.published_event = threading.Event()
+        self.published_event.set()
+        self._running = True
+        self.latency: Dict[Union[str, int], LatencyHistogram] = {key_address: LatencyHistogram() for key_address in battery}
+        self.controller: Union[PollIntervalController, None] = None
+
+    def trigger(self) -> None:
+        """
+        Poll immediately, e.g. if the battery signals new data by itself. Can be called from any thread.
+        """
+        self.wake_event.set()
+
+    def stop(self) -> None:
+        self._running = False
+        self.wake_event.set()
+        self.published_event.set()
+
+    def run(self) -> None:
+        first_key = list(self.battery.keys())[0]
+
+        # created here, since the poll interval can be changed after the thread was created
+        self.controller = PollIntervalController(self.battery[first_key].poll_interval)
+
+        while self._running:
+            # wait until the main loop has published the previous snapshots
+            self.published_event.wait()
+            if not self._running:
+                break
+            self.published_event.clear()
+
+            poll_start = monotonic()
+            snapshots = tuple(self.refresh(key_address) for key_address in self.battery)
+
+            # adapt the poll interval to the duration of the poll of all batteries
+            poll_interval = self.controller.update(sum(snapshot.runtime for snapshot in snapshots))
+            self.battery[first_key].poll_interval = poll_interval
+            snapshots = tuple(snapshot._replace(poll_interval=poll_interval) for snapshot in snapshots)
+
+            GLib.idle_add(self.publish, snapshots)
+
+            # wait for the next poll, a callback from the battery wakes up the thread earlier
+            self.wake_event.wait(max(0, self.battery[first_key].poll_interval / 1000 - (monotonic() - poll_start)))
+            self.wake_event.clear()
+
+    def refresh(self, key_address: Union[str, int]) -> BatterySnapshot:
+        """
+        Call `refresh_data()` of one battery and capture the result.
+
+        :param key_address: Key of the battery in the battery dict
+        :return: The snapshot
+        """
+        start = monotonic()
+        exception = None
+
+        try:
+            with self.battery[key_address].poll_lock:
+                # the getters have to scan the cells again, while the BMS updates them
+                self.battery[key_address].metrics = None
+                result = self.battery[key_address].refresh_data()
+                # calculate the aggregates once for all consumers in the main loop
+                self.battery[key_address].update_metrics()
+        except Exception:
+            result = False
+            exception = traceback.format_exc()
+
+        end = monotonic()
+
+        latency = self.latency[key_address]
+        latency.add(end - start)
+
+        return BatterySnapshot(
+            key_address,
+            result,
+            exception,
+            end,
+            end - start,
+            latency.percentile(50),
+            latency.percentile(95),
+            latency.percentile(99),
+            self.battery[key_address].poll_interval,
+        )
+
+    def publish(self, snapshots: Tuple[BatterySnapshot, ...]) -> bool:
+        """
+        Runs in the main loop.
+
+        :param snapshots: The snapshots of the last poll
+        :return: False, to remove the idle source
+        """
+        try:
+            self.publish_callback(snapshots)
+        except Exception:
+            (
+                exception_type,
+                exception_object,
+                exception_traceback,
+            ) = sys.exc_info()
+            file = exception_traceback.tb_frame.f_code.co_filename
+            line = exception_traceback.tb_lineno
+            logger.error(f"Exception occurred: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
+        finally:
+            # allow the next poll
+            self.published_event.set()
+
+        return False
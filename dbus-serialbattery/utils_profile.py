@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+import math
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+from typing import Union
+from utils import logger, write_file_atomic, LOAD_PROFILE_WEIGHT
+
+
+class LoadProfile:
+    """
+    Expected battery current per hour of the week, learned from the measured current.
+
+    The profile is a fixed array of 168 buckets (7 days * 24 hours). The samples of the running hour are summed up
+    and the mean is added to the bucket of the hour with an exponential weight, when the hour is over.
+    Hours that were not seen yet use the mean of the same hour on the other days or the mean of all hours.
+
+    The expected charge flow of the next week is precomputed once per hour as cumulative sums,
+    so an estimate of the time to charge or discharge a given amount is a binary search and a few multiplications.
+
+    The profile is saved to a small binary file once per hour and on shutdown.
+    """
+
+    BUCKETS = 7 * 24
+    """
+    Number of buckets, one per hour of the week
+    """
+
+    MIN_BUCKETS_READY = 24
+    """
+    Number of buckets that have to be learned, before estimates are returned
+    """
+
+    FILE_HEADER = struct.Struct("<4sHH")
+    """
+    Header of the file as (magic, version, number of buckets), followed by the means as double
+    and the number of learned hours as unsigned short per bucket
+    """
+
+    FILE_MAGIC = b"SBLP"
+    FILE_VERSION = 1
+
+    def __init__(self, path: Union[str, None] = None):
+        """
+        :param path: The file to load the profile from and save it to, None to keep it only in memory
+        """
+        self.path = path
+        self.means: array = array("d", [0.0] * self.BUCKETS)
+        """
+        Mean current in A per bucket, positive while charging
+        """
+        self.counts: array = array("H", [0] * self.BUCKETS)
+        """
+        Number of hours that were added per bucket
+        """
+        self.bucket: Union[int, None] = None
+        self.hour_start: float = 0
+        self.hour_end: float = 0
+        self.hour_sum: float = 0
+        self.hour_count: int = 0
+        self.learned: int = 0
+        """
+        Number of buckets with at least one learned hour
+        """
+        self.cumulative: array = array("d")
+        """
+        Expected charge in Ah from the end of the current hour until the end of each following hour
+        """
+        self.cumulative_max: array = array("d")
+        """
+        Running maximum of `cumulative`, to find the first hour in which a charge is reached
+        """
+        self.cumulative_min: array = array("d")
+        """
+        Running maximum of the negated `cumulative`, to find the first hour in which a discharge is reached
+        """
+
+        if self.path is not None:
+            self.load()
+
+    def load(self) -> bool:
+        """
+        Load the profile from the file. If the file does not exist or is invalid, the profile starts empty.
+
+        :return: True if the profile was loaded, else False
+        """
+        try:
+            with open(self.path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return False
+        except OSError as error:
+            logger.error(f"Load profile could not be read from {self.path}: {error}")
+            return False
+
+        means = array("d")
+        counts = array("H")
+        size = self.FILE_HEADER.size + self.BUCKETS * (means.itemsize + counts.itemsize)
+
+        if len(data) != size or self.FILE_HEADER.unpack_from(data) != (self.FILE_MAGIC, self.FILE_VERSION, self.BUCKETS):
+            logger.warning(f"Load profile {self.path} is invalid, starting with an empty profile")
+            return False
+
+        offset = self.FILE_HEADER.size
+        means.frombytes(data[offset : offset + self.BUCKETS * means.itemsize])
+        offset += self.BUCKETS * means.itemsize
+        counts.frombytes(data[offset:])
+
+        # the file is written in little endian
+        if sys.byteorder == "big":
+            means.byteswap()
+            counts.byteswap()
+
+        self.means = means
+        self.counts = counts
+        self.rebuild()
+        return True
+
+    def save(self) -> bool:
+        """
+        Save the profile to the file.
+
+        :return: True if the profile was saved, else False
+        """
+        if self.path is None:
+            return False
+
+        means = array("d", self.means)
+        counts = array("H", self.counts)
+        if sys.byteorder == "big":
+            means.byteswap()
+            counts.byteswap()
+
+        return write_file_atomic(self.path, self.FILE_HEADER.pack(self.FILE_MAGIC, self.FILE_VERSION, self.BUCKETS) + means.tobytes() + counts.tobytes())
+
+    def is_ready(self) -> bool:
+        """
+        :return: True if enough hours were learned to return estimates, else False
+        """
+        return self.bucket is not None and self.learned >= self.MIN_BUCKETS_READY
+
+    def add(self, current: float, timestamp: float) -> None:
+        """
+        Add a current sample.
+
+        :param current: The current in A, positive while charging
+        :param timestamp: The wall time of the sample as Unix timestamp in seconds
+        :return: None
+        """
+        if not self.hour_start <= timestamp < self.hour_end:
+            self.rollover(timestamp)
+
+        self.hour_sum += current
+        self.hour_count += 1
+
+    def rollover(self, timestamp: float) -> None:
+        """
+        Add the mean of the finished hour to its bucket and start the hour of the timestamp.
+
+        :param timestamp: The wall time as Unix timestamp in seconds
+        :return: None
+        """
+        if self.bucket is not None and self.hour_count > 0:
+            count = self.counts[self.bucket]
+            # the first hours are averaged equally, then older hours fade out
+            weight = max(1 / (count + 1), LOAD_PROFILE_WEIGHT)
+            self.means[self.bucket] += (self.hour_sum / self.hour_count - self.means[self.bucket]) * weight
+            self.counts[self.bucket] = min(count + 1, 0xFFFF)
+            self.save()
+
+        # the profile follows the local time, since the load depends on it
+        local_time = datetime.fromtimestamp(timestamp)
+        self.bucket = local_time.weekday() * 24 + local_time.hour
+        self.hour_start = timestamp - local_time.minute * 60 - local_time.second - local_time.microsecond / 1000000
+        self.hour_end = self.hour_start + 3600
+        self.hour_sum = 0
+        self.hour_count = 0
+
+        self.rebuild()
+
+    def get_expected_currents(self) -> array:
+        """
+        Buckets that were not learned yet use the mean of the same hour on the other days or the mean of all buckets.
+
+        :return: The expected current in A per bucket
+        """
+        learned = [i for i in range(self.BUCKETS) if self.counts[i] > 0]
+        mean = sum(self.means[i] for i in learned) / len(learned) if learned else 0
+
+        hour_means = []
+        for hour in range(24):
+            means = [self.means[i] for i in range(hour, self.BUCKETS, 24) if self.counts[i] > 0]
+            hour_means.append(sum(means) / len(means) if means else mean)
+
+        return array("d", (self.means[i] if self.counts[i] > 0 else hour_means[i % 24] for i in range(self.BUCKETS)))
+
+    def rebuild(self) -> None:
+        """
+        Precompute the expected charge flow of the next week, starting at the end of the current hour.
+
+        :return: None
+        """
+        self.learned = sum(1 for count in self.counts if count > 0)
+
+        if self.bucket is None:
+            return
+
+        expected_currents = self.get_expected_currents()
+        cumulative = array("d", [0.0])
+        cumulative_max = array("d", [0.0])
+        cumulative_min = array("d", [0.0])
+        charge = 0
+
+        for hour in range(1, self.BUCKETS + 1):
+            charge += expected_currents[(self.bucket + hour) % self.BUCKETS]
+            cumulative.append(charge)
+            cumulative_max.append(max(cumulative_max[-1], charge))
+            cumulative_min.append(max(cumulative_min[-1], -charge))
+
+        self.cumulative = cumulative
+        self.cumulative_max = cumulative_max
+        self.cumulative_min = cumulative_min
+
+    def get_seconds_to_charge(self, charge: float, current: float, timestamp: float) -> Union[float, None]:
+        """
+        Estimate the time until the battery charged or discharged the given amount.
+        The rest of the current hour uses the measured current, the following hours the profile.
+
+        :param charge: The charge in Ah, positive to charge and negative to discharge
+        :param current: The measured current in A, e.g. the average of the last minutes
+        :param timestamp: The current wall time as Unix timestamp in seconds
+        :return: The seconds, `math.inf` if the amount is not reached within a week, None if the profile is not ready
+        """
+        if not self.is_ready() or current is None:
+            return None
+
+        if charge == 0:
+            return 0
+
+        # calculate with positive values in both directions
+        sign = 1 if charge > 0 else -1
+        needed = charge * sign
+        current *= sign
+        running = self.cumulative_max if sign > 0 else self.cumulative_min
+
+        # rest of the current hour with the measured current
+        rest_hours = min(max((self.hour_end - timestamp) / 3600, 0), 1)
+        if current > 0 and current * rest_hours >= needed:
+            return needed / current * 3600
+
+        needed -= current * rest_hours
+
+        # first hour after the current hour, in which the needed charge is reached
+        hour = bisect_left(running, needed)
+        if hour >= len(running):
+            return math.inf
+
+        # the expected current is constant within the hour, so the crossing is interpolated linearly
+        charge_before = self.cumulative[hour - 1] * sign
+        charge_after = self.cumulative[hour] * sign
+
+        return (rest_hours + hour - 1 + (needed - charge_before) / (charge_after - charge_before)) * 3600
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple, Union
+from utils_clock import monotonic
+from utils import PUBLISH_ITEMS_CHANGED, PUBLISH_REFRESH_INTERVAL
+
+
+DEADBANDS: Dict[str, Tuple[float, float]] = {
+    "/Dc/0/Voltage": (0.02, 0),
+    "/Dc/0/Current": (0.1, 0),
+    "/Dc/0/Power": (5, 0.01),
+    "/Dc/0/Temperature": (0.1, 0),
+    "/Dc/0/MidVoltage": (0.02, 0),
+    "/Dc/0/MidVoltageDeviation": (0.1, 0),
+    "/Capacity": (0.1, 0),
+    "/ConsumedAmphours": (0.1, 0),
+    "/CurrentAvg": (0.1, 0),
+    "/Voltages/Sum": (0.02, 0),
+    "/Cell/Sum": (0.02, 0),
+}
+"""
+Deadbands of the dbus paths as (absolute, relative) tuple. A new value is only published, if it differs
+from the last published value by at least the absolute deadband or the relative deadband of the last value,
+whichever is greater. Paths that are not listed are published on every change.
+"""
+
+DEADBAND_PREFIXES: List[Tuple[str, Tuple[float, float]]] = [
+    ("/Voltages/Cell", (0.002, 0)),
+    ("/Cell/", (0.002, 0)),
+]
+"""
+Deadbands of dbus paths that start with the prefix, e.g. the cell voltages
+"""
+
+
+class PathPublisher:
+    """
+    Publishes values to a `VeDbusService` only if they changed more than the deadband of the path.
+
+    Values held back by the deadband are published at least every `PUBLISH_REFRESH_INTERVAL` seconds,
+    so the published value never stays away from the real value for long.
+    The last published value is read from the service, so values changed from outside are respected.
+
+    Inside `batch()` all changes are collected and sent as one `ItemsChanged` signal.
+    """
+
+    def __init__(self, dbusservice, refresh_interval: int = PUBLISH_REFRESH_INTERVAL):
+        """
+        :param dbusservice: The `VeDbusService` to publish to
+        :param refresh_interval: Seconds after which a value held back by the deadband is published anyway,
+            0 disables the deadbands
+        """
+        self.dbusservice = dbusservice
+        self.target = dbusservice
+        """
+        The service or the `ServiceContext` of the running batch
+        """
+        self.refresh_interval = refresh_interval
+        self.paths: Dict[str, list] = {}
+        """
+        Table with an entry [absolute deadband, relative deadband, monotonic time of last publish] per path
+        """
+
+    def get_entry(self, path: str) -> list:
+        """
+        Get the table entry of a path, it's created on the first publish.
+
+        :param path: The dbus path
+        :return: The entry
+        """
+        entry = self.paths.get(path)
+
+        if entry is None:
+            deadband = DEADBANDS.get(path)
+
+            if deadband is None:
+                for prefix, prefix_deadband in DEADBAND_PREFIXES:
+                    if path.startswith(prefix):
+                        deadband = prefix_deadband
+                        break
+
+            if deadband is None or self.refresh_interval <= 0:
+                deadband = (0, 0)
+
+            entry = self.paths[path] = [deadband[0], deadband[1], 0]
+
+        return entry
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """
+        Collect all changes published inside the with statement and send them in one `ItemsChanged` signal
+        instead of one `PropertiesChanged` signal per path. If `PUBLISH_ITEMS_CHANGED` is disabled, nothing changes.
+
+        :return: the context manager
+        """
+        if not PUBLISH_ITEMS_CHANGED or self.target is not self.dbusservice:
+            yield
+            return
+
+        # the ServiceContext of velib sends the collected changes on exit
+        with self.dbusservice as context:
+            self.target = context
+            try:
+                yield
+            finally:
+                self.target = self.dbusservice
+
+    def __getitem__(self, path: str):
+        return self.target[path]
+
+    def __setitem__(self, path: str, value: Union[int, float, str, None]) -> None:
+        self.publish(path, value)
+
+    def publish(self, path: str, value: Union[int, float, str, None]) -> bool:
+        """
+        Publish a value, if it changed enough.
+
+        :param path: The dbus path
+        :param value: The new value
+        :return: True if the value was published, else False
+        """
+        last_value = self.target[path]
+
+        if value == last_value:
+            return False
+
+        entry = self.get_entry(path)
+
+        if (
+            (entry[0] > 0 or entry[1] > 0)
+            and isinstance(value, (int, float))
+            and isinstance(last_value, (int, float))
+            and not isinstance(value, bool)
+            # add a small value to avoid that rounding errors hold back changes of exactly the deadband
+            and abs(value - last_value) + 1e-9 < max(entry[0], entry[1] * abs(last_value))
+            and monotonic() - entry[2] < self.refresh_interval
+        ):
+            return False
+
+        self.target[path] = value
+        entry[2] = monotonic()
+        return True
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+import math
+import mmap
+import os
+import struct
+import sys
+from typing import Dict, Iterator, List, Tuple, Union
+from utils import logger, RECORDER_SIZE
+
+
+RECORD_FIELDS: List[Tuple[str, int]] = [
+    ("current", 100),
+    ("voltage", 100),
+    ("soc", 10),
+    ("temp1", 10),
+    ("temp2", 10),
+    ("temp3", 10),
+    ("temp4", 10),
+    ("balancing", 1),
+    ("cvl", 100),
+    ("ccl", 10),
+    ("dcl", 10),
+    ("charge_mode", 1),
+]
+"""
+Fields of a record as (name, scale), followed by the cell voltages with a scale of 1000.
+The values are stored as integer of value * scale. Fields that change often come first,
+so the mask of the changed fields stays short.
+"""
+
+CELL_SCALE = 1000
+"""
+Scale of the cell voltages, 1 mV
+"""
+
+TIME_SCALE = 100
+"""
+Scale of the time between two records, 10 ms
+"""
+
+NONE_VALUE = -(2**31)
+"""
+Stored value of unknown values
+"""
+
+BLOCK_SIZE = 4096
+"""
+Size of a block in bytes. Each block starts with absolute values, so it can be decoded without the previous blocks.
+"""
+
+FILE_HEADER = struct.Struct("<4sHIII")
+"""
+Header of the file as (magic, version, number of blocks, index of the current block, sequence of the current block).
+It's followed by the charge modes as NUL separated strings until the end of the first block.
+"""
+
+BLOCK_HEADER = struct.Struct("<IdHHH")
+"""
+Header of a block as (sequence, Unix timestamp of the first record, number of cells, number of records, used bytes)
+"""
+
+FILE_MAGIC = b"SBTS"
+FILE_VERSION = 1
+
+
+def write_varint(buffer: bytearray, value: int) -> None:
+    """
+    Append an unsigned integer with 7 bits per byte, the highest bit marks that more bytes follow.
+
+    :param buffer: The buffer to append to
+    :param value: The value, has to be positive
+    :return: None
+    """
+    while value > 0x7F:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def read_varint(data: Union[bytes, mmap.mmap], position: int) -> Tuple[int, int]:
+    """
+    Read an unsigned integer written with `write_varint()`.
+
+    :param data: The data to read from
+    :param position: The position of the first byte
+    :return: The value and the position after the value
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+class Recorder:
+    """
+    Records the data of every poll to a ring file of fixed size, to troubleshoot e.g. cell drift
+    with a higher resolution than VRM.
+
+    The file is divided into blocks. A record only contains the time since the previous record,
+    a bit mask of the changed fields and the changes of these fields as variable length integers,
+    so most records need only a few bytes. When the file is full, the oldest block is overwritten.
+
+    The file is memory mapped, so adding a record only copies a few bytes and the kernel writes the changed pages.
+    Use `export_recording.py` to export the recording as CSV or JSON.
+    """
+
+    def __init__(self, path: str, size: int = RECORDER_SIZE * 1024 * 1024):
+        """
+        :param path: The file to record to
+        :param size: Size of the file in bytes
+        """
+        self.path = path
+        self.block_count = max(size // BLOCK_SIZE - 1, 2)
+        self.file = None
+        self.map: Union[mmap.mmap, None] = None
+        self.charge_modes: Dict[str, int] = {}
+        self.strings_end: int = FILE_HEADER.size
+        self.block: int = 0
+        self.sequence: int = 0
+        self.block_start: Union[int, None] = None
+        """
+        Position of the current block in the file, None if a new block has to be started
+        """
+        self.cell_count: int = 0
+        self.records: int = 0
+        self.used: int = 0
+        self.last_time: float = 0
+        self.delta_time: int = 0
+        self.previous: List[int] = []
+        self.values: List[int] = []
+        self.buffer: bytearray = bytearray()
+
+    def open(self) -> bool:
+        """
+        Open the file and continue the recording. An invalid file or a file with a different size is recreated.
+
+        :return: True if the file was opened, else False
+        """
+        size = BLOCK_SIZE * (self.block_count + 1)
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.file = open(self.path, "r+b" if os.path.exists(self.path) else "w+b")
+
+            valid = os.fstat(self.file.fileno()).st_size == size
+            if not valid:
+                self.file.truncate(0)
+                self.file.truncate(size)
+
+            self.map = mmap.mmap(self.file.fileno(), size)
+        except OSError as error:
+            logger.error(f"Recording {self.path} could not be opened: {error}")
+            self.close()
+            return False
+
+        magic, version, block_count, block, sequence = FILE_HEADER.unpack_from(self.map)
+
+        if valid and magic == FILE_MAGIC and version == FILE_VERSION and block_count == self.block_count:
+            self.block = block
+            self.sequence = sequence
+
+            # load the charge modes
+            strings = bytes(self.map[FILE_HEADER.size : BLOCK_SIZE]).split(b"\0\0", 1)[0]
+            for string in strings.split(b"\0") if strings else []:
+                self.charge_modes[string.decode()] = len(self.charge_modes) + 1
+                self.strings_end += len(string) + 1
+        else:
+            for block in range(self.block_count + 1):
+                self.map[BLOCK_SIZE * block : BLOCK_SIZE * (block + 1)] = bytes(BLOCK_SIZE)
+            FILE_HEADER.pack_into(self.map, 0, FILE_MAGIC, FILE_VERSION, self.block_count, self.block_count - 1, 0)
+            self.block = self.block_count - 1
+
+        logger.info(f"Recording to {self.path} ({size / 1024 / 1024:.1f} MB)")
+        return True
+
+    def close(self) -> None:
+        """
+        Write the changed pages and close the file.
+
+        :return: None
+        """
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def get_charge_mode_index(self, charge_mode: Union[str, None]) -> int:
+        """
+        :param charge_mode: The charge mode
+        :return: The index of the charge mode in the string table, 0 if it's None or the table is full
+        """
+        if not charge_mode:
+            return 0
+
+        index = self.charge_modes.get(charge_mode)
+
+        if index is None:
+            string = charge_mode.encode()
+            # keep at least one NUL after the last string to mark the end
+            if self.strings_end + len(string) + 2 > BLOCK_SIZE:
+                return 0
+
+            self.map[self.strings_end : self.strings_end + len(string)] = string
+            self.strings_end += len(string) + 1
+            index = self.charge_modes[charge_mode] = len(self.charge_modes) + 1
+
+        return index
+
+    def start_block(self, timestamp: float) -> None:
+        """
+        Start the next block, the oldest block is overwritten.
+
+        :param timestamp: The Unix timestamp of the first record
+        :return: None
+        """
+        self.block = (self.block + 1) % self.block_count
+        self.sequence += 1
+        self.block_start = BLOCK_SIZE * (self.block + 1)
+        self.records = 0
+        self.used = 0
+        self.last_time = timestamp
+        self.previous = [0] * len(self.values)
+
+        BLOCK_HEADER.pack_into(self.map, self.block_start, self.sequence, timestamp, self.cell_count, 0, 0)
+        FILE_HEADER.pack_into(self.map, 0, FILE_MAGIC, FILE_VERSION, self.block_count, self.block, self.sequence)
+
+    def encode(self, timestamp: float) -> bytearray:
+        """
+        Encode the values as changes to the previous record.
+
+        :param timestamp: The Unix timestamp of the record
+        :return: The encoded record
+        """
+        buffer = self.buffer
+        buffer.clear()
+        self.delta_time = round((timestamp - self.last_time) * TIME_SCALE)
+        write_varint(buffer, self.delta_time)
+
+        changes = bytearray()
+        mask = 0
+        previous = self.previous
+
+        for i, value in enumerate(self.values):
+            delta = value - previous[i]
+            if delta:
+                mask |= 1 << i
+                write_varint(changes, delta * 2 if delta >= 0 else -delta * 2 - 1)
+
+        write_varint(buffer, mask)
+        buffer += changes
+        return buffer
+
+    def record(self, battery, timestamp: float) -> None:
+        """
+        Append the data of the current poll.
+
+        :param battery: The battery
+        :param timestamp: The Unix timestamp of the poll
+        :return: None
+        """
+        if self.map is None:
+            return
+
+        try:
+            values = [
+                battery.get_current(),
+                battery.voltage,
+                battery.soc_calc if battery.soc_calc is not None else battery.soc,
+                battery.temp1,
+                battery.temp2,
+                battery.temp3,
+                battery.temp4,
+                battery.cells.balance_mask,
+                battery.control_voltage,
+                battery.control_charge_current,
+                battery.control_discharge_current,
+                self.get_charge_mode_index(battery.charge_mode),
+            ]
+            quantized = [NONE_VALUE if value is None else round(value * scale) for value, (_, scale) in zip(values, RECORD_FIELDS)]
+            quantized += [NONE_VALUE if math.isnan(voltage) else round(voltage * CELL_SCALE) for voltage in battery.cells.voltages]
+            self.values = quantized
+
+            # start a new block, if the cells changed or the time went backwards
+            if self.block_start is None or len(battery.cells) != self.cell_count or timestamp < self.last_time:
+                self.cell_count = len(battery.cells)
+                self.start_block(timestamp)
+
+            record = self.encode(timestamp)
+
+            if self.used + len(record) > BLOCK_SIZE - BLOCK_HEADER.size or self.records == 0xFFFF:
+                self.start_block(timestamp)
+                record = self.encode(timestamp)
+
+            position = self.block_start + BLOCK_HEADER.size + self.used
+            self.map[position : position + len(record)] = record
+            self.used += len(record)
+            self.records += 1
+            # continue from the stored time, so the rounding errors do not add up
+            self.last_time += self.delta_time / TIME_SCALE
+            self.previous = quantized
+
+            # update the number of records and used bytes in the block header
+            struct.pack_into("<HH", self.map, self.block_start + BLOCK_HEADER.size - 4, self.records, self.used)
+
+        except Exception:
+            # the recording must never stop the driver
+            self.close()
+
+            exception_type, exception_object, exception_traceback = sys.exc_info()
+            file = exception_traceback.tb_frame.f_code.co_filename
+            line = exception_traceback.tb_lineno
+            logger.error(f"Recording stopped: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
+
+
+class RecordingReader:
+    """
+    Reads a file written by `Recorder`.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: The recording
+        """
+        with open(path, "rb") as file:
+            self.data = file.read()
+
+        magic, version, self.block_count, _, _ = FILE_HEADER.unpack_from(self.data)
+        if magic != FILE_MAGIC or version != FILE_VERSION or len(self.data) != BLOCK_SIZE * (self.block_count + 1):
+            raise ValueError(f"{path} is not a valid recording")
+
+        strings = self.data[FILE_HEADER.size : BLOCK_SIZE].split(b"\0\0", 1)[0]
+        self.charge_modes: List[Union[str, None]] = [None] + ([string.decode() for string in strings.split(b"\0")] if strings else [])
+
+        # the blocks in the order they were written
+        self.blocks: List[Tuple[int, int, float, int, int, int]] = []
+        """
+        Blocks as (sequence, position, start timestamp, number of cells, number of records, used bytes)
+        """
+        for block in range(self.block_count):
+            position = BLOCK_SIZE * (block + 1)
+            sequence, start, cell_count, records, used = BLOCK_HEADER.unpack_from(self.data, position)
+            if sequence > 0 and records > 0:
+                self.blocks.append((sequence, position, start, cell_count, records, used))
+        self.blocks.sort()
+
+    def get_max_cell_count(self) -> int:
+        """
+        :return: The highest number of cells of all blocks
+        """
+        return max((block[3] for block in self.blocks), default=0)
+
+    def read(self, start: float = None, end: float = None) -> Iterator[Tuple[float, Dict[str, Union[float, int, str, None]]]]:
+        """
+        Read the records within a time range.
+
+        :param start: The Unix timestamp of the first record, None to start with the oldest record
+        :param end: The Unix timestamp of the last record, None to read until the newest record
+        :return: An iterator of (Unix timestamp, values)
+        """
+        for i, (_, position, block_start, cell_count, records, used) in enumerate(self.blocks):
+            # skip blocks that end before the start, a block ends when the next one starts
+            if start is not None and i + 1 < len(self.blocks) and self.blocks[i + 1][2] < start:
+                continue
+            if end is not None and block_start > end:
+                break
+
+            fields = RECORD_FIELDS + [("cell" + str(cell + 1), CELL_SCALE) for cell in range(cell_count)]
+            values = [0] * len(fields)
+            timestamp = block_start
+            data = self.data
+            data_position = position + BLOCK_HEADER.size
+
+            for _ in range(records):
+                delta_time, data_position = read_varint(data, data_position)
+                mask, data_position = read_varint(data, data_position)
+                timestamp += delta_time / TIME_SCALE
+
+                while mask:
+                    bit = mask & -mask
+                    mask ^= bit
+                    delta, data_position = read_varint(data, data_position)
+                    values[bit.bit_length() - 1] += delta >> 1 if not delta & 1 else -((delta + 1) >> 1)
+
+                if start is not None and timestamp < start:
+                    continue
+                if end is not None and timestamp > end:
+                    return
+
+                record = {}
+                for (name, scale), value in zip(fields, values):
+                    record[name] = None if value == NONE_VALUE else value / scale if scale != 1 else value
+                record["charge_mode"] = self.charge_modes[record["charge_mode"]] if record["charge_mode"] < len(self.charge_modes) else None
+
+                yield round(timestamp, 2), record
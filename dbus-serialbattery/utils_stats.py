@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+import threading
+from collections import deque
+from typing import Callable, Deque, List, Tuple, Union
+from utils_clock import monotonic
+
+
+POWER_AVERAGE_WINDOWS: List[Tuple[str, float, float]] = [
+    ("1Min", 60, 1),
+    ("5Min", 300, 5),
+    ("1Hour", 3600, 60),
+]
+"""
+Windows of the average power as (name of the dbus path, window in seconds, resolution in seconds)
+"""
+
+
+class RollingWindow:
+    """
+    Statistics over the last `size` samples in a ring buffer.
+
+    Mean, minimum and maximum are available in O(1): the sum is maintained on every add
+    and the minimum and maximum are kept in monotonic queues.
+    """
+
+    def __init__(self, size: int):
+        """
+        :param size: Number of samples to keep
+        """
+        self.size = size
+        self.values: Deque[float] = deque(maxlen=size)
+        self.total: float = 0
+        self.adds: int = 0
+        # indexes of the samples, that can still become the minimum or maximum
+        self.min_queue: Deque[list] = deque()
+        self.max_queue: Deque[list] = deque()
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def add(self, value: float) -> None:
+        """
+        Add a sample, the oldest sample is dropped, if the window is full.
+
+        :param value: The sample
+        :return: None
+        """
+        if len(self.values) == self.size:
+            self.total -= self.values[0]
+
+        self.values.append(value)
+        self.total += value
+        self.adds += 1
+
+        # add the sum again from time to time, so that rounding errors do not add up
+        if self.adds % (self.size * 10) == 0:
+            self.total = sum(self.values)
+
+        while self.min_queue and self.min_queue[-1][1] >= value:
+            self.min_queue.pop()
+        self.min_queue.append([self.adds, value])
+        while self.max_queue and self.max_queue[-1][1] <= value:
+            self.max_queue.pop()
+        self.max_queue.append([self.adds, value])
+
+        oldest = self.adds - len(self.values)
+        if self.min_queue[0][0] <= oldest:
+            self.min_queue.popleft()
+        if self.max_queue[0][0] <= oldest:
+            self.max_queue.popleft()
+
+    def clear(self) -> None:
+        self.values.clear()
+        self.min_queue.clear()
+        self.max_queue.clear()
+        self.total = 0
+
+    @property
+    def mean(self) -> Union[float, None]:
+        """
+        :return: The mean of the samples, None if there are no samples
+        """
+        return self.total / len(self.values) if self.values else None
+
+    @property
+    def min(self) -> Union[float, None]:
+        return self.min_queue[0][1] if self.min_queue else None
+
+    @property
+    def max(self) -> Union[float, None]:
+        return self.max_queue[0][1] if self.max_queue else None
+
+
+class TimeWindow:
+    """
+    Mean of the samples of the last `window` seconds.
+
+    The samples are aggregated in buckets of `resolution` seconds, so long windows like one hour
+    need only a few entries and adding a sample is O(1).
+    """
+
+    def __init__(self, window: float, resolution: float = 1):
+        """
+        :param window: Length of the window in seconds
+        :param resolution: Length of a bucket in seconds
+        """
+        self.window = window
+        self.resolution = resolution
+        self.buckets: Deque[list] = deque()
+        """
+        Buckets as [start time, sum, count]
+        """
+        self.total: float = 0
+        self.count: int = 0
+
+    def add(self, value: float, timestamp: float = None) -> None:
+        """
+        Add a sample.
+
+        :param value: The sample
+        :param timestamp: Monotonic time of the sample in seconds, now if None
+        :return: None
+        """
+        if timestamp is None:
+            timestamp = monotonic()
+
+        if self.buckets and timestamp - self.buckets[-1][0] < self.resolution:
+            bucket = self.buckets[-1]
+            bucket[1] += value
+            bucket[2] += 1
+        else:
+            self.buckets.append([timestamp, value, 1])
+
+        self.total += value
+        self.count += 1
+        self.expire(timestamp)
+
+    def expire(self, timestamp: float) -> None:
+        """
+        Drop the buckets that left the window.
+
+        :param timestamp: The current monotonic time in seconds
+        :return: None
+        """
+        while self.buckets and timestamp - self.buckets[0][0] >= self.window:
+            _, bucket_sum, bucket_count = self.buckets.popleft()
+            self.total -= bucket_sum
+            self.count -= bucket_count
+
+        # start from an exact value again, if the window is empty
+        if self.count == 0:
+            self.total = 0
+
+    def clear(self) -> None:
+        self.buckets.clear()
+        self.total = 0
+        self.count = 0
+
+    @property
+    def mean(self) -> Union[float, None]:
+        """
+        :return: The mean of the samples in the window, None if there are no samples
+        """
+        return self.total / self.count if self.count > 0 else None
+
+
+class Ema:
+    """
+    Exponential moving average.
+    """
+
+    def __init__(self, alpha: float):
+        """
+        :param alpha: Weight of a new sample between 0 and 1, higher values follow changes faster
+        """
+        self.alpha = alpha
+        self.value: Union[float, None] = None
+
+    def add(self, value: float) -> float:
+        """
+        Add a sample.
+
+        :param value: The sample
+        :return: The new average
+        """
+        self.value = value if self.value is None else self.value + self.alpha * (value - self.value)
+        return self.value
+
+    def clear(self) -> None:
+        self.value = None
+
+
+class EventCounter:
+    """
+    Counts events within the last `window` seconds, up to `limit` events.
+
+    Only the timestamps of the last `limit` events are kept, since it's only needed to know,
+    if the limit was reached within the window.
+    """
+
+    def __init__(self, window: float, limit: int):
+        """
+        :param window: Length of the window in seconds
+        :param limit: Maximum number of events that are counted
+        """
+        self.window = window
+        self.limit = limit
+        self.timestamps: Deque[float] = deque(maxlen=limit)
+
+    def add(self, timestamp: float = None) -> None:
+        """
+        Record an event.
+
+        :param timestamp: Time of the event in seconds, now if None
+        :return: None
+        """
+        self.timestamps.append(monotonic() if timestamp is None else timestamp)
+
+    def count(self, timestamp: float = None) -> int:
+        """
+        Number of events within the window.
+
+        :param timestamp: The current time in seconds, now if None
+        :return: The number of events, at most `limit`
+        """
+        if timestamp is None:
+            timestamp = monotonic()
+
+        while self.timestamps and timestamp - self.timestamps[0] > self.window:
+            self.timestamps.popleft()
+
+        return len(self.timestamps)
+
+    def is_limit_reached(self, timestamp: float = None) -> bool:
+        """
+        :param timestamp: The current time in seconds, now if None
+        :return: True if `limit` events occurred within the window
+        """
+        return self.count(timestamp) >= self.limit
+
+
+class CoulombCounter:
+    """
+    Integrates the current of every sample, that the driver receives, to the charge in Ah.
+
+    The samples are integrated with the trapezoidal rule on a monotonic clock, so the accuracy does not depend
+    on the poll interval and a paused main loop does not lose charge. Samples can be added from any thread,
+    e.g. by the CAN receiver or a BLE notification, the charge is taken by the main loop with `take()`.
+    The charge is only integrated between samples, the interval after the last sample is added with the next sample.
+
+    A sample added with `supersede` that follows the previous one within `SUPERSEDE_INTERVAL` replaces it,
+    since some drivers set a preliminary value first and correct it directly afterwards in the same poll.
+    Samples with the time of a received frame are always integrated, also if several frames arrive in one burst.
+    """
+
+    SUPERSEDE_INTERVAL = 0.01
+    """
+    Seconds within a sample replaces the previous sample
+    """
+
+    def __init__(self, correction: Callable[[float], float] = None):
+        """
+        :param correction: Called with each current to correct it, e.g. with the SoC current correction curve
+        """
+        self.correction = correction
+        self.lock = threading.Lock()
+        self.last_time: Union[float, None] = None
+        self.last_current: Union[float, None] = None
+        self.last_segment: float = 0
+        self.prev_time: Union[float, None] = None
+        self.prev_current: Union[float, None] = None
+        self.charge: float = 0
+        """
+        Charge in Ah since the last `take()`, positive while charging
+        """
+        self.samples: int = 0
+        """
+        Number of samples since the last `take()`
+        """
+
+    def add(self, current: float, timestamp: float = None, supersede: bool = False) -> None:
+        """
+        Add a current sample.
+
+        :param current: The current in A
+        :param timestamp: Monotonic time of the sample in seconds, now if None
+        :param supersede: If True, the sample replaces the previous sample, if it follows within `SUPERSEDE_INTERVAL`
+        :return: None
+        """
+        if timestamp is None:
+            timestamp = monotonic()
+        if self.correction is not None:
+            current = self.correction(current)
+
+        with self.lock:
+            if supersede and self.last_time is not None and timestamp - self.last_time < self.SUPERSEDE_INTERVAL:
+                # replace the last sample
+                self.charge -= self.last_segment
+                self.last_time = self.prev_time
+                self.last_current = self.prev_current
+            else:
+                self.samples += 1
+
+            segment = 0
+            if self.last_time is not None and timestamp > self.last_time:
+                segment = (self.last_current + current) / 2 * (timestamp - self.last_time) / 3600
+
+            self.charge += segment
+            self.last_segment = segment
+            self.prev_time = self.last_time
+            self.prev_current = self.last_current
+            self.last_time = timestamp
+            self.last_current = current
+
+    def take(self) -> float:
+        """
+        Return the charge integrated until the last sample since the last call and start counting from zero.
+
+        :return: The charge in Ah, positive while charging
+        """
+        with self.lock:
+            # the taken charge must not be replaced anymore
+            self.last_segment = 0
+            self.prev_time = self.last_time
+            self.prev_current = self.last_current
+
+            charge = self.charge
+            self.charge = 0
+            self.samples = 0
+
+        return charge
+
+    def reset(self) -> None:
+        """
+        Forget the last sample and the charge, e.g. if the connection to the battery was lost.
+
+        :return: None
+        """
+        with self.lock:
+            self.last_time = None
+            self.last_current = None
+            self.last_segment = 0
+            self.prev_time = None
+            self.prev_current = None
+            self.charge = 0
+            self.samples = 0